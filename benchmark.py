@@ -0,0 +1,193 @@
+from optparse import OptionParser
+import os, sys, time, json, shutil, tempfile, subprocess
+from eim_corpus import generate
+from eim_discovery import discover, make_job
+from eim_debug_parser import EIMDebugParser
+from master_parser import parser_classes
+
+# Parsers benchmarked, by file type
+benchmark_parsers = dict(parser_classes, DEBUG=EIMDebugParser)
+
+# Directory holding the command-line tools run by the pipeline benchmark
+tool_dir = os.path.dirname(os.path.abspath(__file__))
+
+def main():
+
+    # Setup option parser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--dir', dest='root_dir', default=None, help='corpus directory to benchmark, or to generate into with --sessions')
+    parser.add_option('-s', '--sessions', dest='sessions', type='int', default=None, help='generate a synthetic corpus of this many sessions first')
+    parser.add_option('-l', '--song-lines', dest='song_lines', type='int', default=20000, help='samples in each generated song file')
+    parser.add_option('-g', '--generate-only', dest='generate_only', action='store_true', default=False, help='generate the corpus and exit')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3, help='times each parser benchmark is run; the fastest run is reported')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='worker processes for the parsing stage of the pipeline')
+    parser.add_option('--inject', dest='inject', action='store_true', default=False, help='also time json_injector, which imports the corpus into the eim database on localhost')
+    parser.add_option('-o', '--output', dest='output', default=None, help='also write the results to this JSON file')
+    (options, args) = parser.parse_args()
+
+    if options.root_dir is None and options.sessions is None:
+        parser.error('give a corpus directory with --dir, or --sessions to generate one')
+
+    # Generate a corpus, in a temporary directory unless one was given
+    temporary = options.root_dir is None
+    root_dir = options.root_dir or tempfile.mkdtemp(prefix='eim_corpus_')
+    if options.sessions:
+        start = time.perf_counter()
+        paths = generate(root_dir, options.sessions, song_lines=options.song_lines)
+        print('Generated %d files for %d sessions below %s in %.1f s' %
+                (len(paths), options.sessions, root_dir, time.perf_counter() - start))
+
+    if options.generate_only:
+        return
+
+    try:
+        results = {
+            'parsers':benchmark_parsers_on(root_dir, options.repeat),
+            'pipeline':benchmark_pipeline(root_dir, options.jobs, options.inject)
+        }
+    finally:
+        if temporary:
+            shutil.rmtree(root_dir)
+
+    print_results(results)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+def throughput(files, size, seconds):
+    """
+    Returns a benchmark result for files files of size bytes in all,
+    processed in seconds.
+
+    >>> throughput(4, 4 * 1024 * 1024, 0.5)['mb_per_second']
+    8.0
+    """
+    return {
+        'files':files,
+        'bytes':size,
+        'seconds':seconds,
+        'files_per_second':files / seconds if seconds else None,
+        'mb_per_second':size / (1024 * 1024) / seconds if seconds else None
+    }
+
+def benchmark_parsers_on(root_dir, repeat=3):
+    """
+    Times each parser class over every source file of its type below
+    root_dir, from construction through parse and to_dict, without writing
+    output. Returns a result from throughput for each file type, using the
+    fastest of repeat runs.
+    """
+    jobs = dict()
+    for f in discover(root_dir):
+        if f.extension == 'txt' and f.file_type in benchmark_parsers:
+            jobs.setdefault(f.file_type, list()).append(make_job(os.path.abspath(f.path)))
+
+    results = dict()
+    for (file_type, type_jobs) in sorted(jobs.items()):
+        parser_class = benchmark_parsers[file_type]
+        size = sum(job.size for job in type_jobs)
+        best = None
+
+        for run in range(repeat):
+            start = time.perf_counter()
+            for job in type_jobs:
+                p = parser_class(job.path, job=job)
+                p.parse()
+                p.to_dict()
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best = seconds
+
+        results[file_type] = throughput(len(type_jobs), size, best)
+        results[file_type]['parser'] = parser_class.__name__
+
+    return results
+
+def benchmark_pipeline(original_dir, jobs=1, inject=False):
+    """
+    Times the command-line tools run one after another over a copy of
+    original_dir: master_parser, json_compiler and, if inject is set and a
+    database is running on localhost, json_injector. The tools write their
+    output next to the files they read, so working on a copy leaves
+    original_dir untouched and every run starts from the source files alone.
+    Returns a result from throughput for each stage, counting the files each
+    one reads, and for the whole pipeline, counting the source files.
+    """
+    work_dir = tempfile.mkdtemp(prefix='eim_benchmark_')
+    root_dir = os.path.join(work_dir, 'corpus')
+    stages = [
+        ('parse', ['master_parser.py', '-d', root_dir, '-q', '-j', str(jobs)], lambda f: f.extension == 'txt'),
+        ('compile', ['json_compiler.py', '-d', root_dir, '-q'], lambda f: f.extension == 'json'),
+        ('inject', ['json_injector.py', '-d', root_dir, '-q'], lambda f: f.extension == 'json' and f.file_type in ('SESSION', 'SONG'))
+    ]
+
+    results = dict()
+    try:
+        # Copy the corpus, keeping the modification times its versions are
+        # read from
+        shutil.copytree(original_dir, root_dir)
+
+        for (stage, command, reads) in stages:
+            if stage == 'inject':
+                if not inject:
+                    continue
+                if not database_available():
+                    print('Skipping the inject stage: no database is running on localhost')
+                    continue
+
+            inputs = [f.path for f in discover(root_dir) if reads(f)]
+            size = sum(os.path.getsize(path) for path in inputs)
+
+            # Logs are written to the working directory, outside the copy
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, os.path.join(tool_dir, command[0])] + command[1:],
+                    cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            results[stage] = throughput(len(inputs), size, time.perf_counter() - start)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if 'parse' in results:
+        results['total'] = throughput(results['parse']['files'], results['parse']['bytes'],
+                sum(result['seconds'] for result in results.values()))
+
+    return results
+
+def database_available(host='localhost', port=27017):
+    """
+    Returns True if a MongoDB server answers on host:port within a second.
+    """
+    from pymongo import MongoClient
+    client = MongoClient(host, port, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+        return True
+    except Exception:
+        return False
+    finally:
+        client.close()
+
+def rate(format, value):
+    """
+    Formats a rate from throughput, which is None for a run that took no
+    measurable time.
+
+    >>> rate('%.1f', 2.25), rate('%.1f', None)
+    ('2.2', '-')
+    """
+    if value is None:
+        return '-'
+    return format % value
+
+def print_results(results):
+    row = '%-10s %-18s %8s %10s %10s %10s'
+    print(row % ('', '', 'files', 'seconds', 'files/s', 'MB/s'))
+    for (group, group_results) in [('parser', results['parsers']), ('pipeline', results['pipeline'])]:
+        for (name, result) in sorted(group_results.items()):
+            label = result.get('parser', name)
+            print(row % (group, label, result['files'], '%.3f' % result['seconds'],
+                    rate('%.1f', result['files_per_second']), rate('%.2f', result['mb_per_second'])))
+
+if __name__ == "__main__":
+    main()
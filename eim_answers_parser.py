@@ -1,13 +1,34 @@
-from eim_parser import EIMParser, EIMParsingError
+from eim_parser import EIMParser, EIMParsingError, date_first, tail_lines
 import re, datetime, sys, os
 
+# Classifies an answer line by its question key and captures its answer in a
+# single search. Keys are matched case-insensitively, and where two could
+# start at the same place they are tried in the order below. Each key's group
+# spans its answer, which is captured in <key>_value groups, or in a
+# <key>_empty group when the question was left unanswered; a line whose
+# answer cannot be read matches its key alone.
+answer_key_regex = re.compile(
+        '(?P<sex>(?i:SEX)(?:.*?(?P<sex_value>Male|Female)|(?P<sex_empty>$))?)'
+        '|(?P<dob>(?i:DOB)(?:[\",\s]+(?P<dob_value>\d{1,4})|(?P<dob_empty>$))?)'
+        '|(?P<nationality>(?i:NATIONALITY)(?:\"?[,\s]+(?:symbol )?(?P<nationality_value>[\s\w]+)|(?P<nationality_empty>$))?)'
+        '|(?P<musical_background>(?i:MUSICAL_BACKGROUND)(?:.*?(?P<musical_background_value>Yes|No)|(?P<musical_background_empty>$))?)'
+        '|(?P<musical_expertise>(?i:MUSICAL_EXPERTISE)(?:.*(?P<musical_expertise_value>\d)|(?P<musical_expertise_empty>$))?)'
+        '|(?P<hearing_impairments>(?i:HEARING_IMPAIRMENTS)(?:.*?(?P<hearing_impairments_value>Yes|No)|(?P<hearing_impairments_empty>$))?)'
+        '|(?P<visual_impairments>(?i:VISUAL_IMPAIRMENTS)(?:.*?(?P<visual_impairments_value>Yes|No)|(?P<visual_impairments_empty>$))?)'
+        '|(?P<song_scale>(?i:SONG)(?P<song_scale_index>\d+)_(?:(?:Scale\d+[a-z]?_)?(?P<song_scale_name>\w+).*(?P<song_scale_value>\d)|(?:Scale\d+_)?(?P<song_scale_empty>\w+)$)?)'
+        '|(?P<most>(?i:FINALQ_MOST)(?:_(?P<most_name>\w+)[\s,]+(?P<most_value>\d+)|(?P<most_empty>_\w+$))?)'
+        '|(?P<emotion_index>(?i:EMOTIONINDEX)(?:(?P<emotion_index_index>\w+)" , (?P<emotion_index_value>\d+\.\d+) ;)?)'
+        '|(?P<music_style>(?i:MUSIC_?STYLE)(?:_(?P<music_style_name>\w+)\"?[\s,]+(?P<music_style_value>[01])|(?P<music_style_empty>_\w+$))?)'
+        '|(?P<song_label>(?i:SONG\s?\d [HRST]\d{3}))'
+        '|(?P<song>(?i:^SONG\d$))')
+
 class EIMAnswersParser(EIMParser):
 
-    def __init__(self, filepath, logger=None):
+    def __init__(self, filepath, logger=None, job=None):
         """
         Initializes EIMAnswersParser.
         """
-        super().__init__(filepath, logger)
+        super().__init__(filepath, logger, job)
         self.sex = None
         self.dob = None
         self.nationality = None
@@ -154,34 +175,26 @@ class EIMAnswersParser(EIMParser):
             allowed_lines = 20
 
         try:
-            self.open_file()
-            lines = list(self._file)
-
-            total_lines = len(lines)
-
+            # Version 5 files are parsed in full, streaming them. Earlier
+            # versions only hold answers in their last allowed_lines lines,
+            # which are read back from the end of the file and numbered
+            # backwards from -1 for the last line.
             if self.version == 5:
-                start_line = 0
+                self.open_file()
+                lines = self.iter_lines()
             else:
-                start_line = total_lines - allowed_lines
-
-
-            # If a date line is present, parse it first
-            for number, line in enumerate(lines):
-                if number >= start_line:
-                    if re.search('DATE', line):
-                        try:
-                            self.parse_line(line, number + 1)
-                        except:
-                            self.logger.error(e)
-                        break
-
-            # Parse all allowed lines
-            for number, line in enumerate(lines):
-                if number >= start_line:
-                    try:
-                        self.parse_line(line, number + 1)
-                    except Exception as e:
-                        self.logger.error(e)
+                tail = tail_lines(self._filepath, allowed_lines)
+                lines = date_first(enumerate(tail, -len(tail)))
+
+            # Parse all allowed lines, with any date line parsed first
+            for (number, line) in lines:
+                try:
+                    self.parse_line(line, number)
+                except Exception as e:
+                    self.count_line_error(e)
+            self.log_line_errors()
+
+            self.finalize()
 
             # Parse session id
             match = re.search('T\d_S(\d{4})_.*.txt', self._filepath)
@@ -197,9 +210,20 @@ class EIMAnswersParser(EIMParser):
             if self._file and not self._file.closed:
                 self.close_file()
 
+    def finalize(self):
+        """
+        Sorts the ratings and emotion indices collected from every line into
+        their arrays.
+        """
+        self.sort_ratings()
+        if self.temporary_emotion_indices:
+            self.sort_emotion_indices()
+
     def parse_line(self, line, number):
         """
-        Parses a line of text from an answer file.
+        Parses a line of text from an answer file. The line is searched once
+        with answer_key_regex, and the match, holding the answer, is passed to
+        the parser method for its key.
 
         >>> f = open('./test_data/.SINGAPORE_T2_S0448_answers.txt', 'w')
         >>> f.close()
@@ -234,86 +258,107 @@ class EIMAnswersParser(EIMParser):
         False
 
         >>> p.parse_line('"Song1_Scale1_Engagement" , 3 ;', 8)
+        >>> p.finalize()
         >>> p.ratings['engagement'][0]
         3
 
         >>> p.parse_line('"Song1_Scale2_Positivity" , 3 ;', 9)
+        >>> p.finalize()
         >>> p.ratings['positivity'][0]
         3
 
         >>> p.parse_line('"Song1_Scale3_Activity" , 2 ;', 10)
+        >>> p.finalize()
         >>> p.ratings['activity'][0]
         2
 
         >>> p.parse_line('"Song1_Scale4_Power" , 3 ;', 11)
+        >>> p.finalize()
         >>> p.ratings['power'][0]
         3
 
         >>> p.parse_line('"Song1_Scale5_Chills" , 1 ;', 12)
+        >>> p.finalize()
         >>> p.ratings['chills'][0]
         1
 
         >>> p.parse_line('"Song1_Scale6_like_dislike" , 2 ;', 13)
+        >>> p.finalize()
         >>> p.ratings['like_dislike'][0]
         2
 
         >>> p.parse_line('"Song1_Scale7_Familiarity" , 4 ;', 14)
+        >>> p.finalize()
         >>> p.ratings['familiarity'][0]
         4
 
         >>> p.parse_line('"Song2_Scale1_Engagement" , 1 ;', 15)
+        >>> p.finalize()
         >>> p.ratings['engagement'][1]
         1
 
         >>> p.parse_line('"Song2_Scale2_Positivity" , 2 ;', 16)
+        >>> p.finalize()
         >>> p.ratings['positivity'][1]
         2
 
         >>> p.parse_line('"Song2_Scale3_Activity" , 1 ;', 17)
+        >>> p.finalize()
         >>> p.ratings['activity'][1]
         1
 
         >>> p.parse_line('"Song2_Scale4_Power" , 3 ;', 18)
+        >>> p.finalize()
         >>> p.ratings['power'][1]
         3
 
         >>> p.parse_line('"Song2_Scale5_Chills" , 1 ;', 19)
+        >>> p.finalize()
         >>> p.ratings['chills'][1]
         1
 
         >>> p.parse_line('"Song2_Scale6_like_dislike" , 1 ;', 20)
+        >>> p.finalize()
         >>> p.ratings['like_dislike'][1]
         1
 
         >>> p.parse_line('"Song2_Scale7_Familiarity" , 1 ;', 21)
+        >>> p.finalize()
         >>> p.ratings['familiarity'][1]
         1
 
         >>> p.parse_line('"Song3_Scale1_Engagement" , 2 ;', 22)
+        >>> p.finalize()
         >>> p.ratings['engagement'][2]
         2
 
         >>> p.parse_line('"Song3_Scale2_Positivity" , 3 ;', 23)
+        >>> p.finalize()
         >>> p.ratings['positivity'][2]
         3
 
         >>> p.parse_line('"Song3_Scale3_Activity" , 2 ;', 24)
+        >>> p.finalize()
         >>> p.ratings['activity'][2]
         2
 
         >>> p.parse_line('"Song3_Scale4_Power" , 3 ;', 25)
+        >>> p.finalize()
         >>> p.ratings['power'][2]
         3
 
         >>> p.parse_line('"Song3_Scale5_Chills" , 1 ;', 26)
+        >>> p.finalize()
         >>> p.ratings['chills'][2]
         1
 
         >>> p.parse_line('"Song3_Scale6_like_dislike" , 2 ;', 27)
+        >>> p.finalize()
         >>> p.ratings['like_dislike'][2]
         2
 
         >>> p.parse_line('"Song3_Scale7_Familiarity" , 1 ;', 28)
+        >>> p.finalize()
         >>> p.ratings['familiarity'][2]
         1
 
@@ -326,14 +371,17 @@ class EIMAnswersParser(EIMParser):
         1
 
         >>> p.parse_line('"EmotionIndex3" , 0.598997 ;', 31)
+        >>> p.finalize()
         >>> p.emotion_indices[2]
         0.598997
 
         >>> p.parse_line('"EmotionIndex2" , 0.595210 ;', 32)
+        >>> p.finalize()
         >>> p.emotion_indices[1]
         0.59521
 
         >>> p.parse_line('"EmotionIndex1" , 21.4085 ;', 33)
+        >>> p.finalize()
         >>> p.emotion_indices[0]
         21.4085
 
@@ -366,49 +414,16 @@ class EIMAnswersParser(EIMParser):
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
 
-        if re.search('SEX', line.upper()):
-            self.parse_sex_line(line, number)
-
-        elif re.search('DOB', line.upper()):
-            self.parse_dob_line(line, number)
-
-        elif re.search('NATIONALITY', line.upper()):
-            self.parse_nationality_line(line, number)
-
-        elif re.search('MUSICAL_BACKGROUND', line.upper()):
-            self.parse_musical_background_line(line, number)
-
-        elif re.search('MUSICAL_EXPERTISE', line.upper()):
-            self.parse_musical_expertise_line(line, number)
-
-        elif re.search('HEARING_IMPAIRMENTS', line.upper()):
-            self.parse_hearing_impairments_line(line, number)
-
-        elif re.search('VISUAL_IMPAIRMENTS', line.upper()):
-            self.parse_visual_impairments_line(line, number)
-
-        elif re.search('SONG\d+_', line.upper()):
-            self.parse_song_scale_line(line, number)
-
-        elif re.search('FINALQ_MOST', line.upper()):
-            self.parse_most_enjoyed_engaged_line(line, number)
-
-        elif re.search('EMOTIONINDEX', line.upper()):
-            self.parse_emotion_index_line(line, number)
-
-        elif re.search('MUSIC_?STYLE', line.upper()):
-            self.parse_music_style_line(line, number)
-
-        elif re.search('SONG\s?\d [HRST]\d{3}', line.upper()):
-            return
-
-        elif re.search('^SONG\d$', line.upper()):
-            return
-
-        else:
+        match = answer_key_regex.search(line)
+        if not match:
             raise EIMParsingError('Unprocessed line: %s:%d %s' % (self._filepath, number, line))
 
-    def parse_most_enjoyed_engaged_line(self, line, number):
+        # Song label lines carry no answer
+        handler = answer_line_handlers[match.lastgroup]
+        if handler:
+            handler(self, line, number, match)
+
+    def parse_most_enjoyed_engaged_line(self, line, number, match=None):
         """
         Parses the 'Most Enjoyed / Engaged' lines from an answer file.
 
@@ -432,21 +447,20 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('FinalQ_Most_(\w+)[\s,]+(\d+)', line)
-        empty_match = re.search('^FinalQ_Most_(\w+)$', line)
+        match = match or answer_key_regex.search(line)
 
-        if match:
-            if match.groups()[0] in ['Enjoyed', 'Ejoyed']:
-                self.most_enjoyed = int(match.groups()[1])
-            elif match.groups()[0] == 'Engaged':
-                self.most_engaged = int(match.groups()[1])
-        elif empty_match:
+        if match and match.group('most_value'):
+            if match.group('most_name') in ['Enjoyed', 'Ejoyed']:
+                self.most_enjoyed = int(match.group('most_value'))
+            elif match.group('most_name') == 'Engaged':
+                self.most_engaged = int(match.group('most_value'))
+        elif match and match.group('most_empty'):
             return
         else:
             raise EIMParsingError("Invalid most enjoyed / engaged line: %s:%d"
                     % (self._filepath, number))
 
-    def parse_musical_expertise_line(self, line, number):
+    def parse_musical_expertise_line(self, line, number, match=None):
         """
         Parses the 'Musical Expertise' line from an answer file.
 
@@ -466,17 +480,16 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('Musical_Expertise.*(\d+)', line)
-        empty_match = re.search('Musical_Expertise$', line)
-        if match:
-            self.musical_expertise = int(match.groups()[0])
-        elif empty_match:
+        match = match or answer_key_regex.search(line)
+        if match and match.group('musical_expertise_value'):
+            self.musical_expertise = int(match.group('musical_expertise_value'))
+        elif match and match.group('musical_expertise_empty') is not None:
             return
         else:
             raise EIMParsingError("Invalid musical expertise line: %s:%d"
                     % (self._filepath, number))
 
-    def parse_music_style_line(self, line, number):
+    def parse_music_style_line(self, line, number, match=None):
         """
         Parses an 'Music Style' line from an answer file.
 
@@ -526,17 +539,15 @@ class EIMAnswersParser(EIMParser):
                 self.music_styles.append(style)
         """
 
-        match = re.search('\"?05_Music_Style_(\w+)\"?[\s,]+1', line)
-        match_empty = re.search('Music_Style_(\w+)$', line)
-        match_zero = re.search('\"?05_Music_Style_(\w+)\"?[\s,]+0', line)
+        match = match or answer_key_regex.search(line)
 
-        if match:
+        if match and match.group('music_style_value') == '1':
             if not self.music_styles:
                 self.music_styles = list()
-            self.music_styles.append(match.groups()[0].lower())
+            self.music_styles.append(match.group('music_style_name').lower())
 
         else:
-            if match_empty or match_zero:
+            if match and (match.group('music_style_empty') or match.group('music_style_value') == '0'):
                 return
             raise EIMParsingError("Invalid music style line: %s:%d"
                     % (self._filepath, number))
@@ -582,7 +593,7 @@ class EIMAnswersParser(EIMParser):
         for entry in self.temporary_emotion_indices:
             self.emotion_indices[int(entry['index'] - 1)] = float(entry['value'])
 
-    def parse_emotion_index_line(self, line, number):
+    def parse_emotion_index_line(self, line, number, match=None):
         """
         Parses an 'Emotion Index' line from an answer file.
 
@@ -591,12 +602,15 @@ class EIMAnswersParser(EIMParser):
 
         >>> p = EIMAnswersParser('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         >>> p.parse_emotion_index_line('"EmotionIndex2" , 36.4641 ;', 1)
+        >>> p.finalize()
         >>> p.emotion_indices[1]
         36.4641
         >>> p.parse_emotion_index_line('"EmotionIndex84" , 18.5 ;', 1)
+        >>> p.finalize()
         >>> p.emotion_indices[83]
         18.5
         >>> p.parse_emotion_index_line('"EmotionIndex1" , 1.0 ;', 1)
+        >>> p.finalize()
         >>> p.emotion_indices[0]
         1.0
 
@@ -608,14 +622,13 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('"EmotionIndex(\w+)" , (\d+\.\d+) ;', line)
-        if match:
+        match = match or answer_key_regex.search(line)
+        if match and match.group('emotion_index_value'):
             if not self.temporary_emotion_indices:
                 self.temporary_emotion_indices = list()
-            number = match.groups()[0]
-            value = float(match.groups()[1])
-            self.temporary_emotion_indices.append({'index':int(number),'value':value})
-            self.sort_emotion_indices()
+            index = int(match.group('emotion_index_index'))
+            value = float(match.group('emotion_index_value'))
+            self.temporary_emotion_indices.append({'index':index,'value':value})
         else:
             raise EIMParsingError("Invalid emotion index line: %s:%d"
                     % (self._filepath, number))
@@ -688,7 +701,7 @@ class EIMAnswersParser(EIMParser):
 
                 self.ratings[scale][entry['index'] - 1] = entry['value']
 
-    def parse_song_scale_line(self, line, number):
+    def parse_song_scale_line(self, line, number, match=None):
         """
         Parses a 'Song Scale' line from an answer file.
 
@@ -697,11 +710,13 @@ class EIMAnswersParser(EIMParser):
 
         >>> p = EIMAnswersParser('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         >>> p.parse_song_scale_line('"Song2_Scale4_Power" , 5 ;', 1)
+        >>> p.finalize()
         >>> p.ratings['power'][1]
         5
         >>> p.ratings['power'][0]
 
         >>> p.parse_song_scale_line('"Song1_Scale4_Power" , 3 ;', 1)
+        >>> p.finalize()
         >>> p.ratings['power'][0]
         3
 
@@ -720,29 +735,25 @@ class EIMAnswersParser(EIMParser):
         if not self.temporary_ratings:
             self.temporary_ratings = dict()
 
-        match = re.search('Song(\d+)_(?:Scale\d+[a-z]?_)?(\w+).*(\d)', line)
-        empty_match = re.search('Song(\d+)_(?:Scale\d+_)?(\w+)$', line)
-        if match:
-            number = int(match.groups()[0])
-            scale = match.groups()[1].lower()
-            value = int(match.groups()[2])
+        match = match or answer_key_regex.search(line)
+        if match and match.group('song_scale_value'):
+            index = int(match.group('song_scale_index'))
+            scale = match.group('song_scale_name').lower()
+            value = int(match.group('song_scale_value'))
             if scale not in self.temporary_ratings:
                 self.temporary_ratings[scale] = list()
-            self.temporary_ratings[scale].append({'index':number,'value':value})
-        elif empty_match:
-            number = int(match.groups()[0])
-            scale = match.groups()[1].lower()
+            self.temporary_ratings[scale].append({'index':index,'value':value})
+        elif match and match.group('song_scale_empty'):
+            index = int(match.group('song_scale_index'))
+            scale = match.group('song_scale_empty').lower()
             if scale not in self.temporary_ratings:
                 self.temporary_ratings[scale] = list()
-            self.temporary_ratings[scale].append({'index':number,'value':None})
+            self.temporary_ratings[scale].append({'index':index,'value':None})
         else:
             raise EIMParsingError("Invalid song scale line: %s:%d"
                     % (self._filepath, number))
 
-        # Re-sort the song ratings
-        self.sort_ratings()
-
-    def parse_visual_impairments_line(self, line, number):
+    def parse_visual_impairments_line(self, line, number, match=None):
         """
         Parses the 'Hearing Impairments' line from an answer file.
 
@@ -766,20 +777,19 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('(Yes|No)', line)
-        empty_match = re.search('Impairments$', line)
-        if match:
-            if match.groups()[0] == 'Yes':
+        match = match or answer_key_regex.search(line)
+        if match and match.group('visual_impairments_value'):
+            if match.group('visual_impairments_value') == 'Yes':
                 self.visual_impairments = True
             else:
                 self.visual_impairments = False
-        elif empty_match:
+        elif match and match.group('visual_impairments_empty') is not None:
             return
         else:
             raise EIMParsingError("Invalid visual impairments line: %s:%d"
                     % (self._filepath, number))
 
-    def parse_hearing_impairments_line(self, line, number):
+    def parse_hearing_impairments_line(self, line, number, match=None):
         """
         Parses the 'Hearing Impairments' line from an answer file.
 
@@ -803,20 +813,19 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('(Yes|No)', line)
-        empty_match = re.search('Impairments$', line)
-        if match:
-            if match.groups()[0] == 'Yes':
+        match = match or answer_key_regex.search(line)
+        if match and match.group('hearing_impairments_value'):
+            if match.group('hearing_impairments_value') == 'Yes':
                 self.hearing_impairments = True
             else:
                 self.hearing_impairments = False
-        elif empty_match:
+        elif match and match.group('hearing_impairments_empty') is not None:
             return
         else:
             raise EIMParsingError("Invalid hearing impairments line: %s:%d"
                     % (self._filepath, number))
 
-    def parse_musical_background_line(self, line, number):
+    def parse_musical_background_line(self, line, number, match=None):
         """
         Parses the 'Musical Background' line from an answer file.
 
@@ -840,13 +849,12 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        empty = re.search('^03_Musical_Background$', line)
-        if empty:
+        match = match or answer_key_regex.search(line)
+        if match and match.group('musical_background_empty') is not None:
             self.musical_background = None
         else:
-            match = re.search('(Yes|No)', line)
-            if match:
-                if match.groups()[0] == 'Yes':
+            if match and match.group('musical_background_value'):
+                if match.group('musical_background_value') == 'Yes':
                     self.musical_background = True
                 else:
                     self.musical_background = False
@@ -854,7 +862,7 @@ class EIMAnswersParser(EIMParser):
                 raise EIMParsingError("Invalid musical background line: %s:%d"
                         % (self._filepath, number))
 
-    def parse_nationality_line(self, line, number):
+    def parse_nationality_line(self, line, number, match=None):
         """
         Parses the 'Nationality' line from an answer file.
 
@@ -878,17 +886,16 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('\"?02_Nationality\"?[,\s]+(?:symbol )?([\s\w]+)', line)
-        empty_match = re.search('Nationality$', line)
-        if match:
-            self.nationality = match.groups()[0].lower().strip()
-        elif empty_match:
+        match = match or answer_key_regex.search(line)
+        if match and match.group('nationality_value'):
+            self.nationality = match.group('nationality_value').lower().strip()
+        elif match and match.group('nationality_empty') is not None:
             return
         else:
             raise EIMParsingError("Invalid nationality line: %s:%d"
                     % (self._filepath, number))
 
-    def parse_dob_line(self, line, number):
+    def parse_dob_line(self, line, number, match=None):
         """
         Parses the 'DOB' line from an answer file.
 
@@ -908,20 +915,19 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('DOB[\",\s]+(\d{1,4})', line)
-        empty_match = re.search('DOB$', line)
-        if match:
-            year = int(match.groups()[0])
+        match = match or answer_key_regex.search(line)
+        if match and match.group('dob_value'):
+            year = int(match.group('dob_value'))
             if year == 0:
                 year = None
             self.dob = year
-        elif empty_match:
+        elif match and match.group('dob_empty') is not None:
             return
         else:
             raise EIMParsingError("Invalid DOB line: %s:%d"
                     % (self._filepath, number))
 
-    def parse_sex_line(self, line, number):
+    def parse_sex_line(self, line, number, match=None):
         """
         Parses the 'Sex' line from an answer file.
 
@@ -946,16 +952,33 @@ class EIMAnswersParser(EIMParser):
         >>> import os
         >>> os.unlink('./test_data/.SINGAPORE_T2_S0448_answers.txt')
         """
-        match = re.search('(Male|Female)', line)
-        empty_match = re.search('Sex$', line)
-        if match:
-            self.sex = match.groups()[0].lower()
-        elif empty_match:
+        match = match or answer_key_regex.search(line)
+        if match and match.group('sex_value'):
+            self.sex = match.group('sex_value').lower()
+        elif match and match.group('sex_empty') is not None:
             return
         else:
             raise EIMParsingError("Invalid sex line: %s:%d"
                     % (self._filepath, number))
 
+# Parser method for each key group of answer_key_regex, or None for lines
+# that are recognized but ignored
+answer_line_handlers = {
+    'sex':EIMAnswersParser.parse_sex_line,
+    'dob':EIMAnswersParser.parse_dob_line,
+    'nationality':EIMAnswersParser.parse_nationality_line,
+    'musical_background':EIMAnswersParser.parse_musical_background_line,
+    'musical_expertise':EIMAnswersParser.parse_musical_expertise_line,
+    'hearing_impairments':EIMAnswersParser.parse_hearing_impairments_line,
+    'visual_impairments':EIMAnswersParser.parse_visual_impairments_line,
+    'song_scale':EIMAnswersParser.parse_song_scale_line,
+    'most':EIMAnswersParser.parse_most_enjoyed_engaged_line,
+    'emotion_index':EIMAnswersParser.parse_emotion_index_line,
+    'music_style':EIMAnswersParser.parse_music_style_line,
+    'song_label':None,
+    'song':None
+}
+
 def __test():
     import doctest
     doctest.testmod()
@@ -0,0 +1,229 @@
+from optparse import OptionParser
+import os, sqlite3, datetime, logging
+from eim_parser import location_from_path, version_from_mtime
+from eim_discovery import discover, classify
+
+catalog_schema = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        file_type TEXT NOT NULL,
+        extension TEXT NOT NULL,
+        label TEXT,
+        location TEXT,
+        terminal INTEGER,
+        session_number INTEGER,
+        version INTEGER,
+        size INTEGER,
+        mtime REAL
+    );
+    CREATE INDEX IF NOT EXISTS files_location_mtime ON files (location, mtime);
+    CREATE INDEX IF NOT EXISTS files_session ON files (session_number, terminal);
+"""
+
+catalog_columns = ['path', 'file_type', 'extension', 'label', 'location',
+        'terminal', 'session_number', 'version', 'size', 'mtime']
+
+def describe_file(filepath, stat=None):
+    """
+    Returns a catalog row dictionary for a session file, or None if the
+    filename is not a session file.
+
+    >>> stat = os.stat_result((0,) * 6 + (512, 0, 1328054400, 0))
+    >>> d = describe_file('/data/BERGEN/SERVER/T0_S0822_R017.txt', stat)
+    >>> d['file_type'], d['label'], d['location'], d['terminal'], d['session_number'], d['version'], d['size']
+    ('SONG', 'R017', 'bergen', 0, 822, 5, 512)
+    >>> describe_file('/data/BERGEN/SERVER/T0_S0822.json', stat)['file_type']
+    'SESSION'
+    >>> describe_file('/data/BERGEN/SERVER/notes.txt')
+    """
+    f = classify(filepath)
+    if f.file_type == 'UNKNOWN':
+        return None
+
+    if stat is None:
+        stat = os.stat(filepath)
+
+    return {
+        'path':os.path.abspath(filepath),
+        'file_type':f.file_type,
+        'extension':f.extension,
+        'label':f.label,
+        'location':location_from_path(filepath),
+        'terminal':f.terminal,
+        'session_number':f.session_number,
+        'version':version_from_mtime(stat.st_mtime),
+        'size':stat.st_size,
+        'mtime':stat.st_mtime
+    }
+
+class EIMCatalog():
+
+    def __init__(self, filepath='eim_catalog.sqlite', logger=None):
+        """
+        Opens, creating it if necessary, a persistent SQLite catalog of the
+        session files found below one or more root directories.
+
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(root, 'BERGEN', 'T2'))
+        >>> for name in ['T2_S0822_answers.txt', 'T2_S0822_R017.txt', 'T2_S0822.json', 'notes.txt']:
+        ...     open(os.path.join(root, 'BERGEN', 'T2', name), 'w').close()
+        >>> os.utime(os.path.join(root, 'BERGEN', 'T2', 'T2_S0822_answers.txt'), (1329300000, 1329300000))
+        >>> c = EIMCatalog(os.path.join(root, 'catalog.sqlite'))
+        >>> c.update(root)
+        3
+        >>> [os.path.basename(r['path']) for r in c.query(location='bergen', since=datetime.date(2012, 2, 1), until=datetime.date(2012, 3, 1))]
+        ['T2_S0822_answers.txt']
+        >>> len(c.query(extension='txt'))
+        2
+        >>> os.unlink(os.path.join(root, 'BERGEN', 'T2', 'T2_S0822_R017.txt'))
+        >>> c.update(root)
+        2
+        >>> c.close()
+        >>> import shutil
+        >>> shutil.rmtree(root)
+        """
+        if logger == None:
+            self.logger = logging.getLogger('eim_catalog')
+        else:
+            self.logger = logger
+
+        self._filepath = filepath
+        self._connection = sqlite3.connect(filepath)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(catalog_schema)
+
+    def close(self):
+        self._connection.close()
+
+    def add(self, rows):
+        """
+        Inserts or replaces catalog rows.
+        """
+        self._connection.executemany(
+                'INSERT OR REPLACE INTO files (%s) VALUES (%s)' % (
+                    ', '.join(catalog_columns),
+                    ', '.join(':%s' % c for c in catalog_columns)),
+                rows)
+        self._connection.commit()
+
+    def update(self, root_dir):
+        """
+        Walks root_dir and brings its part of the catalog up to date, adding
+        new and changed files and dropping files that no longer exist. Returns
+        the number of session files found.
+        """
+        root_dir = os.path.abspath(root_dir)
+        rows = list()
+
+        for f in discover(root_dir):
+            if f.file_type == 'UNKNOWN':
+                continue
+            try:
+                rows.append(describe_file(f.path))
+            except OSError as e:
+                self.logger.error('Could not catalog %s: %s' % (f.path, e))
+
+        prefix = os.path.join(root_dir, '')
+        self._connection.execute(
+                'DELETE FROM files WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix))
+        self.add(rows)
+        self.logger.info('Cataloged %d session files below %s' % (len(rows), root_dir))
+        return len(rows)
+
+    def query(self, file_type=None, extension=None, location=None, terminal=None,
+            session_number=None, since=None, until=None, root_dir=None):
+        """
+        Returns catalog rows, as dictionaries ordered by path, matching every
+        given criterion. since and until are dates or datetimes bounding the
+        file modification time; until is exclusive. root_dir limits the rows to
+        files below that directory.
+        """
+        clauses = list()
+        values = list()
+
+        if root_dir is not None:
+            prefix = os.path.join(os.path.abspath(root_dir), '')
+            clauses.append('substr(path, 1, ?) = ?')
+            values.extend([len(prefix), prefix])
+
+        for (column, value) in [('file_type', file_type), ('extension', extension),
+                ('location', location), ('terminal', terminal),
+                ('session_number', session_number)]:
+            if value is not None:
+                clauses.append('%s = ?' % column)
+                values.append(value)
+
+        if since is not None:
+            clauses.append('mtime >= ?')
+            values.append(to_timestamp(since))
+
+        if until is not None:
+            clauses.append('mtime < ?')
+            values.append(to_timestamp(until))
+
+        statement = 'SELECT * FROM files'
+        if clauses:
+            statement += ' WHERE ' + ' AND '.join(clauses)
+        statement += ' ORDER BY path'
+
+        return [dict(row) for row in self._connection.execute(statement, values)]
+
+def to_timestamp(date):
+    """
+    Converts a date or datetime to seconds since the epoch, in local time.
+
+    >>> to_timestamp(datetime.date(2012, 2, 1)) == datetime.datetime(2012, 2, 1).timestamp()
+    True
+    """
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime(date.year, date.month, date.day)
+    return date.timestamp()
+
+def main():
+
+    # Setup option parser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--catalog', dest='catalog', default='eim_catalog.sqlite', help='catalog database file')
+    parser.add_option('-d', '--dir', dest='root_dirs', action='append', default=[], help='root directory to (re)catalog; may be repeated')
+    parser.add_option('-t', '--type', dest='file_type', default=None, help='list files of this type, such as SONG or ANSWERS')
+    parser.add_option('-e', '--extension', dest='extension', default=None, help='list files with this extension, txt or json')
+    parser.add_option('-l', '--location', dest='location', default=None, help='list files from this location')
+    parser.add_option('-s', '--since', dest='since', default=None, help='list files modified on or after this date (YYYY-MM-DD)')
+    parser.add_option('-u', '--until', dest='until', default=None, help='list files modified before this date (YYYY-MM-DD)')
+    (options, args) = parser.parse_args()
+
+    logger = logging.getLogger('eim_catalog')
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(ch)
+
+    catalog = EIMCatalog(options.catalog, logger)
+
+    try:
+        # Update the catalog for each root directory given
+        for root_dir in options.root_dirs:
+            catalog.update(root_dir)
+
+        # Otherwise, list matching files
+        if not options.root_dirs:
+            since = None
+            until = None
+            if options.since:
+                since = datetime.datetime.strptime(options.since, '%Y-%m-%d')
+            if options.until:
+                until = datetime.datetime.strptime(options.until, '%Y-%m-%d')
+
+            location = options.location.lower() if options.location else None
+            for row in catalog.query(file_type=options.file_type, extension=options.extension,
+                    location=location, since=since, until=until):
+                print(row['path'])
+
+    finally:
+        catalog.close()
+
+if __name__ == "__main__":
+    main()
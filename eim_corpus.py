@@ -0,0 +1,311 @@
+"""
+Generates synthetic experiment data with the directory layout, filenames,
+file formats and modification times of the real data, for benchmarks and
+for trying out the tools without a copy of the experiment archive.
+
+Each session gets a reset, info, test, answers and debug file and three song
+files. Sessions are spread over the five locations. Dublin sessions cycle
+through the four Dublin file versions: their files are given modification
+times inside each version's date range, so that version_from_mtime
+recognizes them, and use the legacy signal and answer formats. Answer files
+of versions 1-4 hold their answers in exactly the last lines read for their
+version, after a preamble of other lines.
+"""
+import os, random, datetime
+
+# A day inside the date range of each Dublin version
+dublin_dates = {
+    1:datetime.date(2010,7,6),
+    2:datetime.date(2010,8,14),
+    3:datetime.date(2010,9,5),
+    4:datetime.date(2010,9,30)
+}
+
+# First experiment day at each of the other locations
+location_dates = {
+    'NYC':datetime.date(2011,7,7),
+    'BERGEN':datetime.date(2012,2,1),
+    'SINGAPORE':datetime.date(2012,7,20),
+    'MANILA':datetime.date(2012,12,20)
+}
+
+locations = ['DUBLIN', 'NYC', 'BERGEN', 'SINGAPORE', 'MANILA']
+
+# Rating scales asked after each song, by answer file version
+rating_scales = {
+    1:['Engagement', 'Positivity', 'Activity', 'Power', 'Chills', 'like_dislike', 'Familiarity'],
+    2:['Engagement', 'Positivity', 'Activity', 'Power', 'Chills', 'like_dislike', 'Familiarity', 'Tension'],
+    3:['Engagement', 'Positivity', 'Activity', 'Power', 'Chills', 'like_dislike', 'Familiarity', 'Tension', 'Wonder', 'Transcendence'],
+    4:['Engagement', 'Positivity', 'Activity', 'Power'],
+    5:['Engagement', 'Positivity', 'Activity', 'Power', 'Chills', 'like_dislike', 'Familiarity']
+}
+
+music_styles = ['Rock', 'Pop', 'Jazz', 'Classical', 'Dance', 'Hip_Hop', 'World', 'Traditional_Irish']
+nationalities = ['Irish', 'American', 'Norwegian', 'Singaporean', 'Filipino']
+
+# Songs played in the experiment: happy, relaxing, sad and tense excerpts
+song_labels = ['%s%03d' % (kind, number) for kind in 'HRST' for number in range(1, 21)]
+
+# Milliseconds between signal samples
+sample_interval = 4
+
+def session_directory(root_dir, location, terminal, date):
+    """
+    Returns the directory holding a session's files, laid out as on the
+    experiment servers at location.
+
+    >>> session_directory('data', 'DUBLIN', 1, datetime.date(2010,9,5))
+    'data/DUBLIN/MuSE_SERVER/05-Sep-2010'
+    >>> session_directory('data', 'NYC', 2, datetime.date(2011,7,7))
+    'data/NYC/SERVER_NYC/2011-07-07/terminals/T2/2011-07-07'
+    >>> session_directory('data', 'SINGAPORE', 3, datetime.date(2012,7,21))
+    'data/SINGAPORE/SERVER/2012-07-21/SingaporeTerminal/T3/21-07-2012/experiment'
+    """
+    if location == 'DUBLIN':
+        return os.path.join(root_dir, location, 'MuSE_SERVER', date.strftime('%d-%b-%Y'))
+
+    if location == 'NYC':
+        return os.path.join(root_dir, location, 'SERVER_NYC', date.isoformat(),
+                'terminals', 'T%d' % terminal, date.isoformat())
+
+    terminal_dir = '%sTerminal' % location.capitalize()
+    if location == 'BERGEN':
+        return os.path.join(root_dir, location, 'SERVER', date.isoformat(), terminal_dir,
+                date.strftime('%d-%m-%Y'), 'experiment')
+
+    return os.path.join(root_dir, location, 'SERVER', date.isoformat(), terminal_dir,
+            'T%d' % terminal, date.strftime('%d-%m-%Y'), 'experiment')
+
+def clock(seconds):
+    """
+    Returns a time of day in seconds as HH:MM:SS.
+
+    >>> clock(52058)
+    '14:27:38'
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def signal_lines(count, version, rng, malformed=0.0):
+    """
+    Returns count lines of signal samples, four milliseconds apart, in the
+    seven-channel format of version 5 or the fifteen-column legacy format.
+    A fraction malformed of the lines is truncated.
+
+    >>> lines = signal_lines(2, 5, random.Random(0))
+    >>> [len(line.split()) for line in lines]
+    [7, 7]
+    >>> lines[1].split()[0]
+    '00:00.004'
+    >>> signal_lines(1, 2, random.Random(0))[0].split()[3:]
+    ['0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
+    """
+    lines = list()
+    eda = rng.uniform(200, 400)
+    hr = rng.uniform(60, 90)
+
+    for i in range(count):
+        millis = i * sample_interval
+        timestamp = '%02d:%02d.%03d' % (millis // 60000, millis // 1000 % 60, millis % 1000)
+        eda = min(max(eda + rng.uniform(-2, 2), 100), 600)
+        pox = rng.randint(0, 1023)
+
+        if version > 4:
+            hr = min(max(hr + rng.uniform(-0.5, 0.5), 40), 180)
+            line = '%s %d %.2f 1 %d %.3f 1' % (timestamp, eda, eda * 1.1, pox, hr)
+        else:
+            line = '%s %d %d 0 0 0 0 0 0 0 0 0 0 0 0' % (timestamp, eda, pox)
+
+        if malformed and rng.random() < malformed:
+            line = line[:len(line) // 2]
+        lines.append(line)
+
+    return lines
+
+def answer_lines(version, songs, rng):
+    """
+    Returns the answer lines of a questionnaire for version. Versions 1-4
+    return exactly as many lines as are read from the end of their files.
+
+    >>> rng = random.Random(0)
+    >>> [len(answer_lines(version, ['H001', 'R014', 'S002'], rng)) for version in [1, 2, 3, 4]]
+    [84, 41, 47, 20]
+    >>> answer_lines(5, ['H001', 'R014', 'S002'], rng)[0]
+    '"01a_Sex , symbol Female ;'
+    """
+    lines = list()
+    scales = rating_scales[version]
+
+    if version == 5:
+        quote = '"'
+        symbol = 'symbol '
+    else:
+        quote = ''
+        symbol = ''
+
+    lines.append('%s01a_Sex , %s%s ;' % (quote, symbol, rng.choice(['Male', 'Female'])))
+    lines.append('%s01b_DOB%s , %d ;' % (quote, quote, rng.randint(1940, 1995)))
+    lines.append('%s02_Nationality%s , %s%s ;' % (quote, quote, symbol, rng.choice(nationalities)))
+    lines.append('%s03_Musical_Background%s , %s%s ;' % (quote, quote, symbol, rng.choice(['Yes', 'No'])))
+    lines.append('%s03_Musical_Expertise%s , %d ;' % (quote, quote, rng.randint(1, 5)))
+    lines.append('%s04_Hearing_Impairments%s , %s%s ;' % (quote, quote, symbol, rng.choice(['Yes', 'No'])))
+    lines.append('%s04_Visual_Impairments%s , %s%s ;' % (quote, quote, symbol, rng.choice(['Yes', 'No'])))
+
+    for (number, song) in enumerate(songs, 1):
+        if version in (2, 3):
+            lines.append('SONG %d %s' % (number, song))
+        for (index, scale) in enumerate(scales, 1):
+            lines.append('%sSong%d_Scale%d_%s%s , %d ;' % (quote, number, index, scale, quote, rng.randint(1, 5)))
+
+    lines.append('FinalQ_Most_Enjoyed , %d ;' % rng.randint(1, len(songs)))
+    if version != 4:
+        lines.append('FinalQ_Most_Engaged , %d ;' % rng.randint(1, len(songs)))
+
+    if version == 1:
+        for index in range(54, 0, -1):
+            lines.append('"EmotionIndex%d" , %.6f ;' % (index, rng.uniform(0, 40)))
+    elif version == 5:
+        for index in range(3, 0, -1):
+            lines.append('"EmotionIndex%d" , %.6f ;' % (index, rng.uniform(0, 40)))
+
+    if version in (2, 3, 5):
+        for style in rng.sample(music_styles, 5):
+            lines.append('%s05_Music_Style_%s%s , %d ;' % (quote, style, quote, rng.randint(0, 1)))
+
+    return lines
+
+def info_lines(date, start, songs, version):
+    """
+    Returns the lines of an info file for a session starting start seconds
+    after midnight on date.
+
+    >>> info_lines(datetime.date(2012,7,20), 51958, ['H015', 'S014', 'H001'], 5)[:3]
+    ['SONGS , symbol "H015.wav-S014.wav-H001.wav" ;', 'DATE , symbol "07-20-2012" ;', 'START , symbol "14:25:58" ;']
+    >>> info_lines(datetime.date(2010,9,5), 51958, ['H015', 'S014', 'H001'], 3)[-1]
+    'H001, 14:32:08;'
+    """
+    lines = list()
+    media = '-'.join('%s.wav' % song for song in songs)
+
+    if version == 5:
+        lines.append('SONGS , symbol "%s" ;' % media)
+        lines.append('DATE , symbol "%s" ;' % date.strftime('%m-%d-%Y'))
+        lines.append('START , symbol "%s" ;' % clock(start))
+        lines.append('TEST , symbol "%s" ;' % clock(start + 40))
+        for (number, song) in enumerate(songs, 1):
+            lines.append('"song%d" , symbol "%s" ;' % (number, clock(start + 70 + 150 * (number - 1))))
+        lines.append('END , symbol "%s" ;' % clock(start + 70 + 150 * len(songs)))
+    else:
+        lines.append('SONGS, %s;' % media)
+        lines.append('DATE, %s;' % date.strftime('%m-%d-%Y'))
+        lines.append('START, %s;' % clock(start))
+        lines.append('TEST, %s;' % clock(start + 40))
+        lines.append('END, %s;' % clock(start + 70 + 150 * len(songs)))
+        for (number, song) in enumerate(songs, 1):
+            lines.append('%s, %s;' % (song, clock(start + 70 + 150 * (number - 1))))
+
+    return lines
+
+def debug_lines(start, songs):
+    """
+    Returns the lines of a debug file, giving the start, end and length of
+    each song played.
+
+    >>> debug_lines(51958, ['H015'])
+    ['Song 1', 'Start 14:27:08', 'End 14:28:38', 'Length 90000.000']
+    """
+    lines = list()
+    for number in range(1, len(songs) + 1):
+        song_start = start + 70 + 150 * (number - 1)
+        lines.append('Song %d' % number)
+        lines.append('Start %s' % clock(song_start))
+        lines.append('End %s' % clock(song_start + 90))
+        lines.append('Length %.3f' % 90000.0)
+    return lines
+
+def write_lines(filepath, lines, mtime):
+    """
+    Writes lines to filepath, one per line, and sets its modification time.
+    """
+    f = open(filepath, 'w')
+    try:
+        for line in lines:
+            f.write(line)
+            f.write('\n')
+    finally:
+        f.close()
+    os.utime(filepath, (mtime, mtime))
+
+def generate(root_dir, sessions, song_lines=20000, seed=0, malformed=0.0):
+    """
+    Writes the files of sessions synthetic sessions below root_dir and
+    returns a list of their paths. Song files have song_lines samples each
+    and the test file an eighth as many; a fraction malformed of signal
+    lines is truncated. The same seed always gives the same corpus.
+
+    >>> import tempfile, shutil
+    >>> from eim_discovery import discover
+    >>> from eim_parser import location_from_path
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = generate(directory, 5, song_lines=16)
+    >>> len(paths)
+    40
+    >>> sorted(set(f.file_type for f in discover(directory)))
+    ['ANSWERS', 'DEBUG', 'INFO', 'RESET', 'SONG', 'TEST']
+    >>> sorted(set(location_from_path(path) for path in paths))
+    ['bergen', 'dublin', 'manila', 'nyc', 'singapore']
+    >>> shutil.rmtree(directory)
+    """
+    rng = random.Random(seed)
+    paths = list()
+
+    for index in range(sessions):
+        location = locations[index % len(locations)]
+        round_number = index // len(locations)
+        session_number = round_number + 1
+
+        if location == 'DUBLIN':
+            version = round_number % 4 + 1
+            date = dublin_dates[version]
+            terminal = rng.randint(1, 4)
+        else:
+            version = 5
+            date = location_dates[location] + datetime.timedelta(days=round_number // 20)
+            terminal = rng.randint(0, 4)
+
+        start = rng.randint(9 * 3600, 18 * 3600)
+        mtime = datetime.datetime.combine(date, datetime.time()).timestamp() + start + 1200
+        songs = rng.sample(song_labels, 3)
+
+        directory = session_directory(root_dir, location, terminal, date)
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, 'T%d_S%04d' % (terminal, session_number))
+
+        files = {
+            'RESET':['Slide %d Black1.maxpat' % rng.randint(1, 20)],
+            '1nfo':info_lines(date, start, songs, version),
+            'TEST':signal_lines(song_lines // 8, version, rng, malformed),
+            'debug':debug_lines(start, songs)
+        }
+
+        answers = answer_lines(version, songs, rng)
+        if version < 5:
+            preamble = ['Slide %d Questionnaire.maxpat' % n for n in range(1, 31)]
+            answers = preamble + answers
+        files['answers'] = answers
+
+        for song in songs:
+            files[song] = signal_lines(song_lines, version, rng, malformed)
+
+        for (suffix, lines) in files.items():
+            filepath = '%s_%s.txt' % (prefix, suffix)
+            write_lines(filepath, lines, mtime)
+            paths.append(filepath)
+
+    return paths
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
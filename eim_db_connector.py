@@ -1,5 +1,7 @@
-from pymongo import MongoClient
-# from eim_parser import EIMParserLogger
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from concurrent.futures import ThreadPoolExecutor
+import logging, itertools
 
 def recursive_update(old_dict, new_dict):
     """
@@ -18,14 +20,62 @@ def recursive_update(old_dict, new_dict):
         else:
             old_dict[k] = new_dict[k]
 
+def merge_expression(value, path):
+    """
+    Returns an aggregation expression for the field at path after value is
+    merged into it as recursive_update would: a dict is merged key by key
+    into a stored embedded document, and replaces the field whole when the
+    stored value is missing, null or not a document; other values, lists
+    included, replace the field.
+
+    >>> merge_expression([2,0,1], 'songs.timestamps')
+    {'$literal': [2, 0, 1]}
+    >>> merge_expression({}, 'rookie') == {'$cond':[{'$eq':[{'$type':'$rookie'}, 'object']},
+    ...     {'$mergeObjects':['$rookie', {}]}, {'$literal':{}}]}
+    True
+    >>> e = merge_expression({'order':['zero']}, 'songs')
+    >>> e['$cond'][1]
+    {'$mergeObjects': ['$songs', {'order': {'$literal': ['zero']}}]}
+    >>> e['$cond'][2]
+    {'$literal': {'order': ['zero']}}
+    """
+    if not isinstance(value, dict):
+        return {'$literal':value}
+
+    fields = dict((k, merge_expression(v, '%s.%s' % (path, k))) for (k, v) in value.items())
+    return {'$cond':[{'$eq':[{'$type':'$' + path}, 'object']},
+            {'$mergeObjects':['$' + path, fields]},
+            {'$literal':value}]}
+
+def session_update(session_id, document):
+    """
+    Returns the update that merges document into the stored document of a
+    session, as recursive_update would. It is an update pipeline, so the
+    merge runs on the server, in the same round trip as the upsert, and only
+    the fields of document are sent. Update pipelines need MongoDB 4.2.
+
+    >>> session_update(7, {'session_id':7, 'id':43})
+    [{'$set': {'session_id': {'$literal': 7}, 'id': {'$literal': 43}}}]
+    """
+    fields = {'session_id':{'$literal':session_id}}
+    for (k, v) in document.items():
+        if k != 'session_id':
+            fields[k] = merge_expression(v, k)
+    return [{'$set':fields}]
+
 class EIMDBConnector():
     def __init__(self, logger=None):
         self._client = None
-        self.logger = logger
+        self._address = None
+        self.logger = logger or logging.getLogger('eim_db_connector')
 
-    def connect(self, hostname='muse.cc.vt.edu', port=27017):
+    def connect(self, hostname='muse.cc.vt.edu', port=27017, **client_options):
         """
-        Connects to the EiM database.
+        Connects to the EiM database. Any client_options, such as maxPoolSize,
+        username, password and authSource, are passed to MongoClient. The
+        client keeps a pool of connections that is shared by every request
+        made through this connector, including those from bulk_insert's
+        threads.
 
         >>> c = EIMDBConnector()
         >>> c.connect()
@@ -37,17 +87,23 @@ class EIMDBConnector():
             ...
         pymongo.errors.ConnectionFailure:
         """
+        self._address = (hostname, port, client_options)
         try:
-            self._client = MongoClient(hostname, port)
+            self._client = MongoClient(hostname, port, **client_options)
         except:
-            self.logger.log('Could not connect to database on %s:%d' % (hostname, port), 'FAILURE')
+            self.logger.error('Could not connect to database on %s:%d' % (hostname, port))
             raise
 
     def disconnect(self):
         """
-        Disconnects from the EiM database.
+        Disconnects from the EiM database, closing every connection in the
+        client's pool.
+
+        >>> c = EIMDBConnector()
+        >>> c.connect('localhost', connect=False)
+        >>> c.disconnect()
         """
-        self._client.disconnect()
+        self._client.close()
 
     def find_by_session_id(self, session_id, database='eim', collection='sessions'):
         """
@@ -75,18 +131,19 @@ class EIMDBConnector():
         >>> c.authenticate_to_database('eim', 'eim', 'emotoheaven')
         >>> res = c.upsert_by_session_id(123456789, {'session_id':123456789})
         >>> res = c.remove_by_session_id(123456789)
-        >>> res['n']
+        >>> res.deleted_count
         1
-        >>> res['err'] == None
-        True
         >>> c.find_by_session_id(123456789)
         """
         db = self._client[database]
-        return db["%s" %collection].remove({'session_id':session_id})
+        return db["%s" % collection].delete_one({'session_id':session_id})
 
     def upsert_by_session_id(self, session_id, document, database='eim', collection='sessions'):
         """
-        Updates or inserts a document into a collection by session ID.
+        Updates or inserts a document into a collection by session ID. The
+        document is merged into the stored one on the server by the update
+        pipeline from session_update, so only its fields are sent and the
+        update is one atomic round trip.
 
         >>> c = EIMDBConnector()
         >>> c.connect()
@@ -100,51 +157,164 @@ class EIMDBConnector():
             ...
         KeyError: 'updated_key'
 
-        >>> res = c.upsert_by_session_id(123456789, {'updated_key':n})
-        >>> res['err'] == None
-        True
-        >>> res['n']
+        >>> res = c.upsert_by_session_id(123456789, {'updated_key':n, 'nested':{'a':1}})
+        >>> res.matched_count
         1
         >>> c.find_by_session_id(123456789)['updated_key'] == n
         True
 
-        >>> res = c.upsert_by_session_id(123456789, {'updated_key':n+1})
-        >>> res['err'] == None
-        True
-        >>> res['n']
+        >>> res = c.upsert_by_session_id(123456789, {'updated_key':n+1, 'nested':{'b':2}})
+        >>> res.matched_count
         1
         >>> c.find_by_session_id(123456789)['updated_key'] == n + 1
         True
+        >>> c.find_by_session_id(123456789)['nested'] == {'a':1, 'b':2}
+        True
 
         >>> res = c.remove_by_session_id(123456789)
         """
         db = self._client[database]
-        existing_document = self.find_by_session_id(session_id, database, collection)
+        try:
+            return db["%s" % collection].update_one({'session_id':session_id}, session_update(session_id, document), upsert=True)
+        except:
+            self.logger.warning('Could find or update document with session ID: %s' % session_id)
+
+    def upsert_many_by_session_id(self, pairs, database='eim', collection='sessions', batch_size=100):
+        """
+        Updates or inserts documents into a collection by session ID, as
+        upsert_by_session_id does, from any iterable of (session_id,
+        document) pairs. The upserts are sent in unordered bulk writes of
+        batch_size. Returns the number of documents inserted or modified.
+
+        >>> c = EIMDBConnector()
+        >>> c.connect('localhost')
+        >>> c.upsert_many_by_session_id(((n, {'answers':{'sex':'male'}}) for n in range(5)), 'eim_test', 'upserts')
+        5
+        >>> c.upsert_many_by_session_id([(0, {'answers':{'age':30}}), (0, {'metadata':{'terminal':2}})], 'eim_test', 'upserts')
+        2
+        >>> sorted(c.find_by_session_id(0, 'eim_test', 'upserts')['answers'].items())
+        [('age', 30), ('sex', 'male')]
 
-        if not existing_document:
-            existing_document = {}
+        Dicts replace stored values that are not documents, and empty dicts
+        create missing documents but leave stored ones alone, as with
+        recursive_update:
 
-        recursive_update(existing_document, document)
+        >>> c.upsert_many_by_session_id([(1, {'answers':None, 'metadata':5})], 'eim_test', 'upserts')
+        1
+        >>> c.upsert_many_by_session_id([(1, {'answers':{'sex':'female'}, 'metadata':{'terminal':1}, 'media':{}})], 'eim_test', 'upserts')
+        1
+        >>> d = c.find_by_session_id(1, 'eim_test', 'upserts')
+        >>> (d['answers'], d['metadata'], d['media'])
+        ({'sex': 'female'}, {'terminal': 1}, {})
+        >>> c.upsert_many_by_session_id([(0, {'answers':{}})], 'eim_test', 'upserts')
+        0
+        >>> sorted(c.find_by_session_id(0, 'eim_test', 'upserts')['answers'].items())
+        [('age', 30), ('sex', 'male')]
+        >>> c._client.drop_database('eim_test')
+        """
+        requests = (UpdateOne({'session_id':session_id}, session_update(session_id, document), upsert=True)
+                for (session_id, document) in pairs)
+        return self.bulk_write(requests, database, collection, batch_size)
 
+    def insert_document(self, document, database='eim', collection='sessions'):
+        """
+        Inserts a document into a collection.
+        """
+        db = self._client[database]
         try:
-            find_result = db["%s" % collection].update({'session_id':session_id}, existing_document, upsert=True)
-            return find_result
+            return db["%s" % collection].insert_one(document)
         except:
-            self.logger.log('Could find or update document with session ID: %s' % session_id, 'WARN')
+            self.logger.warning('Could not insert document into %s.%s' % (database, collection))
+            raise
+
+    def bulk_insert(self, documents, database='eim', collection='sessions', batch_size=100, workers=1):
+        """
+        Inserts documents, from any iterable, into a collection in batches of
+        batch_size, each sent as one unordered insert_many so that a bad
+        document does not stop the rest of its batch. With more than one
+        worker, batches are sent from a pool of threads sharing this
+        connector's client, with at most two batches per worker held in
+        memory. Returns the number of documents inserted; documents that
+        could not be inserted are logged.
+
+        >>> c = EIMDBConnector()
+        >>> c.connect('localhost')
+        >>> c.bulk_insert(({'session_id':n} for n in range(250)), 'eim_test', 'bulk_insert', batch_size=100, workers=2)
+        250
+        >>> c._client['eim_test']['bulk_insert'].count_documents({})
+        250
+        >>> c._client.drop_database('eim_test')
+        """
+        def insert(batch):
+            try:
+                return len(self._client[database][collection].insert_many(batch, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                self.logger.warning('Could not insert %d of %d documents into %s.%s: %s' % (
+                        len(errors), len(batch), database, collection,
+                        errors[0]['errmsg'] if errors else e))
+                return e.details.get('nInserted', 0)
+
+        documents = iter(documents)
+        batches = iter(lambda: list(itertools.islice(documents, batch_size)), [])
+
+        if workers <= 1:
+            return sum(insert(batch) for batch in batches)
+
+        inserted = 0
+        with ThreadPoolExecutor(workers) as executor:
+            pending = list()
+            for batch in batches:
+                pending.append(executor.submit(insert, batch))
+                if len(pending) >= 2 * workers:
+                    inserted += pending.pop(0).result()
+            for future in pending:
+                inserted += future.result()
+
+        return inserted
+
+    def bulk_write(self, requests, database='eim', collection='sessions', batch_size=100):
+        """
+        Sends write requests, such as InsertOne or UpdateOne, from any
+        iterable to a collection in unordered batches of batch_size. Returns
+        the number of documents inserted, upserted or modified; failed
+        requests are logged.
+        """
+        requests = iter(requests)
+        written = 0
+
+        for batch in iter(lambda: list(itertools.islice(requests, batch_size)), []):
+            try:
+                result = self._client[database][collection].bulk_write(batch, ordered=False)
+                written += result.inserted_count + result.upserted_count + result.modified_count
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                self.logger.warning('Could not write %d of %d requests to %s.%s: %s' % (
+                        len(errors), len(batch), database, collection,
+                        errors[0]['errmsg'] if errors else e))
+                written += e.details.get('nInserted', 0) + e.details.get('nUpserted', 0) + e.details.get('nModified', 0)
+
+        return written
 
     def authenticate_to_database(self, database, username, password):
         """
-        Authenticates to database using username and password.
+        Authenticates to database using username and password. Clients
+        authenticate when they connect, so this reconnects to the same server
+        with the credentials; passing them to connect in the first place
+        saves the second connection.
 
         >>> c = EIMDBConnector()
         >>> c.connect()
         >>> c.authenticate_to_database('eim', 'eim', 'emotoheaven')
         """
-        db = self._client[database]
+        (hostname, port, client_options) = self._address
+        client_options = dict(client_options, username=username, password=password, authSource=database)
+        self.disconnect()
+        self.connect(hostname, port, **client_options)
         try:
-            db.authenticate(username, password)
+            self._client[database].command('ping')
         except PyMongoError:
-            self.logger.log('Could not authenticate to database', 'FAILURE')
+            self.logger.error('Could not authenticate to database')
             raise
 
 def __test():
@@ -2,11 +2,11 @@ from eim_parser import EIMParser, EIMParsingError
 import re, datetime, sys, os
 
 class EIMDebugParser(EIMParser):
-    def __init__(self, filepath, logger=None):
+    def __init__(self, filepath, logger=None, job=None):
         """
         Initializes EIMDebugParser.
         """
-        super().__init__(filepath, logger)
+        super().__init__(filepath, logger, job)
         self.debug_data = []
 
     def parse(self):
@@ -0,0 +1,281 @@
+import os, re, collections, queue, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from eim_parser import location_from_path, version_from_mtime
+
+# Matches the name of every session file, source or compiled, capturing the
+# terminal, session number, optional suffix and extension in one pass
+session_file_regex = re.compile('T(\d)_S(\d{4,})(?:_(RESET|1nfo|TEST|answers|debug|email|[HRST]\d{3,}))?\.(txt|json)$')
+
+# File type for each filename suffix. Song files are labelled by their song,
+# and compiled session files have no suffix.
+suffix_types = {
+    'RESET':'RESET',
+    '1nfo':'INFO',
+    'TEST':'TEST',
+    'answers':'ANSWERS',
+    'debug':'DEBUG',
+    'email':'EMAIL',
+    None:'SESSION'
+}
+
+# Number of discovered files handed from a scanning thread to the consumer
+# at a time
+scan_batch_size = 256
+
+EIMFile = collections.namedtuple('EIMFile',
+        ['path', 'file_type', 'extension', 'terminal', 'session_number', 'label'])
+
+def classify(filepath):
+    """
+    Classifies a file by its name. Returns an EIMFile holding its path, type,
+    extension, terminal, session number and label (the filename suffix, such
+    as 'R017' or 'answers'). Files that are not session files have type
+    'UNKNOWN'.
+
+    >>> classify('/data/T3_S0574_R017.txt')
+    EIMFile(path='/data/T3_S0574_R017.txt', file_type='SONG', extension='txt', terminal=3, session_number=574, label='R017')
+    >>> classify('/data/T3_S0574_1nfo.json').file_type
+    'INFO'
+    >>> classify('/data/T3_S0574.json').file_type
+    'SESSION'
+    >>> classify('/data/T3_S0574.txt').file_type
+    'UNKNOWN'
+    >>> classify('/data/notes.md')
+    EIMFile(path='/data/notes.md', file_type='UNKNOWN', extension='md', terminal=None, session_number=None, label=None)
+    """
+    name = os.path.basename(filepath)
+    match = session_file_regex.search(name)
+
+    if not match:
+        return EIMFile(filepath, 'UNKNOWN', os.path.splitext(name)[1][1:], None, None, None)
+
+    (terminal, session, suffix, extension) = match.groups()
+    file_type = suffix_types.get(suffix, 'SONG')
+    if file_type == 'SESSION' and extension != 'json':
+        file_type = 'UNKNOWN'
+
+    return EIMFile(filepath, file_type, extension, int(terminal), int(session), suffix)
+
+class EIMJob():
+    """
+    A parse job: the path of a source file and the metadata derived from its
+    path and modification time, worked out once during discovery. Parsers are
+    only built from a job when a worker runs it, and a job pickles to little
+    more than a tuple, so jobs are cheap to hand to worker processes.
+
+    >>> import pickle
+    >>> job = EIMJob('/data/NYC/T2/T2_S0342_answers.txt', 'ANSWERS', 'nyc', 2, 342, 5, 2048)
+    >>> copy = pickle.loads(pickle.dumps(job))
+    >>> copy
+    EIMJob('/data/NYC/T2/T2_S0342_answers.txt', 'ANSWERS', 'nyc', 2, 342, 5, 2048)
+    >>> copy.size == job.size
+    True
+    """
+    __slots__ = ('path', 'file_type', 'location', 'terminal', 'session_number', 'version', 'size')
+
+    def __init__(self, path, file_type, location, terminal, session_number, version, size):
+        self.path = path
+        self.file_type = file_type
+        self.location = location
+        self.terminal = terminal
+        self.session_number = session_number
+        self.version = version
+        self.size = size
+
+    def __reduce__(self):
+        return (EIMJob, tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        return 'EIMJob(%s)' % ', '.join(repr(getattr(self, name)) for name in self.__slots__)
+
+def make_job(filepath, stat=None):
+    """
+    Builds the EIMJob for a file, reading its size and modification time with
+    os.stat unless a stat result is given. The location is read from the
+    absolute path, so relative paths below a location directory, such as
+    those found by walking '.' inside it, still have one.
+
+    >>> stat = os.stat_result((0,) * 6 + (512, 0, 1328054400, 0))
+    >>> make_job('/data/BERGEN/SERVER/T0_S0822_R017.txt', stat)
+    EIMJob('/data/BERGEN/SERVER/T0_S0822_R017.txt', 'SONG', 'bergen', 0, 822, 5, 512)
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(root, 'NYC'))
+    >>> cwd = os.getcwd()
+    >>> os.chdir(os.path.join(root, 'NYC'))
+    >>> make_job('./T2_S0342_answers.txt', stat)
+    EIMJob('./T2_S0342_answers.txt', 'ANSWERS', 'nyc', 2, 342, 5, 512)
+    >>> os.chdir(cwd)
+    >>> shutil.rmtree(root)
+    """
+    f = classify(filepath)
+
+    if stat is None:
+        stat = os.stat(filepath)
+
+    return EIMJob(filepath, f.file_type, location_from_path(os.path.abspath(filepath)), f.terminal,
+            f.session_number, version_from_mtime(stat.st_mtime), stat.st_size)
+
+def discover(root_dir):
+    """
+    Walks the tree below root_dir with os.scandir and lazily yields an
+    EIMFile for every file as soon as its directory is read, so callers can
+    start work before the walk finishes. Like os.walk, symbolic links to
+    directories are not followed and unreadable directories are skipped.
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(root, 'NYC', 'T2'))
+    >>> for name in ['T2_S0342_answers.txt', 'T2_S0342_H001.txt', 'notes.md']:
+    ...     open(os.path.join(root, 'NYC', 'T2', name), 'w').close()
+    >>> sorted((f.file_type, f.label) for f in discover(root))
+    [('ANSWERS', 'answers'), ('SONG', 'H001'), ('UNKNOWN', None)]
+    >>> shutil.rmtree(root)
+    """
+    pending = [root_dir]
+
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                else:
+                    yield classify(entry.path)
+
+def discover_roots(root_dirs, threads=8, stats=None):
+    """
+    Discovers files below several root directories at once. The top level of
+    each root is listed first and every top-level subdirectory is then walked
+    by discover on a pool of threads, so that deep location dumps are scanned
+    side by side. EIMFiles are yielded as the threads find them, in no
+    particular order.
+
+    If stats is given, it is filled in with a dictionary per root holding the
+    number of 'files' found and the 'seconds' taken to scan it, from the
+    start of its listing until the last of its threads finished walking. Time
+    the caller spends on the yielded files is not counted.
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> for location in ['NYC', 'BERGEN']:
+    ...     for terminal in ['T1', 'T2']:
+    ...         os.makedirs(os.path.join(root, location, terminal))
+    ...         open(os.path.join(root, location, terminal, terminal + '_S0342_answers.txt'), 'w').close()
+    >>> open(os.path.join(root, 'NYC', 'notes.md'), 'w').close()
+    >>> roots = [os.path.join(root, 'NYC'), os.path.join(root, 'BERGEN')]
+    >>> stats = dict()
+    >>> sorted(os.path.relpath(f.path, root) for f in discover_roots(roots, threads=2, stats=stats))
+    ['BERGEN/T1/T1_S0342_answers.txt', 'BERGEN/T2/T2_S0342_answers.txt', 'NYC/T1/T1_S0342_answers.txt', 'NYC/T2/T2_S0342_answers.txt', 'NYC/notes.md']
+    >>> [stats[r]['files'] for r in roots]
+    [3, 2]
+    >>> all(0 < stats[r]['seconds'] < 1 for r in roots)
+    True
+    >>> shutil.rmtree(root)
+    """
+    if stats is None:
+        stats = dict()
+
+    results = queue.Queue()
+    pending = dict()
+    started = dict()
+    finished = dict()
+    finished_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max(1, threads))
+
+    def scanned(root_dir):
+        # Note the time a scan of root_dir finished, keeping the latest
+        with finished_lock:
+            finished[root_dir] = max(finished.get(root_dir, 0.0), time.perf_counter())
+
+    def scan(root_dir, directory):
+        # Walk one top-level subdirectory, passing batches of files back to
+        # the consumer, then signal completion with None
+        try:
+            batch = list()
+            for f in discover(directory):
+                batch.append(f)
+                if len(batch) == scan_batch_size:
+                    results.put((root_dir, batch))
+                    batch = list()
+            if batch:
+                results.put((root_dir, batch))
+        except Exception as e:
+            results.put((root_dir, e))
+        scanned(root_dir)
+        results.put((root_dir, None))
+
+    def finish(root_dir):
+        with finished_lock:
+            stats[root_dir]['seconds'] = finished[root_dir] - started[root_dir]
+
+    try:
+        # List the top level of each root, yielding its files and handing its
+        # subdirectories to the pool
+        for root_dir in root_dirs:
+            started[root_dir] = time.perf_counter()
+            stats[root_dir] = {'files':0, 'seconds':0.0}
+            pending[root_dir] = 0
+            top_files = list()
+
+            try:
+                with os.scandir(root_dir) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            if not entry.is_symlink():
+                                pending[root_dir] += 1
+                                executor.submit(scan, root_dir, entry.path)
+                        else:
+                            top_files.append(classify(entry.path))
+            except OSError:
+                pass
+            scanned(root_dir)
+
+            stats[root_dir]['files'] += len(top_files)
+            for f in top_files:
+                yield f
+
+            if not pending[root_dir]:
+                finish(root_dir)
+
+        # Stream files from the pool until every subdirectory is done
+        while sum(pending.values()):
+            (root_dir, batch) = results.get()
+
+            if batch is None:
+                pending[root_dir] -= 1
+                if not pending[root_dir]:
+                    finish(root_dir)
+            elif isinstance(batch, Exception):
+                raise batch
+            else:
+                stats[root_dir]['files'] += len(batch)
+                for f in batch:
+                    yield f
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
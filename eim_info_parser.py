@@ -3,11 +3,11 @@ import re, datetime, sys
 
 class EIMInfoParser(EIMParser):
 
-    def __init__(self, filepath, logger=None):
+    def __init__(self, filepath, logger=None, job=None):
         """
         Initializes EIMInfoParser.
         """
-        super().__init__(filepath, logger)
+        super().__init__(filepath, logger, job)
         self._date = None
         self._timestamps = {}
         self._song_timestamps = []
@@ -83,6 +83,12 @@ class EIMInfoParser(EIMParser):
         return_dict['date'] = self._date.isoformat()
         return return_dict
 
+    def finalize(self):
+        """
+        Puts the song timestamps collected from every line in order.
+        """
+        self._song_timestamps.sort()
+
     def parse_line(self, line, number):
         """
         Parses a line of text from an info file.
@@ -114,6 +120,7 @@ class EIMInfoParser(EIMParser):
         >>> p.parse_line('"song2" , symbol "13:01:04" ;', 9)
         >>> p.parse_line('"song1" , symbol "12:58:37" ;', 10)
         >>> p.parse_line('"song3" , symbol "13:03:19" ;', 11)
+        >>> p.finalize()
         >>> p._song_timestamps
         ['2012-12-20T12:58:37', '2012-12-20T13:01:04', '2012-12-20T13:03:19']
 
@@ -260,6 +267,7 @@ class EIMInfoParser(EIMParser):
         >>> p.parse_song_timestamp_line('"song2" , symbol "13:01:04" ;')
         >>> p.parse_song_timestamp_line('"song1" , symbol "12:58:37" ;')
         >>> p.parse_song_timestamp_line('"song3" , symbol "13:03:19" ;')
+        >>> p.finalize()
         >>> p._song_timestamps
         ['2013-08-14T12:58:37', '2013-08-14T13:01:04', '2013-08-14T13:03:19']
 
@@ -317,7 +325,6 @@ class EIMInfoParser(EIMParser):
                 int(s)
                 )
         self._song_timestamps.append(timestamp.isoformat())
-        self._song_timestamps.sort()
 
     def parse_date_line(self, line):
         """
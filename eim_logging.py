@@ -0,0 +1,68 @@
+import logging, logging.handlers, multiprocessing
+
+log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def start_logging(name, filepath, console_level=logging.DEBUG):
+    """
+    Sets up the named logger of a command-line tool to log DEBUG and higher
+    to filepath, and console_level and higher to the terminal. Records are
+    put on a queue and written by a listener thread, so logging never waits
+    on the file or the terminal. Returns the started QueueListener; pass its
+    queue to worker processes with worker_logging, and stop it with
+    stop_logging before exiting so that every record is written.
+
+    >>> import tempfile, os, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> listener = start_logging('eim_logging_test', os.path.join(directory, 'test.log'), logging.CRITICAL)
+    >>> logging.getLogger('eim_logging_test').info('Parsed 3 files')
+    >>> stop_logging(listener)
+    >>> open(os.path.join(directory, 'test.log')).read().strip().endswith('eim_logging_test - INFO - Parsed 3 files')
+    True
+    >>> shutil.rmtree(directory)
+    """
+    formatter = logging.Formatter(log_format)
+
+    fh = logging.FileHandler(filepath)
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+    ch = logging.StreamHandler()
+    ch.setLevel(console_level)
+    ch.setFormatter(formatter)
+
+    queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(queue, fh, ch, respect_handler_level=True)
+    listener.start()
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(queue))
+
+    return listener
+
+def worker_logging(queue, name):
+    """
+    Sends the records of the named logger in a worker process to the queue
+    of the parent's listener. Meant as a multiprocessing.Pool initializer.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(queue))
+
+def stop_logging(listener):
+    """
+    Writes every queued record and stops the listener and its handlers.
+    """
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
@@ -0,0 +1,181 @@
+import json, os, time, math
+
+# Per-file latency percentiles reported for each file type
+latency_quantiles = [0.5, 0.95]
+
+def percentile(values, quantile):
+    """
+    Returns the nearest-rank percentile of a list of numbers, or None if it
+    is empty.
+
+    >>> percentile([4, 1, 3, 2], 0.5), percentile([4, 1, 3, 2], 0.95), percentile([], 0.5)
+    (2, 4, None)
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(math.ceil(quantile * len(ordered))), 1)
+    return ordered[rank - 1]
+
+class EIMMetrics():
+
+    def __init__(self):
+        """
+        Collects throughput and error counts per file type over a run: files
+        parsed and skipped, bytes read, signal samples, malformed lines,
+        exceptions and the time taken by each file.
+
+        >>> m = EIMMetrics()
+        >>> m.record('SONG', size=2048, samples=20, malformed=1, seconds=0.5)
+        >>> m.record('SONG', size=1024, samples=10, seconds=0.25, error=True)
+        >>> m.record('INFO', skipped=True)
+        >>> song = m.to_dict(seconds=2.0)['types']['SONG']
+        >>> (song['files'], song['bytes'], song['samples'], song['malformed_lines'], song['exceptions'])
+        (2, 3072, 30, 1, 1)
+        >>> (song['latency']['p50'], song['latency']['max'])
+        (0.25, 0.5)
+        >>> m.to_dict(seconds=2.0)['total']['files_per_second']
+        1.0
+        """
+        self._types = dict()
+
+    def _entry(self, file_type):
+        if file_type not in self._types:
+            self._types[file_type] = {'files':0, 'skipped':0, 'bytes':0, 'samples':0,
+                    'malformed_lines':0, 'exceptions':0, 'latencies':list()}
+        return self._types[file_type]
+
+    def record(self, file_type, size=0, samples=0, malformed=0, seconds=None, error=False, skipped=False):
+        """
+        Records one file of file_type: its size in bytes, the samples parsed
+        from it, its malformed lines, the seconds it took to parse and write,
+        whether parsing it raised an exception, and whether it was skipped
+        without parsing.
+        """
+        entry = self._entry(file_type)
+
+        if skipped:
+            entry['skipped'] += 1
+            return
+
+        entry['files'] += 1
+        entry['bytes'] += size
+        entry['samples'] += samples
+        entry['malformed_lines'] += malformed
+        if error:
+            entry['exceptions'] += 1
+        if seconds is not None:
+            entry['latencies'].append(seconds)
+
+    def to_dict(self, seconds=None):
+        """
+        Returns the metrics as a dictionary with an entry per file type under
+        'types' and their sum under 'total'. Latency percentiles are per file.
+        Throughput per type is its bytes and files over the time spent parsing
+        them; total throughput is over seconds, the wall time of the run, when
+        given.
+        """
+        types = dict()
+        total = {'files':0, 'skipped':0, 'bytes':0, 'samples':0, 'malformed_lines':0, 'exceptions':0}
+
+        for (file_type, entry) in sorted(self._types.items()):
+            metrics = dict((field, entry[field]) for field in total)
+            latencies = entry['latencies']
+            busy = sum(latencies)
+
+            metrics['latency'] = dict(('p%d' % round(q * 100), percentile(latencies, q)) for q in latency_quantiles)
+            metrics['latency']['max'] = max(latencies) if latencies else None
+            metrics['seconds'] = busy
+            metrics['files_per_second'] = entry['files'] / busy if busy else None
+            metrics['bytes_per_second'] = entry['bytes'] / busy if busy else None
+            types[file_type] = metrics
+
+            for field in total:
+                total[field] += entry[field]
+
+        total['seconds'] = seconds
+        total['files_per_second'] = total['files'] / seconds if seconds else None
+        total['bytes_per_second'] = total['bytes'] / seconds if seconds else None
+
+        return {'types':types, 'total':total}
+
+    def write_json(self, filepath, seconds=None, **extra):
+        """
+        Writes the metrics, and any extra fields given, to a JSON file.
+        """
+        report = self.to_dict(seconds)
+        report.update(extra)
+        with open(filepath, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    def write_prometheus(self, filepath, seconds=None, prefix='eim_parser'):
+        """
+        Writes the metrics to filepath in the Prometheus text exposition
+        format, for the node exporter's textfile collector. The file is written
+        under a temporary name and renamed, so the collector never reads a
+        partial file.
+
+        >>> m = EIMMetrics()
+        >>> m.record('RESET', size=30, seconds=0.001)
+        >>> m.write_prometheus('./.eim_metrics.prom', seconds=0.5)
+        >>> lines = open('./.eim_metrics.prom').read().splitlines()
+        >>> [line for line in lines if line.startswith('eim_parser_files_total')]
+        ['eim_parser_files_total{type="RESET"} 1']
+        >>> 'eim_parser_file_seconds{type="RESET",quantile="0.95"} 0.001' in lines
+        True
+        >>> os.unlink('./.eim_metrics.prom')
+        """
+        report = self.to_dict(seconds)
+        counters = [
+            ('files_total', 'files', 'Files parsed.'),
+            ('skipped_files_total', 'skipped', 'Files skipped because their output was current.'),
+            ('bytes_total', 'bytes', 'Bytes of source files parsed.'),
+            ('samples_total', 'samples', 'Signal samples parsed.'),
+            ('malformed_lines_total', 'malformed_lines', 'Lines that could not be parsed.'),
+            ('exceptions_total', 'exceptions', 'Files whose parsing raised an exception.')
+        ]
+
+        lines = list()
+        for (name, field, description) in counters:
+            lines.append('# HELP %s_%s %s' % (prefix, name, description))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for (file_type, metrics) in report['types'].items():
+                lines.append('%s_%s{type="%s"} %s' % (prefix, name, file_type, metrics[field]))
+
+        lines.append('# HELP %s_file_seconds Time taken to parse and write each file.' % prefix)
+        lines.append('# TYPE %s_file_seconds summary' % prefix)
+        for (file_type, metrics) in report['types'].items():
+            entry = self._types[file_type]
+            for q in latency_quantiles:
+                value = metrics['latency']['p%d' % round(q * 100)]
+                if value is not None:
+                    lines.append('%s_file_seconds{type="%s",quantile="%s"} %s' % (prefix, file_type, q, value))
+            lines.append('%s_file_seconds_sum{type="%s"} %s' % (prefix, file_type, metrics['seconds']))
+            lines.append('%s_file_seconds_count{type="%s"} %d' % (prefix, file_type, len(entry['latencies'])))
+
+        lines.append('# HELP %s_bytes_per_second Bytes parsed per second of the run.' % prefix)
+        lines.append('# TYPE %s_bytes_per_second gauge' % prefix)
+        if report['total']['bytes_per_second'] is not None:
+            lines.append('%s_bytes_per_second %s' % (prefix, report['total']['bytes_per_second']))
+
+        lines.append('# HELP %s_run_seconds Wall time of the run.' % prefix)
+        lines.append('# TYPE %s_run_seconds gauge' % prefix)
+        if seconds is not None:
+            lines.append('%s_run_seconds %s' % (prefix, seconds))
+
+        lines.append('# HELP %s_last_run_timestamp_seconds Time the run finished.' % prefix)
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % prefix)
+        lines.append('%s_last_run_timestamp_seconds %d' % (prefix, time.time()))
+
+        temporary = filepath + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines))
+            f.write('\n')
+        os.replace(temporary, filepath)
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
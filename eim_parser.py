@@ -1,7 +1,12 @@
-import re, datetime, sys, logging, os, json
+import re, datetime, sys, logging, os, json, locale, contextlib
+import eim_serializer
 
 experiment_locations = ['DUBLIN', 'NYC', 'BERGEN', 'SINGAPORE', 'MANILA']
 
+# Number of lines held while looking for a DATE line near the top of a file.
+# Files whose DATE line comes later are read twice instead.
+date_lookahead = 64
+
 def timestamp_to_millis(timestamp_string):
     """
     Converts a timestamp string of the format '02:14.667' to an integer
@@ -15,14 +20,143 @@ def timestamp_to_millis(timestamp_string):
     seconds = int(match.groups()[1]) * 1000
     return int(match.groups()[2]) + minutes + seconds
 
+def location_from_path(filepath):
+    """
+    Returns the lower-case experiment location named in filepath, or None.
+
+    >>> location_from_path('/data/BERGEN/SERVER/2012-02-01/T0_S0822_answers.txt')
+    'bergen'
+    >>> location_from_path('/data/T0_S0822_answers.txt')
+    """
+    for location in experiment_locations:
+        if location in filepath:
+            return location.lower()
+    return None
+
+def version_from_mtime(mtime):
+    """
+    Returns the file version, from among the four Dublin versions and the one
+    version used everywhere else, for a file modification time in seconds
+    since the epoch, or None if the time falls between versions.
+
+    >>> version_from_mtime(datetime.datetime(2010,7,6,12).timestamp())
+    1
+    >>> version_from_mtime(datetime.datetime(2012,2,2).timestamp())
+    5
+    >>> version_from_mtime(datetime.datetime(2010,7,22,12).timestamp())
+    """
+    dublin_a = (datetime.datetime(2010,7,1),datetime.datetime(2010,7,21,23,59))
+    dublin_b = (datetime.datetime(2010,7,23),datetime.datetime(2010,8,29,23,59))
+    dublin_c = (datetime.datetime(2010,8,31),datetime.datetime(2010,9,19,23,59))
+    dublin_d = (datetime.datetime(2010,9,21),datetime.datetime(2010,10,1,23,59))
+
+    filetime = datetime.datetime.fromtimestamp(mtime)
+
+    if filetime >= dublin_a[0] and filetime <= dublin_a[1]:
+        return 1
+    elif filetime >= dublin_b[0] and filetime <= dublin_b[1]:
+        return 2
+    elif filetime >= dublin_c[0] and filetime <= dublin_c[1]:
+        return 3
+    elif filetime >= dublin_d[0] and filetime <= dublin_d[1]:
+        return 4
+    elif filetime >= dublin_d[1]:
+        return 5
+
+    return None
+
+def date_first(numbered_lines):
+    """
+    Returns a list of (line number, line) pairs with the first DATE line, if
+    there is one, placed before all of the lines.
+
+    >>> date_first([(1, 'Slide 1'), (2, 'DATE 2012 2 2'), (3, 'Slide 2')])
+    [(2, 'DATE 2012 2 2'), (1, 'Slide 1'), (2, 'DATE 2012 2 2'), (3, 'Slide 2')]
+    >>> date_first([(1, 'Slide 1')])
+    [(1, 'Slide 1')]
+    """
+    numbered_lines = list(numbered_lines)
+    for (number, line) in numbered_lines:
+        if 'DATE' in line:
+            return [(number, line)] + numbered_lines
+    return numbered_lines
+
+def tail_lines(filepath, count, block_size=8192):
+    """
+    Returns the last count lines of a text file, reading it backwards from
+    the end in blocks so that a long prefix is never read. Lines are decoded
+    and their endings translated as they would be by open(filepath, 'r').
+
+    >>> f = open('./.MANILA_T4_S9898_answers.txt', 'wb')
+    >>> written = f.write(b'prefix\\n' * 5000 + b'"01a_Sex , symbol Female ;\\r\\n"01b_DOB" , 1983 ;')
+    >>> f.close()
+    >>> tail_lines('./.MANILA_T4_S9898_answers.txt', 3, block_size=16)
+    ['prefix\\n', '"01a_Sex , symbol Female ;\\n', '"01b_DOB" , 1983 ;']
+    >>> len(tail_lines('./.MANILA_T4_S9898_answers.txt', 84))
+    84
+    >>> len(tail_lines('./.MANILA_T4_S9898_answers.txt', 6000))
+    5002
+    >>> tail_lines('./.MANILA_T4_S9898_answers.txt', 0)
+    []
+    >>> os.unlink('./.MANILA_T4_S9898_answers.txt')
+    """
+    if count <= 0:
+        return []
+
+    try:
+        f = open(filepath, 'rb')
+    except:
+        raise EIMParsingError('Could not open file %s' % filepath)
+
+    try:
+        # Read blocks backwards until they hold enough line breaks, counting
+        # \n and \r separately so that \r\n is not counted twice
+        position = f.seek(0, os.SEEK_END)
+        blocks = list()
+        newlines = 0
+        returns = 0
+
+        while position > 0 and max(newlines, returns) <= count:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            block = f.read(size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+            returns += block.count(b'\r')
+
+    finally:
+        f.close()
+
+    data = b''.join(reversed(blocks))
+
+    # Unless the start of the file was reached, drop the partial first line
+    if position > 0:
+        breaks = [i for i in (data.find(b'\n'), data.find(b'\r')) if i >= 0]
+        start = min(breaks) + 1
+        if data[start - 1:start + 1] == b'\r\n':
+            start += 1
+        data = data[start:]
+
+    text = data.decode(locale.getpreferredencoding(False))
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+
+    # Put line endings back, leaving a final unterminated line as it is
+    lines = [line + '\n' for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+    return lines[-count:]
+
 class EIMParsingError(Exception):
     pass
 
 class EIMParser():
 
-    def __init__(self, filepath, logger=None):
+    def __init__(self, filepath, logger=None, job=None):
         """
         Initializes an EIMParser with a reference to the appropriate filepath.
+        If an EIMJob from discovery is given, its location, terminal and
+        version are used instead of being worked out again from the path and
+        modification time.
 
         A filepath must be provided.
         >>> p = EIMParser(filepath = None)
@@ -41,9 +175,39 @@ class EIMParser():
         self._filepath = os.path.abspath(filepath)
         self._file = None
         self._experiment_metadata = {'location':None, 'terminal':None, 'session_number':None}
-        self.gather_metadata()
+        self._line_errors = dict()
+        self.malformed_lines = 0
         self.version = None
-        self.determine_file_version()
+        self.file_type = job.file_type if job else None
+        self.profile = None
+
+        if job is None:
+            self.gather_metadata()
+            self.determine_file_version()
+        else:
+            self.use_job(job)
+
+    def use_job(self, job):
+        """
+        Takes the metadata of this document from an EIMJob built during
+        discovery.
+
+        >>> from eim_discovery import EIMJob
+        >>> job = EIMJob('/data/NYC/T2/T2_S0342_answers.txt', 'ANSWERS', 'nyc', 2, 342, 5, 2048)
+        >>> p = EIMParser(job.path, job=job)
+        >>> p._experiment_metadata['location'], p._experiment_metadata['terminal'], p.version
+        ('nyc', 2, 5)
+        """
+        if job.location is None:
+            raise EIMParsingError('Could not determine location for %s' % self._filepath)
+        if job.terminal is None:
+            raise EIMParsingError('Could not determine terminal number for %s' % self._filepath)
+        if job.version is None:
+            raise EIMParsingError('Could not determine answer file version: %s' % self._filepath)
+
+        self._experiment_metadata['location'] = job.location
+        self._experiment_metadata['terminal'] = job.terminal
+        self.version = job.version
 
     def determine_file_version(self):
         """
@@ -75,27 +239,8 @@ class EIMParser():
         >>> p.version
         5
         """
-        dublin_a = (datetime.datetime(2010,7,1),datetime.datetime(2010,7,21,23,59))
-        dublin_b = (datetime.datetime(2010,7,23),datetime.datetime(2010,8,29,23,59))
-        dublin_c = (datetime.datetime(2010,8,31),datetime.datetime(2010,9,19,23,59))
-        dublin_d = (datetime.datetime(2010,9,21),datetime.datetime(2010,10,1,23,59))
-
-        filetime = datetime.datetime.fromtimestamp(os.stat(self._filepath).st_mtime)
-
-        if filetime >= dublin_a[0] and filetime <= dublin_a[1]:
-            self.version = 1
-            return
-        elif filetime >= dublin_b[0] and filetime <= dublin_b[1]:
-            self.version = 2
-            return
-        elif filetime >= dublin_c[0] and filetime <= dublin_c[1]:
-            self.version = 3
-            return
-        elif filetime >= dublin_d[0] and filetime <= dublin_d[1]:
-            self.version = 4
-            return
-        elif filetime >= dublin_d[1]:
-            self.version = 5
+        self.version = version_from_mtime(os.stat(self._filepath).st_mtime)
+        if self.version:
             return
 
         raise EIMParsingError('Could not determine answer file version: %s' % self._filepath)
@@ -126,12 +271,10 @@ class EIMParser():
       >>> p._experiment_metadata['location']
       'singapore'
       """
-      match = None
-      for location in experiment_locations:
-        match = re.search('(%s)' % location, self._filepath)
-        if match:
-          self._experiment_metadata['location'] = match.groups()[0].lower()
-          return
+      location = location_from_path(self._filepath)
+      if location:
+        self._experiment_metadata['location'] = location
+        return
 
       raise EIMParsingError('Could not determine location for %s' % self._filepath)
 
@@ -145,14 +288,10 @@ class EIMParser():
         >>> p._experiment_metadata['terminal']
         2
         """
-        print('gather_terminal')
-        match = None
         match = re.search('.*T(\d)_.*.txt', self._filepath)
         if match:
             self._experiment_metadata['terminal'] = int(match.groups()[0])
             return
-        else:
-            print('no match')
 
         raise EIMParsingError('Could not determine terminal number for %s' % self._filepath)
 
@@ -177,11 +316,21 @@ class EIMParser():
         >>> os.unlink(f.name)
         """
         try:
-            self._file = open(self._filepath, 'r')
+            with self.phase('read'):
+                self._file = open(self._filepath, 'r')
             return True
         except:
             raise EIMParsingError('Could not open %s' % self._filepath)
 
+    def phase(self, name):
+        """
+        Returns a context that times a phase of this parser's work in its
+        EIMProfile, if one has been set on profile, or does nothing.
+        """
+        if self.profile is None:
+            return contextlib.nullcontext()
+        return self.profile.phase(name, self.file_type)
+
     def close_file(self):
         """
         Closes the file at filepath.
@@ -215,30 +364,20 @@ class EIMParser():
         """
         try:
             self.open_file()
-            lines = list(self._file)
-
-            # If a date line is present, parse it first
-            for number, line in enumerate(lines):
-                if re.search('DATE', line):
-                    try:
-                        self.parse_line(line, number + 1)
-                    except:
-                        self.logger.error(e)
-                    break
-
-            # Parse all lines
-            for number, line in enumerate(lines):
+
+            # Parse all lines, with any date line parsed first
+            for (number, line) in self.iter_lines():
                 try:
-                    self.parse_line(line, number + 1)
+                    self.parse_line(line, number)
                 except Exception as e:
-                    self.logger.error(e)
+                    self.count_line_error(e)
+            self.log_line_errors()
+
+            # Build anything derived from all of the lines
+            self.finalize()
 
             # Parse session id
-            match = re.search('T\d_S(\d{4})_.*.txt', self._filepath)
-            if match:
-                self._experiment_metadata['session_number'] = int(match.groups()[0])
-            else:
-                raise EIMParsingError("No valid session id found in filename %s" % self._filepath)
+            self.parse_session_number()
 
         except:
             raise
@@ -247,6 +386,131 @@ class EIMParser():
             if self._file and not self._file.closed:
                 self.close_file()
 
+    def count_line_error(self, error):
+        """
+        Logs the first error of each kind raised while parsing a line, and
+        counts the rest. The kind is the error message up to its first colon,
+        such as 'Unprocessed line'. Every error counts as a malformed line.
+        """
+        self.malformed_lines += 1
+        kind = str(error).split(':')[0]
+        self._line_errors[kind] = self._line_errors.get(kind, 0) + 1
+        if self._line_errors[kind] == 1:
+            self.logger.error(error)
+
+    def log_line_errors(self):
+        """
+        Logs one summary per kind of line error that occurred more than once,
+        then clears the counts.
+
+        >>> import io
+        >>> stream = io.StringIO()
+        >>> logger = logging.getLogger('eim_parser_errors')
+        >>> logger.addHandler(logging.StreamHandler(stream))
+        >>> from eim_discovery import EIMJob
+        >>> job = EIMJob('/data/MANILA/T2_S9898_answers.txt', 'ANSWERS', 'manila', 2, 9898, 5, 0)
+        >>> p = EIMParser(job.path, logger, job)
+        >>> for number in range(3): p.count_line_error(EIMParsingError('Unprocessed line: %s:%d junk' % (p._filepath, number)))
+        >>> p.log_line_errors()
+        >>> print(stream.getvalue().strip())
+        Unprocessed line: /data/MANILA/T2_S9898_answers.txt:0 junk
+        2 more 'Unprocessed line' errors in /data/MANILA/T2_S9898_answers.txt
+        """
+        for (kind, count) in sorted(self._line_errors.items()):
+            if count > 1:
+                self.logger.error("%d more '%s' errors in %s" % (count - 1, kind, self._filepath))
+        self._line_errors = dict()
+
+    def sample_count(self):
+        """
+        Returns the number of signal samples parsed. Files other than test and
+        song files hold no samples.
+        """
+        return 0
+
+    def finalize(self):
+        """
+        Called once by parse after every line has been parsed, so that
+        subclasses can build structures that depend on all of the lines
+        rather than rebuilding them line by line. Does nothing by default.
+        """
+        pass
+
+    def iter_lines(self):
+        """
+        Streams (line number, line) pairs from the open file. If a DATE line
+        is present it is yielded once before all of the lines, so that the
+        date is known when the other lines are parsed. Only the first
+        date_lookahead lines are held while looking for it; if it is further
+        down, the file is scanned for it and then read again from the start.
+
+        >>> f = open('./.MANILA_T4_S9898_test.txt', 'w')
+        >>> written = f.write('Slide 1\\n' * 100 + 'DATE 2012 2 2\\n')
+        >>> f.close()
+        >>> parser = EIMParser(filepath = './.MANILA_T4_S9898_test.txt')
+        >>> parser.open_file()
+        True
+        >>> lines = list(parser.iter_lines())
+        >>> parser.close_file()
+        >>> len(lines), lines[0], lines[-1]
+        (102, (101, 'DATE 2012 2 2\\n'), (101, 'DATE 2012 2 2\\n'))
+
+        >>> import os
+        >>> os.unlink(f.name)
+        """
+        lookahead = list()
+
+        for line in self._file:
+            lookahead.append((len(lookahead) + 1, line))
+
+            # Date line near the top: yield it and the held lines, then
+            # carry on streaming
+            if 'DATE' in line:
+                for pair in date_first(lookahead):
+                    yield pair
+                for pair in enumerate(self._file, len(lookahead) + 1):
+                    yield pair
+                return
+
+            if len(lookahead) == date_lookahead:
+                break
+
+        # The whole file fit in the lookahead and has no date line
+        else:
+            for pair in lookahead:
+                yield pair
+            return
+
+        # Otherwise, scan the rest of the file for a date line, then rewind
+        for (number, line) in enumerate(self._file, date_lookahead + 1):
+            if 'DATE' in line:
+                yield (number, line)
+                break
+
+        self._file.seek(0)
+        for pair in enumerate(self._file, 1):
+            yield pair
+
+    def parse_session_number(self):
+        """
+        Parses the session number from the filename.
+
+        >>> f = open('./.MANILA_T4_S9898_test.txt', 'w')
+        >>> f.close()
+        >>> parser = EIMParser(filepath = './.MANILA_T4_S9898_test.txt')
+        >>> parser.parse_session_number()
+        >>> parser._experiment_metadata['session_number']
+        9898
+
+        >>> import os
+        >>> os.unlink(f.name)
+        """
+        match = re.search('T\d_S(\d{4})_.*.txt', self._filepath)
+        if match:
+            self._experiment_metadata['session_number'] = int(match.groups()[0])
+        else:
+            raise EIMParsingError("No valid session id found in filename %s" % self._filepath)
+
     def parse_line(self, line, number):
         pass
 
@@ -255,9 +519,18 @@ class EIMParser():
         base['metadata'] = self._experiment_metadata
         return base
 
+    def json_document(self):
+        """
+        Returns the document written by to_json_file: the dict representation
+        by default. Subclasses may return NumPy arrays in place of lists, which
+        are then written in chunks.
+        """
+        return self.to_dict()
+
     def to_json_file(self):
         """
-        Saves dict representation as a JSON file.
+        Saves dict representation as a JSON file, streaming it through
+        eim_serializer.dump.
 
         >>> f = open('./.MANILA_T2_S9898_test.txt', 'w')
         >>> f.close()
@@ -278,13 +551,19 @@ class EIMParser():
         """
         current_dir = os.path.dirname(self._filepath)
         file_no_ext = os.path.splitext(os.path.basename(self._filepath))[0]
-        try:
-            f = open(os.path.join(current_dir, '%s.json' % file_no_ext), 'w')
-            json.dump(self.to_dict(), f)
-        except:
-            raise EIMParsingError('Could not write JSON file for %s', self._filepath)
-        finally:
-            f.close()
+        with self.phase('to_dict'):
+            document = self.json_document()
+
+        with self.phase('write'):
+            try:
+                f = open(os.path.join(current_dir, '%s.json' % file_no_ext), 'w')
+            except:
+                raise EIMParsingError('Could not write JSON file for %s' % self._filepath)
+
+            try:
+                eim_serializer.dump(document, f)
+            finally:
+                f.close()
 
 def __test():
     import doctest
@@ -0,0 +1,293 @@
+"""
+Parses the source files of whole sessions and hands the compiled session
+document, and the documents of the session's song files, straight to a sink,
+without writing and re-reading a JSON file per source file in between.
+
+The session document is merged from the info and answers files exactly as
+json_compiler merges their JSON files, and songs are documents as written by
+master_parser, so a file sink leaves the same T?_S????.json and song JSON
+files that json_injector imports, and a database sink inserts the documents
+that json_injector would import.
+"""
+import os, re, json, logging
+from eim_parser import EIMParsingError
+from eim_info_parser import EIMInfoParser
+from eim_answers_parser import EIMAnswersParser
+from eim_test_parser import EIMSongParser
+
+# Parsers of the file types that end up in the database, in the order their
+# files are merged into a session. Reset, test and debug files are not
+# compiled or imported and are skipped.
+session_parsers = [
+    ('INFO', EIMInfoParser),
+    ('ANSWERS', EIMAnswersParser),
+    ('SONG', EIMSongParser)
+]
+
+# Matches the part of a path shared by all files of a session, like
+# '/data/NYC/.../T2_S0342'
+session_prefix_regex = re.compile('(.*T\d_S\d+)')
+
+def session_prefix(filepath):
+    """
+    Returns the part of a path shared by all files of its session, or None.
+
+    >>> session_prefix('/data/NYC/T2_S0342_answers.txt')
+    '/data/NYC/T2_S0342'
+    >>> session_prefix('/data/NYC/notes.txt')
+    """
+    match = session_prefix_regex.search(filepath)
+    if match:
+        return match.groups()[0]
+    return None
+
+def group_sessions(jobs):
+    """
+    Groups EIMJobs by session. Returns a list of (prefix, jobs) pairs in the
+    order their sessions were first seen. Jobs of files outside any session
+    are dropped.
+
+    >>> from eim_discovery import EIMJob
+    >>> jobs = [EIMJob('/d/T1_S0001_1nfo.txt', 'INFO', 'nyc', 1, 1, 5, 10),
+    ...     EIMJob('/d/T2_S0002_1nfo.txt', 'INFO', 'nyc', 2, 2, 5, 10),
+    ...     EIMJob('/d/T1_S0001_H003.txt', 'SONG', 'nyc', 1, 1, 5, 10)]
+    >>> [(prefix, [job.file_type for job in session]) for (prefix, session) in group_sessions(jobs)]
+    [('/d/T1_S0001', ['INFO', 'SONG']), ('/d/T2_S0002', ['INFO'])]
+    """
+    sessions = dict()
+    for job in jobs:
+        prefix = session_prefix(job.path)
+        if prefix:
+            sessions.setdefault(prefix, list()).append(job)
+    return list(sessions.items())
+
+def metadata_is_complete(check_dict):
+    """
+    Returns True if a document holds a session number, terminal and location
+    in its metadata.
+
+    >>> metadata_is_complete({'metadata':{'session_number':342, 'terminal':2, 'location':'nyc'}})
+    True
+    >>> metadata_is_complete({'metadata':{'session_number':None, 'terminal':2, 'location':'nyc'}})
+    False
+    """
+    if "metadata" not in check_dict:
+        return False
+
+    if "session_number" not in check_dict["metadata"]:
+        return False
+    elif not isinstance(check_dict["metadata"]["session_number"], int):
+        return False
+
+    if "terminal" not in check_dict["metadata"]:
+        return False
+    elif not isinstance(check_dict["metadata"]["terminal"], int):
+        return False
+
+    if "location" not in check_dict["metadata"]:
+        return False
+    elif not isinstance(check_dict["metadata"]["location"], str):
+        return False
+
+    return True
+
+def session_is_complete(document):
+    """
+    Returns True if a session document holds answers, metadata, media and
+    timestamps, as json_injector requires before importing it.
+
+    >>> session_is_complete({'answers':{}, 'metadata':{}, 'media':[], 'timestamps':{}})
+    True
+    >>> session_is_complete({'metadata':{}})
+    False
+    """
+    for key in ['answers', 'metadata', 'media', 'timestamps']:
+        if key not in document:
+            return False
+    return True
+
+def merge_document(session, file_type, document):
+    """
+    Merges the document of an info or answers file into a session document,
+    taking its metadata if the session's is not yet complete.
+
+    >>> session = dict()
+    >>> merge_document(session, 'ANSWERS', {'metadata':{'session_number':342, 'terminal':2, 'location':'nyc'}, 'answers':{'sex':'male'}})
+    >>> merge_document(session, 'INFO', {'metadata':{}, 'media':['H001.wav'], 'date':'2011-07-07', 'timestamps':{}})
+    >>> sorted(session.keys())
+    ['answers', 'date', 'media', 'metadata', 'timestamps']
+    >>> session['metadata']['session_number']
+    342
+    """
+    if file_type == 'INFO':
+        if not metadata_is_complete(session):
+            session["metadata"] = document["metadata"]
+        session["media"] = document["media"]
+        session["date"] = document["date"]
+        session["timestamps"] = document["timestamps"]
+
+    elif file_type == 'ANSWERS':
+        if not metadata_is_complete(session):
+            session["metadata"] = document["metadata"]
+        session["answers"] = document["answers"]
+
+def build_session(jobs, logger=None):
+    """
+    Parses the files of one session. Returns a tuple of the session document,
+    a list of parsers holding its songs, and a list of error messages for
+    files that could not be parsed. Files that are not merged or imported are
+    skipped.
+
+    >>> import tempfile, shutil
+    >>> from eim_corpus import generate
+    >>> from eim_discovery import discover, make_job
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = generate(directory, 1, song_lines=8)
+    >>> [(prefix, jobs)] = group_sessions(make_job(f.path) for f in discover(directory))
+    >>> (session, songs, errors) = build_session(jobs)
+    >>> sorted(session.keys()), len(songs), errors
+    (['answers', 'date', 'media', 'metadata', 'timestamps'], 3, [])
+    >>> shutil.rmtree(directory)
+    """
+    logger = logger or logging.getLogger('eim_pipeline')
+    session = dict()
+    songs = list()
+    errors = list()
+
+    for (file_type, parser_class) in session_parsers:
+        for job in jobs:
+            if job.file_type != file_type:
+                continue
+
+            try:
+                p = parser_class(job.path, logger, job)
+                p.parse()
+            except Exception as e:
+                errors.append("Error parsing %s: %s" % (job.path, e))
+                continue
+
+            if file_type == 'SONG':
+                songs.append(p)
+            else:
+                merge_document(session, file_type, p.to_dict())
+
+    return (session, songs, errors)
+
+class EIMFileSink():
+
+    def __init__(self, logger=None):
+        """
+        Writes session documents to <prefix>.json, as json_compiler does, and
+        song documents next to their source files, as master_parser does.
+        """
+        self.logger = logger or logging.getLogger('eim_pipeline')
+
+    def write_session(self, prefix, session):
+        """
+        Writes a session document to <prefix>.json.
+        """
+        filepath = '%s.json' % prefix
+        try:
+            f = open(filepath, 'w')
+        except:
+            raise EIMParsingError('Could not open %s for writing' % filepath)
+        try:
+            json.dump(session, f)
+        finally:
+            f.close()
+
+    def write_song(self, parser):
+        """
+        Writes the document of a parsed song file next to the file.
+        """
+        parser.to_json_file()
+
+    def close(self):
+        pass
+
+class EIMDBSink():
+
+    def __init__(self, connector, database='eim', logger=None):
+        """
+        Inserts session documents into the new_trials collection and song
+        documents into the new_signals collection of database, through a
+        connected EIMDBConnector. Sessions missing answers, metadata, media
+        or timestamps are skipped, as json_injector skips their files.
+
+        >>> class Connector():
+        ...     def insert_document(self, document, database, collection):
+        ...         print('%s.%s %s' % (database, collection, sorted(document.keys())))
+        ...     def disconnect(self):
+        ...         print('disconnected')
+        >>> class Song():
+        ...     def to_dict(self):
+        ...         return {'signals':{}}
+        >>> sink = EIMDBSink(Connector())
+        >>> sink.write_session('T1_S0001', {'answers':{}, 'metadata':{}, 'media':[], 'timestamps':{}})
+        eim.new_trials ['answers', 'media', 'metadata', 'timestamps']
+        >>> sink.write_session('T1_S0002', {'metadata':{}})
+        >>> sink.write_song(Song())
+        eim.new_signals ['signals']
+        >>> sink.close()
+        disconnected
+        """
+        self.connector = connector
+        self.database = database
+        self.logger = logger or logging.getLogger('eim_pipeline')
+
+    def write_session(self, prefix, session):
+        """
+        Inserts a session document, if it is complete.
+        """
+        if not session_is_complete(session):
+            self.logger.info("Skipping incomplete session %s" % prefix)
+            return
+        self.connector.insert_document(session, self.database, 'new_trials')
+
+    def write_song(self, parser):
+        """
+        Inserts the document of a parsed song file.
+        """
+        self.connector.insert_document(parser.to_dict(), self.database, 'new_signals')
+
+    def close(self):
+        self.connector.disconnect()
+
+def run_session(prefix, jobs, sink, logger=None):
+    """
+    Parses the files of one session and writes its documents to sink.
+    Returns a list of error messages, for files that could not be parsed or
+    documents that could not be written.
+
+    >>> import tempfile, shutil
+    >>> from eim_corpus import generate
+    >>> from eim_discovery import discover, make_job
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = generate(directory, 1, song_lines=8)
+    >>> [(prefix, jobs)] = group_sessions(make_job(f.path) for f in discover(directory))
+    >>> run_session(prefix, jobs, EIMFileSink())
+    []
+    >>> sorted(json.load(open(prefix + '.json')).keys())
+    ['answers', 'date', 'media', 'metadata', 'timestamps']
+    >>> len([f for f in discover(directory) if f.file_type == 'SONG' and f.extension == 'json'])
+    3
+    >>> shutil.rmtree(directory)
+    """
+    (session, songs, errors) = build_session(jobs, logger)
+
+    try:
+        if session:
+            sink.write_session(prefix, session)
+        for p in songs:
+            sink.write_song(p)
+    except Exception as e:
+        errors.append("Error writing session %s: %s" % (prefix, e))
+
+    return errors
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
@@ -0,0 +1,145 @@
+import time, json, contextlib, cProfile, os
+
+class EIMProfile():
+
+    def __init__(self):
+        """
+        Accumulates wall and CPU time, and call counts, per phase of a run and
+        per file type. Phases may nest; time is charged to the innermost phase
+        only, so phase totals add up to the time spent in all of them. A phase
+        entered without a file type takes the type of the phase around it.
+
+        >>> p = EIMProfile()
+        >>> with p.phase('parse', 'SONG'):
+        ...     with p.phase('read'):
+        ...         pass
+        >>> sorted(p.to_dict()['types']['SONG'].keys())
+        ['parse', 'read']
+        >>> p.to_dict()['phases']['read']['count']
+        1
+        """
+        self._totals = dict()
+        self._stack = list()
+        self._mark = None
+
+    def _charge(self):
+        # Charge the time since the last mark to the innermost open phase
+        now = (time.perf_counter(), time.thread_time())
+        if self._stack:
+            totals = self._entry(*self._stack[-1])
+            totals['wall'] += now[0] - self._mark[0]
+            totals['cpu'] += now[1] - self._mark[1]
+        self._mark = now
+
+    def _entry(self, name, file_type):
+        key = (name, file_type)
+        if key not in self._totals:
+            self._totals[key] = {'count':0, 'wall':0.0, 'cpu':0.0}
+        return self._totals[key]
+
+    @contextlib.contextmanager
+    def phase(self, name, file_type=None):
+        """
+        Times the enclosed block as one call of a phase.
+        """
+        if file_type is None and self._stack:
+            file_type = self._stack[-1][1]
+
+        self._charge()
+        self._stack.append((name, file_type))
+        try:
+            yield
+        finally:
+            self._charge()
+            self._stack.pop()
+            self._entry(name, file_type)['count'] += 1
+
+    def timed(self, name, iterable):
+        """
+        Yields the items of iterable, timing the production of each one as a
+        call of a phase.
+
+        >>> p = EIMProfile()
+        >>> list(p.timed('discover', range(3)))
+        [0, 1, 2]
+        >>> p.to_dict()['phases']['discover']['count']
+        4
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, report):
+        """
+        Adds the totals of a report returned by to_dict, such as one sent back
+        from a worker process.
+
+        >>> p = EIMProfile()
+        >>> with p.phase('write', 'INFO'):
+        ...     pass
+        >>> q = EIMProfile()
+        >>> q.add(p.to_dict())
+        >>> q.add(p.to_dict())
+        >>> q.to_dict()['types']['INFO']['write']['count']
+        2
+        """
+        for (file_type, phases) in report['types'].items():
+            for (name, totals) in phases.items():
+                entry = self._entry(name, None if file_type == 'ALL' else file_type)
+                for field in ['count', 'wall', 'cpu']:
+                    entry[field] += totals[field]
+
+    def to_dict(self):
+        """
+        Returns the totals as a dictionary with 'phases', summed over file
+        types, and 'types', per file type, each mapping phase names to their
+        'count', 'wall' and 'cpu' seconds. Phases timed without a file type
+        are listed under the type 'ALL'.
+        """
+        phases = dict()
+        types = dict()
+
+        for ((name, file_type), totals) in sorted(self._totals.items(), key=lambda item: (str(item[0][1]), item[0][0])):
+            types.setdefault(file_type or 'ALL', dict())[name] = dict(totals)
+            summed = phases.setdefault(name, {'count':0, 'wall':0.0, 'cpu':0.0})
+            for field in ['count', 'wall', 'cpu']:
+                summed[field] += totals[field]
+
+        return {'phases':phases, 'types':types}
+
+    def write(self, filepath, **extra):
+        """
+        Writes the totals, and any extra fields given, to a JSON report.
+        """
+        report = self.to_dict()
+        report.update(extra)
+        with open(filepath, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+def start_cprofile():
+    """
+    Starts a cProfile profiler for this process and returns it.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def dump_cprofile(profiler, prefix):
+    """
+    Stops a profiler started by start_cprofile and writes its stats to
+    <prefix>.<pid>.prof, to be read with pstats.
+    """
+    profiler.disable()
+    profiler.dump_stats('%s.%d.prof' % (prefix, os.getpid()))
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
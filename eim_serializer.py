@@ -0,0 +1,136 @@
+"""
+Streaming JSON serialization for parsed documents.
+
+dump writes a document exactly as json.dump(document, f) would, with the
+default separators, but NumPy arrays in it are written chunk by chunk
+rather than first being converted to lists, so a song file's signals never
+exist as a full list of Python numbers or as one long string.
+
+If orjson is installed it is used to encode chunks of numbers, and its
+compact output is spaced to match json.dump. Chunks holding floats that
+json.dump would write in exponent form, or that are not finite, are always
+encoded by the standard library.
+"""
+import json
+import numpy
+from eim_signals import column_to_list
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Number of array elements encoded at a time
+chunk_size = 8192
+
+def dump(document, f, fast=True):
+    """
+    Writes document to the open text file f as JSON. Dictionaries, lists and
+    tuples are walked, and NumPy arrays found in them are written as lists of
+    numbers, in chunks. Everything else is encoded by json.dumps. fast allows
+    orjson, when it is installed, to encode the chunks.
+
+    >>> import io
+    >>> signals = {'timestamps':numpy.array([0, 4, 8]), 'hr':numpy.array([71.429, 280.15, 1e-05], dtype=numpy.float32)}
+    >>> document = {'metadata':{'terminal':2, 'location':'manila'}, 'signals':signals, 'label':'R017'}
+    >>> out = io.StringIO()
+    >>> dump(document, out)
+    >>> out.getvalue()
+    '{"metadata": {"terminal": 2, "location": "manila"}, "signals": {"timestamps": [0, 4, 8], "hr": [71.429, 280.15, 1e-05]}, "label": "R017"}'
+    >>> document['signals'] = dict((name, column_to_list(values)) for (name, values) in signals.items())
+    >>> out.getvalue() == json.dumps(document)
+    True
+    """
+    if isinstance(document, numpy.ndarray):
+        write_array(document, f, fast)
+
+    elif isinstance(document, dict):
+        f.write('{')
+        for (index, (key, value)) in enumerate(document.items()):
+            if index:
+                f.write(', ')
+            if not isinstance(key, str):
+                key = json.dumps(key)
+            f.write(json.dumps(key))
+            f.write(': ')
+            dump(value, f, fast)
+        f.write('}')
+
+    elif isinstance(document, (list, tuple)):
+        f.write('[')
+        for (index, value) in enumerate(document):
+            if index:
+                f.write(', ')
+            dump(value, f, fast)
+        f.write(']')
+
+    else:
+        f.write(json.dumps(document))
+
+def write_array(values, f, fast=True):
+    """
+    Writes a one-dimensional NumPy array to f as a JSON list, chunk_size
+    numbers at a time. float32 readings are written through their shortest
+    decimal representation, as by column_to_list.
+
+    >>> import io
+    >>> out = io.StringIO()
+    >>> write_array(numpy.arange(20000), out)
+    >>> out.getvalue() == json.dumps(list(range(20000)))
+    True
+    """
+    f.write('[')
+    for start in range(0, len(values), chunk_size):
+        if start:
+            f.write(', ')
+        f.write(encode_numbers(values[start:start + chunk_size], fast))
+    f.write(']')
+
+def encode_numbers(values, fast=True):
+    """
+    Returns a chunk of a NumPy array encoded as the inside of a JSON list.
+
+    >>> encode_numbers(numpy.array([279.0, -0.0, 1e16, float('nan')]))
+    '279.0, -0.0, 1e+16, NaN'
+    >>> encode_numbers(numpy.array([1, 2], dtype=numpy.uint8), fast=False)
+    '1, 2'
+    """
+    numbers = column_to_list(values)
+
+    if fast and orjson and orjson_compatible(values):
+        return orjson.dumps(numbers)[1:-1].replace(b',', b', ').decode('ascii')
+
+    return json.dumps(numbers)[1:-1]
+
+def orjson_compatible(values):
+    """
+    Returns True if orjson encodes every number in an array the same way as
+    json.dumps: integers, and finite floats that Python writes without an
+    exponent. The bounds are kept a little inside Python's, so that float32
+    readings converted through their shortest representation stay inside
+    them too.
+
+    >>> orjson_compatible(numpy.array([0, 4])), orjson_compatible(numpy.array([0.0, 0.00011, 71.429]))
+    (True, True)
+    >>> orjson_compatible(numpy.array([1e-05])), orjson_compatible(numpy.array([1e16])), orjson_compatible(numpy.array([numpy.inf]))
+    (False, False, False)
+    """
+    if values.dtype.kind in 'iu':
+        return True
+
+    if values.dtype.kind != 'f':
+        return False
+
+    magnitudes = numpy.abs(values.astype(numpy.float64))
+    if not numpy.isfinite(magnitudes).all():
+        return False
+
+    nonzero = magnitudes[magnitudes != 0]
+    return bool(((nonzero >= 1.001e-4) & (nonzero < 1e15)).all())
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
@@ -0,0 +1,200 @@
+"""
+Binary signal files: a compact sidecar to the JSON written by to_json_file.
+
+A signal file (.eimsig) is laid out as follows. All numbers are little-endian.
+
+    offset  size  contents
+    0       8     magic bytes b'EIMSIG01'
+    8       4     unsigned header length, N
+    12      N     UTF-8 JSON header
+    D             column data, starting at the first 8-byte boundary D
+                  after the header, each column also 8-byte aligned
+
+The JSON header holds the parser's 'metadata' dictionary and 'label', the
+number of 'samples', and a 'columns' list with the 'name', NumPy 'dtype',
+byte 'offset' from D and element 'count' of each channel.
+Columns are stored contiguously, so any of them can be read or memory-mapped
+without decoding the others.
+"""
+import json, struct
+import numpy
+from eim_parser import EIMParsingError
+from eim_signals import EIMSignals, signal_types
+
+signal_file_magic = b'EIMSIG01'
+signal_file_extension = '.eimsig'
+
+def align(offset, boundary=8):
+    """
+    Rounds offset up to the next multiple of boundary.
+
+    >>> align(0), align(1), align(8), align(13)
+    (0, 8, 8, 16)
+    """
+    return (offset + boundary - 1) // boundary * boundary
+
+def write_signal_file(filepath, signals, metadata, label):
+    """
+    Writes an EIMSignals, its metadata dictionary and its label to filepath.
+
+    >>> s = EIMSignals({'timestamps':[0, 4], 'hr':[71.429, 72.5], 'hr_status':[1, 1]})
+    >>> write_signal_file('./.MANILA_T2_S9898_H001.eimsig', s, {'terminal':2}, 'H001')
+    >>> d = read_signal_file('./.MANILA_T2_S9898_H001.eimsig')
+    >>> d['label'], d['metadata']
+    ('H001', {'terminal': 2})
+    >>> d['signals'].to_dict()['hr']
+    [71.429, 72.5]
+    >>> import os
+    >>> os.unlink('./.MANILA_T2_S9898_H001.eimsig')
+    """
+    columns = list()
+    offset = 0
+    for (name, dtype) in signal_types:
+        dtype = numpy.dtype(dtype).newbyteorder('<')
+        count = len(signals[name])
+        columns.append({'name':name, 'dtype':dtype.str, 'offset':offset, 'count':count})
+        offset = align(offset + count * dtype.itemsize)
+
+    header = json.dumps({
+        'metadata':metadata, 'label':label, 'samples':len(signals),
+        'columns':columns}).encode('utf-8')
+    data_start = align(len(signal_file_magic) + 4 + len(header))
+
+    try:
+        f = open(filepath, 'wb')
+    except:
+        raise EIMParsingError('Could not write signal file %s' % filepath)
+
+    try:
+        f.write(signal_file_magic)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for column in columns:
+            f.write(b'\0' * (data_start + column['offset'] - f.tell()))
+            f.write(signals[column['name']].astype(column['dtype'], copy=False).tobytes())
+    finally:
+        f.close()
+
+def read_signal_header(f):
+    """
+    Reads the JSON header of an open signal file. Returns a tuple of the
+    header dictionary and the file offset at which the column data starts.
+    """
+    if f.read(len(signal_file_magic)) != signal_file_magic:
+        raise EIMParsingError('Not a signal file: %s' % f.name)
+
+    (length,) = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(length).decode('utf-8'))
+    return (header, align(len(signal_file_magic) + 4 + length))
+
+def read_signal_file(filepath):
+    """
+    Reads a signal file written by write_signal_file and returns a dictionary
+    with its 'metadata', 'label' and 'signals' (an EIMSignals).
+    """
+    try:
+        f = open(filepath, 'rb')
+    except:
+        raise EIMParsingError('Could not open signal file %s' % filepath)
+
+    try:
+        (header, data_start) = read_signal_header(f)
+        columns = dict()
+        for column in header['columns']:
+            f.seek(data_start + column['offset'])
+            columns[column['name']] = numpy.fromfile(f, dtype=column['dtype'], count=column['count'])
+    finally:
+        f.close()
+
+    return {
+        'metadata':header['metadata'],
+        'label':header['label'],
+        'signals':EIMSignals(columns)
+    }
+
+class EIMSignalFile():
+
+    def __init__(self, filepath):
+        """
+        Opens a signal file written by write_signal_file and memory-maps it.
+        Only the header is read; channels are returned as zero-copy views of
+        the mapping, so reading a few seconds of a recording only touches the
+        pages that hold them.
+
+        >>> s = EIMSignals({'timestamps':[0, 4, 8, 12], 'hr':[71.0, 72.0, 73.0, 74.0]})
+        >>> write_signal_file('./.MANILA_T2_S9898_H001.eimsig', s, {'terminal':2}, 'H001')
+        >>> m = EIMSignalFile('./.MANILA_T2_S9898_H001.eimsig')
+        >>> m.label, m.metadata, m.samples
+        ('H001', {'terminal': 2}, 4)
+        >>> m.column('hr', 1, 3).tolist()
+        [72.0, 73.0]
+        >>> m.time_slice('hr', 4, 12).tolist()
+        [72.0, 73.0]
+        >>> m.time_slice('eda_raw', 4, 12).tolist()
+        []
+        >>> m.close()
+        >>> import os
+        >>> os.unlink('./.MANILA_T2_S9898_H001.eimsig')
+        """
+        try:
+            f = open(filepath, 'rb')
+        except:
+            raise EIMParsingError('Could not open signal file %s' % filepath)
+
+        try:
+            (header, data_start) = read_signal_header(f)
+        finally:
+            f.close()
+
+        self._filepath = filepath
+        self.metadata = header['metadata']
+        self.label = header['label']
+        self.samples = header['samples']
+        self._map = numpy.memmap(filepath, dtype=numpy.uint8, mode='r')
+        self._columns = dict()
+
+        for column in header['columns']:
+            dtype = numpy.dtype(column['dtype'])
+            start = data_start + column['offset']
+            stop = start + column['count'] * dtype.itemsize
+            self._columns[column['name']] = self._map[start:stop].view(dtype)
+
+    def close(self):
+        """
+        Drops this reader's references to the mapping. Views already returned
+        keep it open until they are released.
+        """
+        self._columns = dict()
+        self._map = None
+
+    def column(self, name, start=None, stop=None):
+        """
+        Returns a read-only view of samples start to stop of a channel.
+        """
+        return self._columns[name][start:stop]
+
+    def index_range(self, start_millis, end_millis):
+        """
+        Returns the (start, stop) sample indices covering timestamps from
+        start_millis up to, but not including, end_millis. Timestamps are
+        assumed to be non-decreasing, as they are in every recording.
+        """
+        timestamps = self._columns['timestamps']
+        return (
+            int(numpy.searchsorted(timestamps, start_millis, side='left')),
+            int(numpy.searchsorted(timestamps, end_millis, side='left')))
+
+    def time_slice(self, name, start_millis, end_millis):
+        """
+        Returns a read-only view of a channel for timestamps from start_millis
+        up to, but not including, end_millis.
+        """
+        (start, stop) = self.index_range(start_millis, end_millis)
+        return self.column(name, start, stop)
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
@@ -0,0 +1,201 @@
+import numpy
+
+# Signal channels in file order, with the compact type each one is stored as
+signal_types = [
+    ('timestamps', numpy.int64),
+    ('eda_raw', numpy.float32),
+    ('eda_filtered', numpy.float32),
+    ('eda_status', numpy.uint8),
+    ('pox_raw', numpy.float32),
+    ('hr', numpy.float32),
+    ('hr_status', numpy.uint8)
+]
+
+signal_channels = [name for (name, dtype) in signal_types]
+
+# Range of each channel stored in a narrow integer type, outside of which its
+# values would silently wrap around
+channel_limits = dict((name, numpy.iinfo(dtype)) for (name, dtype) in signal_types
+        if numpy.dtype(dtype).kind in 'iu' and numpy.dtype(dtype).itemsize < 8)
+
+def column_to_list(values):
+    """
+    Converts a column to a list of Python numbers. Readings stored as float32
+    are converted through their shortest decimal representation, so that a
+    reading such as 280.15 is returned as 280.15 rather than as the nearest
+    float64 to its float32 value.
+
+    >>> column_to_list(numpy.array([280.15, 71.429], dtype=numpy.float32))
+    [280.15, 71.429]
+    >>> column_to_list(numpy.array([79573], dtype=numpy.int64))
+    [79573]
+    >>> column_to_list(numpy.zeros(0, dtype=numpy.float32))
+    []
+    """
+    if values.dtype == numpy.float32:
+        return values.astype(str).astype(numpy.float64).tolist()
+    return values.tolist()
+
+class EIMSignals():
+
+    def __init__(self, columns=None):
+        """
+        Initializes an empty set of signal columns, optionally filled from a
+        dictionary of column arrays or lists.
+
+        Each channel is kept in a typed NumPy buffer (int64 millis, float32
+        readings and uint8 status flags) that grows geometrically, so samples
+        may be appended one at a time or in blocks. Status flags outside the
+        range of their type are rejected with a ValueError rather than
+        wrapped.
+
+        >>> s = EIMSignals({'timestamps':[0, 4], 'hr':[71.429, 71.5]})
+        >>> len(s)
+        2
+        >>> s['hr'].dtype
+        dtype('float32')
+        >>> len(s['eda_raw'])
+        0
+        """
+        self._buffers = dict()
+        self._lengths = dict()
+        for (name, dtype) in signal_types:
+            self._buffers[name] = numpy.zeros(0, dtype=dtype)
+            self._lengths[name] = 0
+
+        if columns:
+            self.extend(columns)
+
+    def __len__(self):
+        return self._lengths['timestamps']
+
+    def __getitem__(self, name):
+        """
+        Returns a view of the filled part of a channel.
+
+        >>> s = EIMSignals()
+        >>> s.append('eda_status', 1)
+        >>> s['eda_status'].tolist()
+        [1]
+        >>> s['heart']
+        Traceback (most recent call last):
+            ...
+        KeyError: 'heart'
+        """
+        return self._buffers[name][:self._lengths[name]]
+
+    def reserve(self, name, capacity):
+        """
+        Ensures that a channel can hold at least capacity samples.
+
+        >>> s = EIMSignals()
+        >>> s.reserve('hr', 100)
+        >>> len(s._buffers['hr']) >= 100
+        True
+        >>> len(s['hr'])
+        0
+        """
+        current = self._buffers[name]
+        if len(current) >= capacity:
+            return
+
+        if self._lengths[name]:
+            capacity = max(capacity, 2 * len(current))
+
+        grown = numpy.zeros(capacity, dtype=current.dtype)
+        grown[:self._lengths[name]] = current[:self._lengths[name]]
+        self._buffers[name] = grown
+
+    def append(self, name, value):
+        """
+        Appends a single sample to a channel.
+
+        >>> s = EIMSignals()
+        >>> for i in range(20): s.append('timestamps', i * 4)
+        >>> len(s)
+        20
+        >>> int(s['timestamps'][-1])
+        76
+        >>> s.append('hr_status', 256)
+        Traceback (most recent call last):
+            ...
+        ValueError: hr_status values must be between 0 and 255
+        """
+        if name in channel_limits:
+            limits = channel_limits[name]
+            if not limits.min <= value <= limits.max:
+                raise ValueError('%s values must be between %d and %d' % (name, limits.min, limits.max))
+
+        length = self._lengths[name]
+        if length == len(self._buffers[name]):
+            self.reserve(name, max(16, 2 * length))
+        self._buffers[name][length] = value
+        self._lengths[name] = length + 1
+
+    def extend(self, columns):
+        """
+        Appends blocks of samples from a dictionary of column arrays or lists.
+
+        >>> s = EIMSignals()
+        >>> s.extend({'timestamps':[0, 4], 'eda_status':[1, 0]})
+        >>> s.extend({'timestamps':numpy.array([8])})
+        >>> s['timestamps'].tolist()
+        [0, 4, 8]
+        >>> s['eda_status'].tolist()
+        [1, 0]
+        >>> s.extend({'eda_status':[1, -1]})
+        Traceback (most recent call last):
+            ...
+        ValueError: eda_status values must be between 0 and 255
+        """
+        columns = dict((name, numpy.asarray(values)) for (name, values) in columns.items())
+
+        # Guard against values that would wrap around. Parsers drop such
+        # samples before they get here; check every column before any is
+        # extended, so a rejected block leaves the channels aligned
+        for (name, values) in columns.items():
+            if name in channel_limits and len(values):
+                limits = channel_limits[name]
+                if values.min() < limits.min or values.max() > limits.max:
+                    raise ValueError('%s values must be between %d and %d' % (name, limits.min, limits.max))
+
+        for (name, values) in columns.items():
+            length = self._lengths[name]
+            self.reserve(name, length + len(values))
+            self._buffers[name][length:length + len(values)] = values
+            self._lengths[name] = length + len(values)
+
+    def columns(self):
+        """
+        Returns a dictionary of views of every channel.
+
+        >>> sorted(EIMSignals().columns().keys()) == sorted(signal_channels)
+        True
+        """
+        return dict((name, self[name]) for name in signal_channels)
+
+    def nbytes(self):
+        """
+        Returns the number of bytes used by the filled part of every channel.
+
+        >>> EIMSignals({'timestamps':[0], 'hr':[1.0], 'hr_status':[1]}).nbytes()
+        13
+        """
+        return sum(self[name].nbytes for name in signal_channels)
+
+    def to_dict(self):
+        """
+        Returns every channel as a list of Python numbers, ready for JSON.
+
+        >>> d = EIMSignals({'timestamps':[17], 'eda_filtered':[280.15], 'eda_status':[1]}).to_dict()
+        >>> d['timestamps'], d['eda_filtered'], d['eda_status'], d['hr']
+        ([17], [280.15], [1], [])
+        """
+        return dict((name, column_to_list(self[name])) for name in signal_channels)
+
+def __test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    __test()
@@ -1,19 +1,157 @@
 from eim_parser import EIMParser, EIMParsingError, timestamp_to_millis
-import re, datetime, sys
+import re, datetime, sys, io, itertools, os
+import numpy
+from eim_signals import EIMSignals, signal_channels, channel_limits
+from eim_signal_file import write_signal_file, signal_file_extension
+
+# Whole-file equivalents of the line regex in EIMTestParser.parse_line, used
+# when a file is too irregular to be read as a table. The timestamp is split
+# into minutes, seconds and milliseconds so that it can be converted without a
+# second regex, and whitespace never crosses a newline so that a match cannot
+# span two samples. Seven-channel files (version 5) need every channel present;
+# older files only use timestamp, eda_raw and pox_raw.
+signal_regex = re.compile(
+        '^(\\d+):(\\d{2}).(\\d{3})\\d*[^\\S\\n](\\d+)[^\\S\\n](\\d+\\.?\\d*)[^\\S\\n](\\d+)[^\\S\\n](\\d+) (\\d+\\.?\\d*)[^\\S\\n](\\d+)',
+        re.M)
+legacy_signal_regex = re.compile(
+        '^(\\d+):(\\d{2}).(\\d{3})\\d*[^\\S\\n](\\d+)[^\\S\\n](\\d+\\.?\\d*)[^\\S\\n]\\d*[^\\S\\n]\\d* \\d+\\.?\\d*[^\\S\\n]\\d*',
+        re.M)
+
+def empty_signal_columns():
+    """
+    Returns a dictionary of empty NumPy arrays, one for each signal channel.
+
+    >>> sorted(empty_signal_columns().keys()) == sorted(signal_channels)
+    True
+    >>> empty_signal_columns()['eda_status'].dtype
+    dtype('int64')
+    """
+    return {
+        'timestamps':numpy.zeros(0, dtype=numpy.int64),
+        'eda_raw':numpy.zeros(0, dtype=numpy.float64),
+        'eda_filtered':numpy.zeros(0, dtype=numpy.float64),
+        'eda_status':numpy.zeros(0, dtype=numpy.int64),
+        'pox_raw':numpy.zeros(0, dtype=numpy.float64),
+        'hr':numpy.zeros(0, dtype=numpy.float64),
+        'hr_status':numpy.zeros(0, dtype=numpy.int64)
+    }
+
+def tokenize_signals(text, version):
+    """
+    Tokenizes the full text of a test or song file into NumPy column arrays
+    in a single vectorized pass. Returns a tuple of a dictionary of columns and
+    the number of lines that could not be parsed.
+
+    Regular files are read as a whitespace-separated table. Files with ragged
+    or non-numeric lines fall back to a whole-text regex that keeps every
+    well-formed sample. Samples whose status flags are not whole numbers in
+    the range of their channel are dropped and counted as malformed.
+
+    >>> text = '00:00.000 143 145.000 1 0 72.289 1\\n01:02.003 144 146.5 0 1 73.289 0\\n'
+    >>> (columns, malformed) = tokenize_signals(text, 5)
+    >>> columns['timestamps'].tolist()
+    [0, 62003]
+    >>> columns['eda_filtered'].tolist()
+    [145.0, 146.5]
+    >>> columns['hr_status'].tolist()
+    [1, 0]
+    >>> malformed
+    0
+
+    >>> (columns, malformed) = tokenize_signals(text + 'bad\\n', 5)
+    >>> columns['hr'].tolist()
+    [72.289, 73.289]
+    >>> malformed
+    1
+
+    >>> (columns, malformed) = tokenize_signals(text + '01:02.007 144 146.5 0 1 74.289 300\\n', 5)
+    >>> columns['hr_status'].tolist(), malformed
+    ([1, 0], 1)
+    >>> (columns, malformed) = tokenize_signals(text + '01:02.007 144 146.5 -1 1 74.289 1\\n01:02.011 144 146.5 1.7 1 74.289 1\\n', 5)
+    >>> columns['eda_status'].tolist(), malformed
+    ([1, 0], 2)
+
+    >>> text = '00:00.000 343 503 0 0 0 0 0 0 0 0 0 0 0 0\\n00:00.004 343 496 0 0 0 0 0 0 0 0 0 0 0 0'
+    >>> (columns, malformed) = tokenize_signals(text, 4)
+    >>> columns['timestamps'].tolist()
+    [0, 4]
+    >>> columns['pox_raw'].tolist()
+    [503.0, 496.0]
+    >>> columns['hr'].tolist()
+    []
+    """
+    total_lines = text.count('\n')
+    if text and not text.endswith('\n'):
+        total_lines += 1
+
+    columns = empty_signal_columns()
+    if not text.strip():
+        return (columns, total_lines)
+
+    # Split timestamps into minutes and seconds so every field is a number
+    table = None
+    try:
+        table = numpy.loadtxt(io.StringIO(text.replace(':', ' ')), dtype=numpy.float64,
+                comments=None, ndmin=2)
+    except ValueError:
+        pass
+
+    if table is not None and ((version > 4 and table.shape[1] == 8) or
+            (version <= 4 and table.shape[1] >= 8)):
+        minutes = table[:,0]
+        seconds = table[:,1]
+        fields = [table[:,i] for i in range(2, 8)]
+        rows = table.shape[0]
+    else:
+        if version > 4:
+            matches = signal_regex.findall(text)
+        else:
+            matches = legacy_signal_regex.findall(text)
+
+        if not matches:
+            return (columns, total_lines)
+
+        groups = list(zip(*matches))
+        minutes = numpy.array(groups[0], dtype=numpy.float64)
+        seconds = numpy.array(groups[1], dtype=numpy.float64) + numpy.array(groups[2], dtype=numpy.float64) / 1000.0
+        fields = [numpy.array(g, dtype=numpy.float64) for g in groups[3:]]
+        rows = len(matches)
+
+    # Drop samples whose status flags would not fit their channels, rather
+    # than truncating or rejecting the whole file
+    if version > 4:
+        valid = numpy.ones(rows, dtype=bool)
+        for (name, index) in [('eda_status', 2), ('hr_status', 5)]:
+            limits = channel_limits[name]
+            status = fields[index]
+            valid &= (status == numpy.floor(status)) & (status >= limits.min) & (status <= limits.max)
+        if not valid.all():
+            minutes = minutes[valid]
+            seconds = seconds[valid]
+            fields = [field[valid] for field in fields]
+            rows = int(valid.sum())
+
+    columns['timestamps'] = numpy.rint(minutes * 60000 + seconds * 1000).astype(numpy.int64)
+    columns['eda_raw'] = fields[0]
+
+    if version > 4:
+        columns['eda_filtered'] = fields[1]
+        columns['eda_status'] = fields[2].astype(numpy.int64)
+        columns['pox_raw'] = fields[3]
+        columns['hr'] = fields[4]
+        columns['hr_status'] = fields[5].astype(numpy.int64)
+    else:
+        columns['pox_raw'] = fields[1]
+
+    return (columns, total_lines - rows)
 
 class EIMTestParser(EIMParser):
-    def __init__(self, filepath, logger=None):
+    def __init__(self, filepath, logger=None, job=None):
         """
         Initializes EIMTestParser.
         """
-        super().__init__(filepath, logger)
-        self._timestamps = []
-        self._eda_raw = []
-        self._eda_filtered = []
-        self._eda_status = []
-        self._pox_raw = []
-        self._hr = []
-        self._hr_status = []
+        super().__init__(filepath, logger, job)
+        self._signals = EIMSignals()
 
     def to_dict(self):
         """
@@ -58,21 +196,150 @@ class EIMTestParser(EIMParser):
         >>> p.to_dict()['metadata']['session_number']
         576
         """
+        return self.assemble(self._signals.to_dict())
+
+    def json_document(self):
+        """
+        Assembles the document written by to_json_file, holding views of the
+        signal columns so that they are streamed rather than listed.
+        """
+        return self.assemble(self._signals.columns())
+
+    def assemble(self, signals):
+        """
+        Assembles a dictionary of parsed data around the given signals.
+        """
         data = {
             'metadata':self._experiment_metadata,
-            'signals': {
-                'timestamps':self._timestamps,
-                'eda_raw':self._eda_raw,
-                'eda_filtered':self._eda_filtered,
-                'eda_status':self._eda_status,
-                'pox_raw':self._pox_raw,
-                'hr':self._hr,
-                'hr_status':self._hr_status
-            },
-            'label':'test'
+            'signals':signals,
+            'label':self.label()
         }
         return data
 
+    def sample_count(self):
+        """
+        Returns the number of signal samples parsed.
+
+        >>> from eim_discovery import EIMJob
+        >>> job = EIMJob('/data/MANILA/T1_S9999_TEST.txt', 'TEST', 'manila', 1, 9999, 5, 0)
+        >>> p = EIMTestParser(job.path, job=job)
+        >>> p.parse_text('00:00.000 143 145.000 1 0 72.289 1\\nbad\\n00:00.004 144 146.5 0 1 73.289 0\\n')
+        >>> (p.sample_count(), p.malformed_lines)
+        (2, 1)
+        """
+        return len(self._signals)
+
+    def label(self):
+        """
+        Returns the label under which this file's signals are stored.
+        """
+        return 'test'
+
+    def to_signal_file(self):
+        """
+        Saves the parsed signals, metadata and label as a binary signal file
+        next to the source file. See eim_signal_file for the format.
+
+        >>> f = open('./.MANILA_T2_S9898_TEST.txt', 'w')
+        >>> f.writelines(['00:00.%03d 143 145.0 1 0 72.289 1\\n' % i for i in range(3)])
+        >>> f.close()
+        >>> p = EIMTestParser('./.MANILA_T2_S9898_TEST.txt')
+        >>> p.parse()
+        >>> p.to_signal_file()
+        >>> from eim_signal_file import read_signal_file
+        >>> d = read_signal_file('./.MANILA_T2_S9898_TEST.eimsig')
+        >>> d['label']
+        'test'
+        >>> d['metadata']['session_number']
+        9898
+        >>> d['signals'].to_dict()['timestamps']
+        [0, 1, 2]
+        >>> import os
+        >>> os.unlink(f.name)
+        >>> os.unlink('./.MANILA_T2_S9898_TEST.eimsig')
+        """
+        current_dir = os.path.dirname(self._filepath)
+        file_no_ext = os.path.splitext(os.path.basename(self._filepath))[0]
+        write_signal_file(
+                os.path.join(current_dir, file_no_ext + signal_file_extension),
+                self._signals,
+                self._experiment_metadata,
+                self.label())
+
+    def parse(self):
+        """
+        Parses all samples in a test or song file. The file is read at once and
+        tokenized by tokenize_signals rather than line by line.
+        """
+        try:
+            self.open_file()
+            with self.phase('read'):
+                text = self._file.read()
+            self.parse_text(text)
+            self.parse_session_number()
+
+        finally:
+            if self._file and not self._file.closed:
+                self.close_file()
+
+    def parse_text(self, text):
+        """
+        Parses the full text of a test or song file and appends its samples to
+        the signal columns. Malformed lines are skipped and logged as a single
+        error.
+        """
+        (columns, malformed) = tokenize_signals(text, self.version)
+        self._signals.extend(columns)
+        self.malformed_lines += malformed
+
+        if malformed:
+            self.logger.error('Skipped %d malformed lines in \'%s\'' % (malformed, self._filepath))
+
+    def iter_blocks(self, block_size=4096):
+        """
+        Parses a test or song file in blocks of block_size lines, yielding an
+        EIMSignals of the samples in each block. Only one block is held in
+        memory at a time and the parser's own signal columns are left empty, so
+        recordings of any length can be processed with bounded memory.
+
+        >>> f = open('./.MANILA_T2_S9898_H001.txt', 'w')
+        >>> f.writelines(['00:00.%03d 143 145.0 1 0 72.289 1\\n' % i for i in range(10)])
+        >>> f.close()
+        >>> p = EIMSongParser('./.MANILA_T2_S9898_H001.txt')
+        >>> blocks = list(p.iter_blocks(block_size=4))
+        >>> [len(b) for b in blocks]
+        [4, 4, 2]
+        >>> blocks[2].to_dict()['timestamps']
+        [8, 9]
+        >>> p._experiment_metadata['session_number']
+        9898
+        >>> len(p._signals)
+        0
+        >>> import os
+        >>> os.unlink(f.name)
+        """
+        malformed = 0
+        try:
+            self.open_file()
+            self.parse_session_number()
+
+            while True:
+                lines = list(itertools.islice(self._file, block_size))
+                if not lines:
+                    break
+
+                (columns, skipped) = tokenize_signals(''.join(lines), self.version)
+                malformed += skipped
+                self.malformed_lines += skipped
+                yield EIMSignals(columns)
+
+        finally:
+            if self._file and not self._file.closed:
+                self.close_file()
+
+        if malformed:
+            self.logger.error('Skipped %d malformed lines in \'%s\'' % (malformed, self._filepath))
+
     def parse_line(self, line, number):
         """
         Parses a line of text from an test file.
@@ -83,17 +350,17 @@ class EIMTestParser(EIMParser):
         >>> p = EIMTestParser('./test_data/DUBLIN/MuSE_SERVER/05-Sep-2010/T1_S0941_H003.txt')
         >>> p.parse_line('00:00.000 343 503 0 0 0 0 0 0 0 0 0 0 0 0', 1)
         >>> p.parse_line('00:00.000 343 496 0 0 0 0 0 0 0 0 0 0 0 0', 2)
-        >>> p._timestamps[0]
+        >>> p._signals.to_dict()['timestamps'][0]
         0
-        >>> p._timestamps[1]
+        >>> p._signals.to_dict()['timestamps'][1]
         0
-        >>> p._eda_raw[0]
+        >>> p._signals.to_dict()['eda_raw'][0]
         343.0
-        >>> p._eda_raw[1]
+        >>> p._signals.to_dict()['eda_raw'][1]
         343.0
-        >>> p._pox_raw[0]
+        >>> p._signals.to_dict()['pox_raw'][0]
         503.0
-        >>> p._pox_raw[1]
+        >>> p._signals.to_dict()['pox_raw'][1]
         496.0
 
         >>> p.parse_line('00:00.000 143 145.000 1 0 72.289', 3)
@@ -104,21 +371,21 @@ class EIMTestParser(EIMParser):
         >>> p = EIMTestParser('./test_data/.T1_MANILA_S9999_TEST.txt')
         >>> p.parse_line('00:00.000 143 145.000 1 0 72.289 1', 1)
         >>> p.parse_line('00:00.001 144 146.000 0 1 73.289 0', 2)
-        >>> p._timestamps[0]
+        >>> p._signals.to_dict()['timestamps'][0]
         0
-        >>> p._timestamps[1]
+        >>> p._signals.to_dict()['timestamps'][1]
         1
-        >>> p._eda_raw[1]
+        >>> p._signals.to_dict()['eda_raw'][1]
         144.0
-        >>> p._eda_filtered[1]
+        >>> p._signals.to_dict()['eda_filtered'][1]
         146.0
-        >>> p._eda_status[1]
+        >>> p._signals.to_dict()['eda_status'][1]
         0
-        >>> p._pox_raw[1]
+        >>> p._signals.to_dict()['pox_raw'][1]
         1.0
-        >>> p._hr[1]
+        >>> p._signals.to_dict()['hr'][1]
         73.289
-        >>> p._hr_status[1]
+        >>> p._signals.to_dict()['hr_status'][1]
         0
 
         >>> import os
@@ -126,26 +393,26 @@ class EIMTestParser(EIMParser):
         """
         match = re.search('(\d+:\d+.\d+)\s(\d+)\s(\d+\.?\d*)\s(\d*)\s(\d*) (\d+\.?\d*)\s(\d*)', line)
         if match and len(match.groups()) == 7 and self.version > 4:
-            self._timestamps.append(timestamp_to_millis(match.groups()[0]))
-            self._eda_raw.append(float(match.groups()[1]))
-            self._eda_filtered.append(float(match.groups()[2]))
-            self._eda_status.append(int(match.groups()[3]))
-            self._pox_raw.append(float(match.groups()[4]))
-            self._hr.append(float(match.groups()[5]))
-            self._hr_status.append(int(match.groups()[6]))
+            self._signals.append('timestamps', timestamp_to_millis(match.groups()[0]))
+            self._signals.append('eda_raw', float(match.groups()[1]))
+            self._signals.append('eda_filtered', float(match.groups()[2]))
+            self._signals.append('eda_status', int(match.groups()[3]))
+            self._signals.append('pox_raw', float(match.groups()[4]))
+            self._signals.append('hr', float(match.groups()[5]))
+            self._signals.append('hr_status', int(match.groups()[6]))
         elif match and len(match.groups()) == 7 and self.version <= 4:
-            self._timestamps.append(timestamp_to_millis(match.groups()[0]))
-            self._eda_raw.append(float(match.groups()[1]))
-            self._pox_raw.append(float(match.groups()[2]))
+            self._signals.append('timestamps', timestamp_to_millis(match.groups()[0]))
+            self._signals.append('eda_raw', float(match.groups()[1]))
+            self._signals.append('pox_raw', float(match.groups()[2]))
         else:
             raise EIMParsingError('Malformed line in \'%s:%d\': %s' % (self._filepath, number, line))
 
 class EIMSongParser(EIMTestParser):
-    def __init__(self, filepath, logger=None):
+    def __init__(self, filepath, logger=None, job=None):
         """
         Initializes EIMTestParser.
         """
-        super().__init__(filepath, logger)
+        super().__init__(filepath, logger, job)
 
     def to_dict(self):
         """
@@ -190,22 +457,35 @@ class EIMSongParser(EIMTestParser):
         >>> p.to_dict()['label']
         'R017'
 
+        """
+        return self.assemble(self._signals.to_dict())
+
+    def assemble(self, signals):
+        """
+        Assembles a dictionary of parsed data around the given signals.
+        """
+        return {
+            'metadata':self._experiment_metadata,
+            'label':self.label(),
+            'signals':signals
+        }
+
+    def label(self):
+        """
+        Returns the song label from the filename.
+
+        >>> import os
+        >>> os.mkdir('./.MANILA')
+        >>> f = open('./.MANILA/T2_S9898_R017.txt', 'w')
+        >>> f.close()
+        >>> EIMSongParser('./.MANILA/T2_S9898_R017.txt').label()
+        'R017'
+        >>> os.unlink(f.name)
+        >>> os.rmdir('./.MANILA')
         """
         match = re.search('/T\d+_.*_(.*).txt', self._filepath)
         if match:
-            return {
-                'metadata':self._experiment_metadata,
-                'label':match.groups()[0],
-                'signals': {
-                    'timestamps':self._timestamps,
-                    'eda_raw':self._eda_raw,
-                    'eda_filtered':self._eda_filtered,
-                    'eda_status':self._eda_status,
-                    'pox_raw':self._pox_raw,
-                    'hr':self._hr,
-                    'hr_status':self._hr_status
-                }
-            }
+            return match.groups()[0]
         else:
             raise EIMParsingError("Could not find a valid song label in %s" % self._filepath)
 
@@ -1,6 +1,12 @@
-import os, re, sys, pymongo, logging, json, cProfile
+import os, re, sys, pymongo, logging, json, cProfile, atexit, time
+import multiprocessing, multiprocessing.util, functools
 from optparse import OptionParser
 from pprint import pprint
+from eim_catalog import EIMCatalog
+from eim_logging import start_logging, stop_logging, worker_logging
+from eim_discovery import discover, classify
+from eim_profile import EIMProfile, start_cprofile, dump_cprofile
+from eim_pipeline import session_prefix, merge_document
 
 def main():
 
@@ -8,20 +14,24 @@ def main():
     usage = "usage: %prog [base_directory]"
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--dir', dest='root_dir', default=None, help='root directory for parsing')
+    parser.add_option('-c', '--catalog', dest='catalog', default=None, help='catalog database to take the worklist from instead of walking the tree')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='number of sessions to compile in parallel')
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False, help='only show INFO and higher on the screen')
+    parser.add_option('-p', '--profile', dest='profile', default=None, help='write wall and CPU time per phase and file type to this JSON report')
+    parser.add_option('--cprofile', dest='cprofile', default=None, help='write cProfile stats of each process to <prefix>.<pid>.prof')
     (options, args) = parser.parse_args()
 
-    # Configure file and STDOUT logging
+    # Log DEBUG and higher to file, and to the screen unless quiet. Records
+    # are written by a listener thread, off the parsing path.
+    listener = start_logging('json_compiler', 'json_compiler.log', logging.INFO if options.quiet else logging.DEBUG)
+    atexit.register(stop_logging, listener)
     logger = logging.getLogger('json_compiler')
-    logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler('json_compiler.log')
-    fh.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+
+    # Time phases of the run, and profile this process if asked
+    start = (time.perf_counter(), time.process_time())
+    profile = EIMProfile()
+    if options.cprofile:
+        profiler = start_cprofile()
 
     # Use base directory if specified in options
     if options.root_dir:
@@ -35,248 +45,205 @@ def main():
     file_list = list()
     ignored_files = list()
 
-    # Iterate over all files below root_dir
-    for root, dirs, files in os.walk(root_dir):
-        for f in files:
+    with profile.phase('discover'):
+
+        # Take the worklist from the catalog if one was given, rather than
+        # walking the directory tree
+        if options.catalog:
+            catalog = EIMCatalog(options.catalog, logger)
+            file_list = [row['path'] for row in catalog.query(extension='json', root_dir=options.root_dir)]
+            catalog.close()
 
-            # If file has .json extension
-            if re.search('.json$', f):
+        # Otherwise, iterate over all files below root_dir
+        else:
+            for f in discover(root_dir):
 
-                # Add absolute path to file to file_list
-                filepath = os.path.abspath(os.path.join(root, f))
-                logger.debug('Adding %s to worklist' % filepath)
-                file_list.append(filepath)
+                # If file has .json extension
+                if f.extension == 'json':
 
-            # Otherwise, ignore it
-            else:
-                ignored_files.append(f)
+                    # Add absolute path to file to file_list
+                    filepath = os.path.abspath(f.path)
+                    logger.debug('Adding %s to worklist' % filepath)
+                    file_list.append(filepath)
+
+                # Otherwise, ignore it
+                else:
+                    ignored_files.append(f.path)
 
     logger.info("Parsing %d .json files below %s" % (len(file_list), root_dir))
     logger.info("Ignoring %d files" % len(ignored_files))
 
-    total_files = len(file_list)
+    # Group the worklist by session, so that each session's base document
+    # is read, merged and written once rather than once per component file
+    sessions = list()
+    for (prefix, files) in group_files(file_list):
+        if prefix is None:
+            for f in files:
+                logger.debug("Skipping %s: no session prefix in its name" % f)
+        else:
+            sessions.append((prefix, files))
 
-    # Iterate over collected files
-    for (count, f) in enumerate(file_list):
+    total_files = sum(len(files) for (prefix, files) in sessions)
+    logger.info("Compiling %d sessions" % len(sessions))
 
-        # Get existing JSON dictionary
-        prefix = None
-        base_file = None
-        signals_file = None
-        base_filename = None
-        signals_filename = None
+    # Compile sessions in this process, or spread them over a pool of workers
+    worker = functools.partial(compile_session, profile=bool(options.profile))
+    if options.jobs > 1:
+        logger.info("Compiling with %d worker processes" % options.jobs)
+        pool = multiprocessing.Pool(options.jobs, init_worker, (listener.queue, options.cprofile))
+        results = pool.imap_unordered(worker, sessions)
+    else:
+        pool = None
+        results = map(worker, sessions)
+
+    count = 0
+    try:
+        # Collect results as sessions are finished
+        for (prefix, statuses, errors, report) in results:
+            if report:
+                profile.add(report)
+
+            for (f, merged) in statuses:
+                count += 1
+                if merged:
+                    print_parsing_status(count, total_files, f, logger)
+                else:
+                    print_skipping_status(count, total_files, f, logger)
+
+            for error in errors:
+                logger.error(error)
+
+    except BaseException:
+        # Stop the workers at once rather than waiting for them to finish the
+        # rest of the worklist before the error is seen
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if options.profile:
+        type_counts = dict()
+        for f in file_list:
+            file_type = classify(f).file_type
+            type_counts[file_type] = type_counts.get(file_type, 0) + 1
+        profile.write(options.profile, files=type_counts,
+                wall=time.perf_counter() - start[0], cpu=time.process_time() - start[1])
+        logger.info("Wrote profile report to %s" % options.profile)
+
+    if options.cprofile:
+        dump_cprofile(profiler, options.cprofile)
+
+def group_files(file_list):
+    """
+    Groups JSON files by the session prefix in their names, like
+    '/data/T3_S0142'. Returns a list of (prefix, files) pairs in the order
+    sessions were first seen; files without a prefix are grouped under None.
+    Compiled session files are left out, since they are the output.
+
+    >>> group_files(['/d/T3_S0142_1nfo.json', '/d/T3_S0142.json', '/d/T1_S0007_answers.json', '/d/T3_S0142_answers.json', '/d/notes.json'])
+    [('/d/T3_S0142', ['/d/T3_S0142_1nfo.json', '/d/T3_S0142_answers.json']), ('/d/T1_S0007', ['/d/T1_S0007_answers.json']), (None, ['/d/notes.json'])]
+    """
+    sessions = dict()
+    for f in file_list:
+        if classify(f).file_type == 'SESSION':
+            continue
+        sessions.setdefault(session_prefix(f), list()).append(f)
+    return list(sessions.items())
+
+def compile_session(session, profile=False):
+    """
+    Merges the info and answers JSON files of a (prefix, files) session into
+    its base document, <prefix>.json, which is loaded once if it exists and
+    written once. Files of other types are skipped. Returns a tuple of the
+    prefix, a list of (file, merged) pairs, a list of error messages, and, if
+    profile is True, the EIMProfile report of its phases. Runs in worker
+    processes when compiling in parallel.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> prefix = os.path.join(directory, 'T2_S0342')
+    >>> metadata = {'session_number':342, 'terminal':2, 'location':'nyc'}
+    >>> json.dump({'metadata':metadata, 'answers':{'sex':'male'}}, open(prefix + '_answers.json', 'w'))
+    >>> json.dump({'metadata':metadata, 'media':[], 'date':'2011-07-07', 'timestamps':{}}, open(prefix + '_1nfo.json', 'w'))
+    >>> (prefix, statuses, errors, report) = compile_session((prefix, [prefix + '_answers.json', prefix + '_1nfo.json', prefix + '_H001.json']))
+    >>> [merged for (f, merged) in statuses], errors
+    ([True, True, False], [])
+    >>> sorted(json.load(open(prefix + '.json')).keys())
+    ['answers', 'date', 'media', 'metadata', 'timestamps']
+    >>> shutil.rmtree(directory)
+    """
+    (prefix, files) = session
+    timings = EIMProfile()
+    statuses = list()
+    errors = list()
+    base_filename = '%s.json' % prefix
+
+    # Load the existing base document, or start an empty one
+    with timings.phase('read', 'SESSION'):
         base_dict = dict()
-        signals_dict = dict()
-        success = True
-
-        # Look for a 'prefix' in the filename, like 'T3_S0142'
-        match = re.search('(.*T\d_S\d+)', f)
-        if match:
-
-            # Set the base filename to <prefix>.json
-            prefix = match.groups()[0]
-            base_filename = '%s.json' % prefix
-
-            # signals_filename = '%s_signals.json' % prefix
-        else:
-            success = False
-
-        # If we found a prefix and set the base filename
-        if success:
-
-            # Open the file and load existing JSON into base_dict
-            try:
-                base_file = open(base_filename, 'r')
-                base_dict = json.load(base_file)
-
-            # If that threw an exception, assign an empty dict to base_dict
-            except:
-                base_dict = dict()
-
-
-            finally:
-                if base_file and not base_file.closed:
-                    base_file.close()
-
-        if success:
-
-            # Is this a reset file?
-            if re.search('T\d_S\d{4,}_RESET.json', f):
-
-                # Parse reset file
-                print_skipping_status(count + 1, total_files, f, logger)
-
-                # try:
-                #     reset_file = open(f, 'r')
-                #     reset_json = json.load(reset_file)
-                #     base_dict.update(reset_json)
-                #
-                # except Exception as e:
-                #     success = False
-                #     logger.error("Error parsing %s: %s" % (f, e))
-                #
-                # finally:
-                #     if not reset_file.closed:
-                #         reset_file.close()
-
-            # Is this an info file?
-            elif re.search('T\d_S\d{4,}_1nfo.json', f):
-
-                # Parse info file
-                print_parsing_status(count + 1, total_files, f, logger)
-
-                try:
-                    # Open the file
-                    info_file = open(f, 'r')
-
-                    # Load the JSON into a dict
-                    info_json = json.load(info_file)
-
-                    # If metadata isn't complete in the base dictionary, get it from this file
-                    if not metadata_is_complete(base_dict):
-                        base_dict["metadata"] = info_json["metadata"]
-
-                    # Put info file-specific data into the base_dict
-                    base_dict["media"] = info_json["media"]
-                    base_dict["date"] = info_json["date"]
-                    base_dict["timestamps"] = info_json["timestamps"]
-
-                except Exception as e:
-                    success = False
-                    logger.error("Error parsing %s: %s" % (f, e))
-
-                finally:
-                    if not info_file.closed:
-                        info_file.close()
-
-            # Is this a test file?
-            elif re.search('T\d_S\d{4,}_TEST.json', f):
-
-                # Parse test file
-                print_skipping_status(count + 1, total_files, f, logger)
-
-                # Build and use an EIMTestParser for this file
-                # try:
-                #     test_file = open(f, 'r')
-                #     test_json = json.load(test_file)
-                #     if 'signals' not in base_dict.keys():
-                #         base_dict['signals'] = dict()
-                #     base_dict['signals']['test'] = test_json['signals']['test']
-                #
-                # except Exception as e:
-                #     success = False
-                #     logger.error("Error parsing %s: %s" % (f, e))
-                #
-                # finally:
-                #     if not test_file.closed:
-                #         test_file.close()
-
-            # Is this a song file?
-            elif re.search('T\d_S\d{4,}_[HRST]\d{3,}.json', f):
-
-                # Parse song file
-                print_skipping_status(count + 1, total_files, f, logger)
-
-                # Build and use an EIMSongParser for this file
-                # try:
-                #     song_file = open(f, 'r')
-                #     song_json = json.load(song_file)
-                #     if 'signals' not in base_dict.keys():
-                #         base_dict['signals'] = dict()
-                #
-                #     match = re.search('T\d_S\d{4,}_([HRST]\d{3,})', f);
-                #     this_song = match.groups()[0]
-                #     base_dict['signals'][this_song] = song_json['signals']['songs'][this_song]
-                #
-                # except Exception as e:
-                #     success = False
-                #     logger.error("Error parsing %s: %s" % (f, e))
-                #
-                # finally:
-                #     if not song_file.closed:
-                #         song_file.close()
-
-            # Is this an answer file?
-            elif re.search('T\d_S\d{4,}_answers.json', f):
-
-                # Parse answer file
-                print_parsing_status(count + 1, total_files, f, logger)
-
-                try:
-                    # Open the file
-                    answer_file = open(f, 'r')
-
-                    # Load the JSON into a dict
-                    answer_json = json.load(answer_file)
-
-                    # If metadata isn't complete in the base dictionary, get it from this file
-                    if not metadata_is_complete(base_dict):
-                        base_dict["metadata"] = answer_json["metadata"]
-
-                    # Put answer file-specific data into the base_dict
-                    base_dict["answers"] = answer_json["answers"]
-
-                except Exception as e:
-                    success = False
-                    logger.error("Error parsing %s: %s" % (f, e))
-
-                finally:
-                    if not answer_file.closed:
-                        answer_file.close()
-
-
-            # Is this a debug file?
-            elif re.search('T\d_S\d{4,}_debug.json', f):
-
-                # Parse debug file
-                print_skipping_status(count + 1, total_files, f, logger)
-
-                # try:
-                #     debug_file = open(f, 'r')
-                #     debug_json = json.load(debug_file)
-                #     base_dict.update(debug_json)
-                #
-                # except Exception as e:
-                #     success = False
-                #     logger.error("Error parsing %s: %s" % (f, e))
-                #
-                # finally:
-                #     if not debug_file.closed:
-                #         debug_file.close()
-
-        if success:
-            base_file = open(base_filename, 'w')
+        base_file = None
+        try:
+            base_file = open(base_filename, 'r')
+            base_dict = json.load(base_file)
+        except:
+            base_dict = dict()
+        finally:
+            if base_file and not base_file.closed:
+                base_file.close()
+
+    # Merge info and answers files. Reset, test, song and debug files are
+    # not merged into the base document.
+    for f in files:
+        file_type = classify(f).file_type
+        if file_type not in ('INFO', 'ANSWERS'):
+            statuses.append((f, False))
+            continue
+
+        statuses.append((f, True))
+        component_file = None
+        try:
+            with timings.phase('read', file_type):
+                component_file = open(f, 'r')
+                component = json.load(component_file)
+            with timings.phase('compile', file_type):
+                merge_document(base_dict, file_type, component)
+
+        except Exception as e:
+            errors.append("Error parsing %s: %s" % (f, e))
+
+        finally:
+            if component_file and not component_file.closed:
+                component_file.close()
+
+    with timings.phase('write', 'SESSION'):
+        base_file = open(base_filename, 'w')
+        try:
             json.dump(base_dict, base_file)
-
-        if base_file and not base_file.closed:
+        finally:
             base_file.close()
 
+    return (prefix, statuses, errors, timings.to_dict() if profile else None)
+
+def init_worker(queue, cprofile_prefix=None):
+    """
+    Sets up a worker process: its log records are sent to the parent's
+    listener, and if cprofile_prefix is given it is profiled with cProfile
+    until it exits.
+    """
+    worker_logging(queue, 'json_compiler')
+    if cprofile_prefix:
+        profiler = start_cprofile()
+        multiprocessing.util.Finalize(None, dump_cprofile, (profiler, cprofile_prefix), exitpriority=10)
+
 def print_parsing_status(current, total, filename, logger):
     logger.debug("(%d/%d) Parsing %s" % (current, total, filename))
 
 def print_skipping_status(current, total, filename, logger):
     logger.debug("(%d/%d) Skipping %s" % (current, total, filename))
 
-def metadata_is_complete(check_dict):
-    if "metadata" not in check_dict:
-        return False
-
-    if "session_number" not in check_dict["metadata"]:
-        return False
-    elif not isinstance(check_dict["metadata"]["session_number"], int):
-        return False
-
-    if "terminal" not in check_dict["metadata"]:
-        return False
-    elif not isinstance(check_dict["metadata"]["terminal"], int):
-        return False
-
-    if "location" not in check_dict["metadata"]:
-        return False
-    elif not isinstance(check_dict["metadata"]["location"], str):
-        return False
-
-    return True
-
 if __name__ == "__main__":
     main()
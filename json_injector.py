@@ -1,27 +1,39 @@
-import os, re, logging, json
+import os, logging, json, atexit, time
 from optparse import OptionParser
-from subprocess import call
 from credentials import Credentials
+from eim_db_connector import EIMDBConnector
+from eim_catalog import EIMCatalog
+from eim_logging import start_logging, stop_logging
+from eim_discovery import discover, classify
+from eim_profile import EIMProfile, start_cprofile, dump_cprofile
+from eim_pipeline import session_is_complete
 
 def main():
     # Configure OptionParser
     usage = "usage: %prog [base_directory]"
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--dir', dest='root_dir', default=None, help='root directory for parsing')
+    parser.add_option('-c', '--catalog', dest='catalog', default=None, help='catalog database to take the worklist from instead of walking the tree')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=500, help='documents sent to the database per request')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=4, help='threads sending batches to the database, sharing one pool of connections')
+    parser.add_option('--host', dest='host', default='localhost', help='database host')
+    parser.add_option('--port', dest='port', type='int', default=27017, help='database port')
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False, help='only show INFO and higher on the screen')
+    parser.add_option('-p', '--profile', dest='profile', default=None, help='write wall and CPU time per phase and file type to this JSON report')
+    parser.add_option('--cprofile', dest='cprofile', default=None, help='write cProfile stats of this process to <prefix>.<pid>.prof')
     (options, args) = parser.parse_args()
 
-    # Configure logging to STDOUT and file
+    # Log DEBUG and higher to file, and to the screen unless quiet. Records
+    # are written by a listener thread, off the parsing path.
+    listener = start_logging('json_injector', 'json_injector.log', logging.INFO if options.quiet else logging.DEBUG)
+    atexit.register(stop_logging, listener)
     logger = logging.getLogger('json_injector')
-    logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler('json_injector.log')
-    fh.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+
+    # Time phases of the run, and profile this process if asked
+    start = (time.perf_counter(), time.process_time())
+    profile = EIMProfile()
+    if options.cprofile:
+        profiler = start_cprofile()
 
     # Use base directory if passed as option
     if options.root_dir:
@@ -34,74 +46,98 @@ def main():
     file_list = list()
     ignored_files = list()
 
-    # Iterate over all files below root_dir
-    for root, dirs, files in os.walk(root_dir):
-        for f in files:
+    with profile.phase('discover'):
+
+        # Take the worklist from the catalog if one was given, rather than
+        # walking the directory tree
+        if options.catalog:
+            catalog = EIMCatalog(options.catalog, logger)
+            file_list = sorted(
+                    [row['path'] for row in catalog.query(file_type='SESSION', extension='json', root_dir=options.root_dir)] +
+                    [row['path'] for row in catalog.query(file_type='SONG', extension='json', root_dir=options.root_dir)])
+            catalog.close()
 
-            # If a filename matches something like T2_S0134.json or T2_S0134_H001.json,
-            # add it to the worklist
-            if re.search('^T\d_S\d{4,}(?:_[HRST]\d{3})?.json$', f):
-                filepath = os.path.abspath(os.path.join(root, f))
-                logger.debug('Adding %s to worklist' % filepath)
-                file_list.append(filepath)
+        # Otherwise, iterate over all files below root_dir
+        else:
+            for f in discover(root_dir):
 
-            # Otherwise, add it to the list of ignored files
-            else:
-                ignored_files.append(f)
+                # If a filename matches something like T2_S0134.json or T2_S0134_H001.json,
+                # add it to the worklist
+                if f.extension == 'json' and f.file_type in ('SESSION', 'SONG'):
+                    filepath = os.path.abspath(f.path)
+                    logger.debug('Adding %s to worklist' % filepath)
+                    file_list.append(filepath)
+
+                # Otherwise, add it to the list of ignored files
+                else:
+                    ignored_files.append(f.path)
 
     logger.info("Parsing %d .json files below %s" % (len(file_list), root_dir))
     logger.info("Ignoring %d files" % len(ignored_files))
 
-    total_files = len(file_list)
+    # Connect once; every batch reuses the client's pool of connections
+    connector = EIMDBConnector(logger)
+    connector.connect(options.host, options.port, maxPoolSize=max(options.workers, 1),
+            username=Credentials.databaseUsername, password=Credentials.databasePassword,
+            authSource='admin')
 
-    # Iterate over collected files
+    # Send files like T2_S0134.json to the new_trials collection, and files
+    # like T2_S0134_H001.json to the new_signals collection, each in batches
+    # of unordered inserts
+    try:
+        for (file_type, collection) in [('SESSION', 'new_trials'), ('SONG', 'new_signals')]:
+            type_files = [f for f in file_list if classify(f).file_type == file_type]
+            documents = load_documents(type_files, file_type, profile, logger)
+            with profile.phase('write', file_type):
+                inserted = connector.bulk_insert(documents, 'eim', collection, options.batch_size, options.workers)
+            logger.info("Imported %d of %d %s files into %s" % (inserted, len(type_files), file_type, collection))
+    finally:
+        connector.disconnect()
+
+    if options.profile:
+        type_counts = dict()
+        for f in file_list:
+            file_type = classify(f).file_type
+            type_counts[file_type] = type_counts.get(file_type, 0) + 1
+        profile.write(options.profile, files=type_counts,
+                wall=time.perf_counter() - start[0], cpu=time.process_time() - start[1])
+        logger.info("Wrote profile report to %s" % options.profile)
+
+    if options.cprofile:
+        dump_cprofile(profiler, options.cprofile)
+
+def load_documents(file_list, file_type, profile, logger):
+    """
+    Yields the document of each JSON file in file_list, skipping files that
+    cannot be read and session files that are not complete.
+    """
     for (count, f) in enumerate(file_list):
-
-        # MongoDB collection to which we will write
-        collection = None
-
-        # If this is a file like T2_S0134_H001.json, as opposed to one like T2_S0134.json,
-        # send it to the new_signals collection
-        if re.search('[HRST]\d{3}.json', f):
-            collection = 'new_signals'
-
-        # Otherwise, send it to the new_sessions collection
-        else:
-            collection = 'new_trials'
-
-            # If this file doesn't pass muster, skip it
-            if not check_json_file(f):
-                logger.info("Skipping file (%d/%d) %s" % (count + 1, total_files, f))
-                continue
-
-        # Call `mongoimport` to send the file to the MongoDB server
-        logger.info("Importing file (%d/%d) %s" % (count + 1, total_files, f))
-        call(['mongoimport', '-h', 'localhost', '-d', 'eim', '-c', collection, '-u', Credentials.databaseUsername, '-p', Credentials.databasePassword, '--authenticationDatabase', 'admin', '--file', f])
-
-# Check validity of JSON file
-def check_json_file(filepath):
-    valid = True
+        with profile.phase('read', file_type):
+            document = load_json_file(f)
+        if document is None or (file_type == 'SESSION' and not session_is_complete(document)):
+            logger.info("Skipping file (%d/%d) %s" % (count + 1, len(file_list), f))
+            continue
+        logger.debug("Importing file (%d/%d) %s" % (count + 1, len(file_list), f))
+        yield document
+
+# Load a JSON file, or return None if it does not exist or is not valid JSON
+def load_json_file(filepath):
+    f = None
     try:
-        # Make sure it exists and contains valid JSON
         f = open(filepath, 'r')
-        j = json.load(f)
-
-        # Make sure dict from JSON contains answers, metadata, media, and timestamps properties
-        if not 'answers' in j:
-            valid = False
-        if not 'metadata' in j:
-            valid = False
-        if not 'media' in j:
-            valid = False
-        if not 'timestamps' in j:
-            valid = False
+        return json.load(f)
     except:
-        valid = False
+        return None
     finally:
         if f and not f.closed:
             f.close()
 
-    return valid
+# Check validity of JSON file
+def check_json_file(filepath):
+    # Make sure it exists, contains valid JSON, and that the dict from it
+    # contains answers, metadata, media, and timestamps properties
+    j = load_json_file(filepath)
+    return j is not None and session_is_complete(j)
 
 if __name__ == "__main__":
     main()
@@ -1,65 +1,112 @@
 from optparse import OptionParser
 import os, re, sys, pymongo
-from eim_parser import EIMParser, EIMParsingError
+from eim_parser import EIMParser, EIMParsingError, version_from_mtime
 from eim_info_parser import EIMInfoParser
 from eim_test_parser import EIMTestParser, EIMSongParser
 from eim_answers_parser import EIMAnswersParser
 from eim_debug_parser import EIMDebugParser
 from eim_reset_parser import EIMResetParser
+from eim_catalog import EIMCatalog
+from eim_logging import start_logging, stop_logging, worker_logging
+from eim_discovery import discover_roots, make_job, EIMJob
+from eim_profile import EIMProfile, start_cprofile, dump_cprofile
+from eim_metrics import EIMMetrics
 from pprint import pprint
 import logging
 import cProfile
+import multiprocessing, multiprocessing.util, functools, hashlib, json, atexit, time
+
+# Parser used for each data file type. Debug and email files are recognized
+# but not parsed.
+parser_classes = {
+    'RESET':EIMResetParser,
+    'INFO':EIMInfoParser,
+    'TEST':EIMTestParser,
+    'SONG':EIMSongParser,
+    'ANSWERS':EIMAnswersParser
+}
+
+# Relative parse cost per byte of each data file type. Signal files are
+# tokenized in one vectorized pass; the other parsers work line by line.
+# Types that are not parsed only cost a directory entry.
+type_weights = {
+    'RESET':4,
+    'INFO':4,
+    'TEST':1,
+    'SONG':1,
+    'ANSWERS':4
+}
+
+# Number of discovered files ordered together when parsing in parallel
+schedule_window = 256
 
 def main():
 
     # Setup option parser
     usage = "usage: %prog [options]"
     parser = OptionParser(usage=usage)
-    parser.add_option('-d', '--dir', dest='root_dir', default=None, help='root directory for parsing')
+    parser.add_option('-d', '--dir', dest='root_dirs', action='append', default=[], help='root directory for parsing; may be repeated')
+    parser.add_option('-c', '--catalog', dest='catalog', default=None, help='catalog database to take the worklist from instead of walking the tree')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='number of worker processes')
+    parser.add_option('-t', '--scan-threads', dest='scan_threads', type='int', default=8, help='number of threads scanning the root directories')
+    parser.add_option('-i', '--incremental', dest='incremental', action='store_true', default=False, help='skip files whose JSON output is up to date')
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False, help='only show INFO and higher on the screen')
+    parser.add_option('-p', '--profile', dest='profile', default=None, help='write wall and CPU time per phase and file type to this JSON report')
+    parser.add_option('--cprofile', dest='cprofile', default=None, help='write cProfile stats of each process to <prefix>.<pid>.prof')
+    parser.add_option('-m', '--metrics', dest='metrics', default=None, help='write throughput and error counts per file type to this JSON file')
+    parser.add_option('--prometheus', dest='prometheus', default=None, help='write the same metrics to this file in Prometheus textfile format')
     (options, args) = parser.parse_args()
 
-    # Setup loggers, logging errors and higher to screen, and debug and higher
-    # to file
+    # Time phases of the run, and profile this process if asked
+    start = (time.perf_counter(), time.process_time())
+    profile = EIMProfile()
+    scan_profile = EIMProfile()
+    if options.cprofile:
+        profiler = start_cprofile()
+
+    # Log DEBUG and higher to file, and to the screen unless quiet. Records
+    # are written by a listener thread, off the parsing path.
+    listener = start_logging('master_parser', 'master_parser.log', logging.INFO if options.quiet else logging.DEBUG)
+    atexit.register(stop_logging, listener)
     logger = logging.getLogger('master_parser')
-    logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler('master_parser.log')
-    fh.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
-
-    # If a root directory was specified, use it
-    if options.root_dir:
-        root_dir = options.root_dir
+
+    # If root directories were specified, use them
+    if options.root_dirs:
+        root_dirs = list()
+        for root_dir in options.root_dirs:
+            if root_dir not in root_dirs:
+                root_dirs.append(root_dir)
     # Otherwise, use the current directory as the root directory
     else:
-        root_dir = os.getcwd()
+        root_dirs = [os.getcwd()]
 
-    # Create lists to hold paths of all and ignored files
-    file_list = list()
+    # List of ignored files and per-root scan statistics, filled in as the
+    # tree is walked
     ignored_files = list()
-
-    # Iterate over all files below root_dir
-    for root, dirs, files in os.walk(root_dir):
-        for f in files:
-
-            # If the file is a text file, add it to the list of files to be
-            # parsed
-            if re.search('.txt$', f):
-                filepath = "%s/%s" % (root, f)
-                logger.debug('Adding %s to worklist' % filepath)
-                file_list.append(filepath)
-
-            # Otherwise, add it to the ignored file list
+    scan_stats = dict()
+
+    # Take the worklist from the catalog if one was given, rather than
+    # walking the directory tree
+    if options.catalog:
+        with profile.phase('discover'):
+            catalog = EIMCatalog(options.catalog, logger)
+            if options.root_dirs:
+                file_list = list()
+                for root_dir in root_dirs:
+                    file_list.extend(job_from_row(row) for row in catalog.query(extension='txt', root_dir=root_dir))
             else:
-                ignored_files.append(f)
+                file_list = [job_from_row(row) for row in catalog.query(extension='txt')]
+            catalog.close()
+        total_files = len(file_list)
+        logger.info("Parsing %d .txt files below %s" % (total_files, ', '.join(root_dirs)))
 
-    logger.info("Parsing %d .txt files below %s" % (len(file_list), root_dir))
-    logger.info("Ignoring %d files" % len(ignored_files))
+    # Otherwise, parse .txt files below the root directories as they are discovered
+    else:
+        file_list = walk_worklist(root_dirs, ignored_files, logger, options.scan_threads, scan_stats)
+        if options.profile:
+            file_list = scan_profile.timed('discover', file_list)
+        total_files = None
+        logger.info("Parsing .txt files below %s" % ', '.join(root_dirs))
 
     # Determine data file types from among:
     # reset, test, info, answers, debug, and song
@@ -72,126 +119,307 @@ def main():
         'SONG':0,
         'UNKNOWN':0}
 
-    total_files = len(file_list)
-
-    # Iterate over collected files
-    for (index, f) in enumerate(file_list):
-
-        # Is this a reset file?
-        if re.search('T\d_S\d{4,}_RESET.txt', f):
-
-            # Parse reset file
-            print_parsing_status(index + 1, total_files, f, logger)
-
-            # Build and use an EIMResetParser for this file
-            try:
-                p = EIMResetParser(f, logger)
-                p.parse()
-                p.to_json_file()
-
-            except Exception as e:
-                logger.error("Error parsing %s: %s" % (f, e))
-
-            # Update counts
-            type_counts['RESET'] += 1
-
-        # Is this an info file?
-        elif re.search('T\d_S\d{4,}_1nfo.txt', f):
-            # Parse info file
-            print_parsing_status(index + 1, total_files, f, logger)
-
-            # Build and use an EIMInfoParser for this file
-            try:
-                p = EIMInfoParser(f, logger)
-                p.parse()
-                p.to_json_file()
-
-            except Exception as e:
-                logger.error("Error parsing %s: %s" % (f, e))
-
-            # Update counts
-            type_counts['INFO'] += 1
-
-        # Is this a test file?
-        elif re.search('T\d_S\d{4,}_TEST.txt', f):
-            # Parse test file
-            print_parsing_status(index + 1, total_files, f, logger)
-
-            # Build and use an EIMTestParser for this file
-            try:
-                p = EIMTestParser(f, logger)
-                p.parse()
-                p.to_json_file()
-
-            except:
-                logger.error("Error parsing %s" % f)
-
-            # Update counts
-            type_counts['TEST'] += 1
-
-        # Is this a song file?
-        elif re.search('T\d_S\d{4,}_[HRST]\d{3,}.txt', f):
-            # Parse song file
-            print_parsing_status(index + 1, total_files, f, logger)
-
-            # Build and use an EIMSongParser for this file
-            try:
-                p = EIMSongParser(f, logger)
-                p.parse()
-                p.to_json_file()
+    parsed_files = 0
+    skipped_files = 0
+    metrics = EIMMetrics()
+    worker = functools.partial(parse_file, incremental=options.incremental, profile=bool(options.profile))
+
+    # Parse files in this process, or spread them over a pool of workers.
+    # A discovered worklist is scheduled in windows so that the walk can
+    # keep running while the first files are parsed.
+    if options.jobs > 1:
+        logger.info("Parsing with %d worker processes" % options.jobs)
+        pool = multiprocessing.Pool(options.jobs, init_worker, (listener.queue, options.cprofile))
+        window = None if total_files is not None else schedule_window
+        results = pool.imap_unordered(worker, schedule_worklist(file_list, window))
+    else:
+        pool = None
+        results = map(worker, file_list)
+
+    try:
+        # Collect results as files are finished
+        for (index, (f, file_type, skipped, error, report, stats)) in enumerate(results):
+            parsed_files += 1
+
+            if report:
+                profile.add(report)
+            if stats is not None:
+                metrics.record(file_type, error=bool(error), skipped=skipped, **stats)
+
+            if file_type == 'UNKNOWN':
+                logger.warn("(%s) Unrecognized file: %s" % (progress(index, total_files), f))
+            elif skipped:
+                skipped_files += 1
+                print_skipping_status(index + 1, total_files, f, logger)
+            else:
+                print_parsing_status(index + 1, total_files, f, logger)
 
-            except:
-                logger.error("Error parsing %s" % f)
+            if error:
+                logger.error(error)
 
             # Update counts
-            type_counts['SONG'] += 1
+            if file_type in type_counts:
+                type_counts[file_type] += 1
+
+    except BaseException:
+        # Stop the workers at once rather than waiting for them to finish the
+        # rest of the worklist before the error is seen
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if total_files is None:
+        for root_dir in root_dirs:
+            logger.info("Scanned %d files below %s in %.2f s" % (
+                scan_stats[root_dir]['files'], root_dir, scan_stats[root_dir]['seconds']))
+        logger.info("Parsed %d .txt files below %s" % (parsed_files, ', '.join(root_dirs)))
+        logger.info("Ignoring %d files" % len(ignored_files))
 
-        # Is this an answer file?
-        elif re.search('T\d_S\d{4,}_answers.txt', f):
-            # Parse answer file
-            print_parsing_status(index + 1, total_files, f, logger)
-
-            # Build and use an EIMAnswersParser for this file
+    logger.info(type_counts)
+    if options.incremental:
+        logger.info("Skipped %d unchanged files" % skipped_files)
+
+    wall = time.perf_counter() - start[0]
+    if options.metrics:
+        metrics.write_json(options.metrics, wall, jobs=options.jobs)
+        logger.info("Wrote metrics to %s" % options.metrics)
+    if options.prometheus:
+        metrics.write_prometheus(options.prometheus, wall)
+        logger.info("Wrote Prometheus metrics to %s" % options.prometheus)
+
+    if options.profile:
+        profile.add(scan_profile.to_dict())
+        profile.write(options.profile, jobs=options.jobs, files=type_counts,
+                wall=wall, cpu=time.process_time() - start[1])
+        logger.info("Wrote profile report to %s" % options.profile)
+
+    if options.cprofile:
+        dump_cprofile(profiler, options.cprofile)
+
+def init_worker(queue, cprofile_prefix=None):
+    """
+    Sets up a worker process: its log records are sent to the parent's
+    listener, and if cprofile_prefix is given it is profiled with cProfile
+    until it exits.
+    """
+    worker_logging(queue, 'master_parser')
+    if cprofile_prefix:
+        profiler = start_cprofile()
+        multiprocessing.util.Finalize(None, dump_cprofile, (profiler, cprofile_prefix), exitpriority=10)
+
+def walk_worklist(root_dirs, ignored_files, logger, threads=8, stats=None):
+    """
+    Yields an EIMJob for every .txt file below the root directories as it is
+    discovered, appending the paths of all other files to ignored_files. The
+    roots are scanned concurrently on a pool of threads, and stats is filled
+    in with the file count and scan time of each root.
+    """
+    for f in discover_roots(root_dirs, threads, stats):
+        if f.extension == 'txt':
             try:
-                p = EIMAnswersParser(f, logger)
-                p.parse()
-                p.to_json_file()
-
-            except:
-                logger.error("Error parsing %s" % f)
-
-            # Update counts
-            type_counts['ANSWERS'] += 1
-
-        # Is this a debug file?
-        elif re.search('T\d_S\d{4,}_debug.txt', f):
-            # Parse debug file
-            print_parsing_status(index + 1, total_files, f, logger)
-
-            # Build and use an EIMDebugParser for this file
-            # try:
-            #     p = EIMDebugParser(f, logger)
-            #     p.parse()
-            #     p.to_json_file()
-            #
-            # except:
-            #     logger.error("Error parsing %s" % f)
-
-            # Update counts
-            type_counts['DEBUG'] += 1
-
-        elif re.search('T\d_S\d{4}_email.txt', f):
-            print_parsing_status(index + 1, total_files, f, logger)
-
+                job = make_job(f.path)
+            except OSError as e:
+                logger.error('Could not add %s to worklist: %s' % (f.path, e))
+                continue
+            logger.debug('Adding %s to worklist' % f.path)
+            yield job
         else:
-            type_counts['UNKNOWN'] += 1
-            logger.warn("(%d/%d) Unrecognized file: %s" % (index, total_files, f))
-
-    logger.info(type_counts)
+            ignored_files.append(f.path)
+
+def job_from_row(row):
+    """
+    Builds an EIMJob from a catalog row.
+    """
+    return EIMJob(row['path'], row['file_type'], row['location'], row['terminal'],
+            row['session_number'], row['version'], row['size'])
+
+def schedule_worklist(file_list, window=None):
+    """
+    Orders a worklist for parallel parsing by estimated cost, largest first,
+    so that long song files start early and the small reset, info and answer
+    files fill in the gaps at the end of the run. Cost is the file size scaled
+    by the per-byte weight of its parser.
+
+    If window is given, files are ordered in consecutive groups of that many,
+    so that a lazily discovered worklist is dispatched as it is found.
+
+    >>> jobs = [EIMJob('T1_S0001_RESET.txt', 'RESET', 'nyc', 1, 1, 5, 30),
+    ...     EIMJob('T1_S0001_R001.txt', 'SONG', 'nyc', 1, 1, 5, 700000),
+    ...     EIMJob('T1_S0001_answers.txt', 'ANSWERS', 'nyc', 1, 1, 5, 3000)]
+    >>> [job.path for job in schedule_worklist(jobs)]
+    ['T1_S0001_R001.txt', 'T1_S0001_answers.txt', 'T1_S0001_RESET.txt']
+    >>> [job.path for job in schedule_worklist(jobs, window=2)]
+    ['T1_S0001_R001.txt', 'T1_S0001_RESET.txt', 'T1_S0001_answers.txt']
+    """
+    def cost(job):
+        return job.size * type_weights.get(job.file_type, 0)
+
+    group = list()
+    for job in file_list:
+        group.append(job)
+        if window and len(group) == window:
+            for scheduled in sorted(group, key=cost, reverse=True):
+                yield scheduled
+            group = list()
+
+    for scheduled in sorted(group, key=cost, reverse=True):
+        yield scheduled
+
+def parse_file(job, incremental=False, profile=False):
+    """
+    Parses the file of an EIMJob and writes its JSON file, and in incremental
+    mode, its stamp. Returns a tuple of the filepath, its data file type,
+    whether it was skipped because its output was up to date, an error
+    message, or None if it parsed cleanly, if profile is True, the EIMProfile
+    report of its phases, and the file's statistics for EIMMetrics.record:
+    its size, samples, malformed lines and the seconds taken. Files of types
+    that are not parsed have no statistics. Runs in worker processes when
+    parsing in parallel.
+    """
+    logger = logging.getLogger('master_parser')
+    filepath = job.path
+    file_type = job.file_type
+    error = None
+
+    if file_type not in parser_classes:
+        return (filepath, file_type, False, error, None, None)
+
+    if incremental and output_is_current(filepath):
+        return (filepath, file_type, True, error, None, {})
+
+    timings = EIMProfile() if profile else None
+    stats = {'size':job.size or 0, 'samples':0, 'malformed':0}
+    start = time.perf_counter()
+
+    # Build and use the parser for this file type
+    try:
+        p = parser_classes[file_type](filepath, logger, job)
+        p.profile = timings
+        try:
+            with p.phase('parse'):
+                p.parse()
+        finally:
+            stats['samples'] = p.sample_count()
+            stats['malformed'] = p.malformed_lines
+        p.to_json_file()
+
+        # Stamps are only read back in incremental mode, so only pay for
+        # hashing the source then. Otherwise drop any stamp left by an
+        # earlier incremental run, which describes the source of the JSON
+        # output just replaced.
+        with p.phase('write'):
+            if incremental:
+                write_stamp(filepath)
+            else:
+                remove_stamp(filepath)
+
+    except Exception as e:
+        error = "Error parsing %s: %s" % (filepath, e)
+
+    stats['seconds'] = time.perf_counter() - start
+    return (filepath, file_type, False, error, timings.to_dict() if timings else None, stats)
+
+def file_digest(filepath):
+    """
+    Returns the SHA-1 hex digest of a file's contents.
+    """
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_stamp(filepath):
+    """
+    Records the size, modification time and content hash of a source file in
+    a .stamp file next to its JSON output.
+    """
+    stat = os.stat(filepath)
+    stamp = {'size':stat.st_size, 'mtime':stat.st_mtime, 'sha1':file_digest(filepath)}
+    with open(os.path.splitext(filepath)[0] + '.stamp', 'w') as f:
+        json.dump(stamp, f)
+
+def remove_stamp(filepath):
+    """
+    Removes the .stamp file of a source file, if it has one.
+    """
+    try:
+        os.unlink(os.path.splitext(filepath)[0] + '.stamp')
+    except FileNotFoundError:
+        pass
+
+def output_is_current(filepath):
+    """
+    Returns True if the JSON output of a source file exists and the source is
+    unchanged since its stamp was written. Files whose modification time has
+    changed but whose size has not are compared by content hash, unless the
+    new time gives the file another version: the version is read from the
+    modification time, so the file has to be parsed again.
+
+    >>> f = open('./.MANILA_T2_S9898_RESET.txt', 'w')
+    >>> f.close()
+    >>> output_is_current('./.MANILA_T2_S9898_RESET.txt')
+    False
+    >>> open('./.MANILA_T2_S9898_RESET.json', 'w').close()
+    >>> write_stamp('./.MANILA_T2_S9898_RESET.txt')
+    >>> output_is_current('./.MANILA_T2_S9898_RESET.txt')
+    True
+    >>> import datetime
+    >>> later = datetime.datetime(2030, 1, 1).timestamp()
+    >>> os.utime('./.MANILA_T2_S9898_RESET.txt', (later, later))
+    >>> output_is_current('./.MANILA_T2_S9898_RESET.txt')
+    True
+    >>> dublin = datetime.datetime(2010, 8, 1).timestamp()
+    >>> os.utime('./.MANILA_T2_S9898_RESET.txt', (dublin, dublin))
+    >>> output_is_current('./.MANILA_T2_S9898_RESET.txt')
+    False
+    >>> f = open('./.MANILA_T2_S9898_RESET.txt', 'w')
+    >>> written = f.write('Slide 11 Black1.maxpat')
+    >>> f.close()
+    >>> output_is_current('./.MANILA_T2_S9898_RESET.txt')
+    False
+    >>> for ext in ['txt', 'json', 'stamp']: os.unlink('./.MANILA_T2_S9898_RESET.' + ext)
+    """
+    base = os.path.splitext(filepath)[0]
+    if not os.path.exists(base + '.json'):
+        return False
+
+    try:
+        with open(base + '.stamp', 'r') as f:
+            stamp = json.load(f)
+        stat = os.stat(filepath)
+    except (OSError, ValueError):
+        return False
+
+    if stat.st_size != stamp.get('size'):
+        return False
+    if stat.st_mtime == stamp.get('mtime'):
+        return True
+    if stamp.get('mtime') is None or version_from_mtime(stat.st_mtime) != version_from_mtime(stamp['mtime']):
+        return False
+    return file_digest(filepath) == stamp.get('sha1')
+
+def print_skipping_status(current, total, filename, logger):
+    logger.debug("(%s) Skipping unchanged %s" % (progress(current, total), filename))
+
+def progress(current, total):
+    """
+    Formats a progress counter, leaving out the total while it is unknown.
+
+    >>> progress(3, 7), progress(3, None)
+    ('3/7', '3')
+    """
+    if total is None:
+        return '%d' % current
+    return '%d/%d' % (current, total)
 
 def print_parsing_status(current, total, filename, logger):
-    logger.debug("(%d/%d) Parsing %s" % (current, total, filename))
+    logger.debug("(%s) Parsing %s" % (progress(current, total), filename))
 
 if __name__ == "__main__":
-    # cProfile.run('main()', 'master_parser.prof')
     main()
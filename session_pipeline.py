@@ -0,0 +1,139 @@
+from optparse import OptionParser
+import os, logging, atexit, multiprocessing, multiprocessing.util
+from eim_catalog import EIMCatalog
+from eim_logging import start_logging, stop_logging, worker_logging
+from eim_db_connector import EIMDBConnector
+from eim_pipeline import group_sessions, run_session, EIMFileSink, EIMDBSink
+from master_parser import walk_worklist, job_from_row
+
+# Sink of the documents built in this process, set up by open_sink
+sink = None
+
+def main():
+
+    # Setup option parser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--dir', dest='root_dirs', action='append', default=None, help='root directory for parsing; may be given more than once')
+    parser.add_option('-c', '--catalog', dest='catalog', default=None, help='catalog database to take the worklist from instead of walking the tree')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='number of sessions to process in parallel')
+    parser.add_option('-t', '--scan-threads', dest='scan_threads', type='int', default=8, help='number of threads scanning the root directories')
+    parser.add_option('-s', '--sink', dest='sink', default='file', help="where session documents go: 'file' or 'db'")
+    parser.add_option('--host', dest='host', default='localhost', help='database host for the db sink')
+    parser.add_option('--port', dest='port', type='int', default=27017, help='database port for the db sink')
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False, help='only show INFO and higher on the screen')
+    (options, args) = parser.parse_args()
+
+    if options.sink not in ('file', 'db'):
+        parser.error("--sink must be 'file' or 'db'")
+
+    # Log DEBUG and higher to file, and to the screen unless quiet. Records
+    # are written by a listener thread, off the parsing path.
+    listener = start_logging('session_pipeline', 'session_pipeline.log', logging.INFO if options.quiet else logging.DEBUG)
+    atexit.register(stop_logging, listener)
+    logger = logging.getLogger('session_pipeline')
+
+    root_dirs = options.root_dirs or [os.getcwd()]
+
+    # Take the worklist from the catalog if one was given, rather than
+    # walking the directory tree. Sessions can only be grouped once all of
+    # their files have been found.
+    if options.catalog:
+        catalog = EIMCatalog(options.catalog, logger)
+        if options.root_dirs:
+            file_list = list()
+            for root_dir in root_dirs:
+                file_list.extend(job_from_row(row) for row in catalog.query(extension='txt', root_dir=root_dir))
+        else:
+            file_list = [job_from_row(row) for row in catalog.query(extension='txt')]
+        catalog.close()
+    else:
+        file_list = list(walk_worklist(root_dirs, list(), logger, options.scan_threads))
+
+    sessions = group_sessions(file_list)
+    logger.info("Processing %d sessions below %s into the %s sink" % (len(sessions), ', '.join(root_dirs), options.sink))
+
+    sink_options = (options.sink, options.host, options.port)
+
+    # Process sessions in this process, or spread them over a pool of
+    # workers, each with its own sink
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs, init_worker, (listener.queue, sink_options))
+        results = pool.imap_unordered(process_session, sessions)
+    else:
+        pool = None
+        open_sink(*sink_options)
+        results = map(process_session, sessions)
+
+    failed_sessions = 0
+    try:
+        for (index, (prefix, errors)) in enumerate(results):
+            logger.debug("(%d/%d) Processed session %s" % (index + 1, len(sessions), prefix))
+            for error in errors:
+                logger.error(error)
+            if errors:
+                failed_sessions += 1
+
+    except BaseException:
+        # Stop the workers at once rather than waiting for them to finish the
+        # rest of the sessions before the error is seen
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+
+    finally:
+        if not pool:
+            close_sink()
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    logger.info("Processed %d sessions, %d with errors" % (len(sessions), failed_sessions))
+
+def open_sink(kind, host='localhost', port=27017):
+    """
+    Sets up the sink of this process: an EIMFileSink, or an EIMDBSink
+    connected to the database on host:port with the importing credentials.
+    """
+    global sink
+    logger = logging.getLogger('session_pipeline')
+
+    if kind == 'db':
+        from credentials import Credentials
+        connector = EIMDBConnector(logger)
+        connector.connect(host, port, username=Credentials.databaseUsername,
+                password=Credentials.databasePassword, authSource='admin')
+        sink = EIMDBSink(connector, logger=logger)
+    else:
+        sink = EIMFileSink(logger)
+
+def close_sink():
+    """
+    Closes the sink of this process.
+    """
+    if sink:
+        sink.close()
+
+def init_worker(queue, sink_options):
+    """
+    Sets up a worker process: its log records are sent to the parent's
+    listener, and it opens its own sink, which is closed when it exits.
+    """
+    worker_logging(queue, 'session_pipeline')
+    open_sink(*sink_options)
+    multiprocessing.util.Finalize(None, close_sink, exitpriority=10)
+
+def process_session(session):
+    """
+    Parses the files of a (prefix, jobs) session from group_sessions and
+    writes its documents to this process's sink. Returns the prefix and a
+    list of error messages. Runs in worker processes when processing in
+    parallel.
+    """
+    (prefix, jobs) = session
+    return (prefix, run_session(prefix, jobs, sink, logging.getLogger('session_pipeline')))
+
+if __name__ == "__main__":
+    main()